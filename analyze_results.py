@@ -1,11 +1,25 @@
 """
 Visualization and Analysis Script for Hallucination Detection Results
 Run this after main.py to generate visual insights
+
+Reads the columnar results directory (default: detection_results) through
+memory-mapped arrays, so the analysis stays fast for millions of cases
+
+Usage:
+    python analyze_results.py [RESULTS_DIR]
 """
 
-import json
+import sys
+import time
 import numpy as np
-from collections import Counter
+
+from result_columns import ResultColumns
+from score_matrix import METHODS, classification_metrics
+
+# Error cases listed per kind; the rest are only counted
+MAX_LISTED_ERRORS = 20
+
+results_path = sys.argv[1] if len(sys.argv) > 1 else 'detection_results'
 
 print("=" * 80)
 print("VISUALIZATION & ANALYSIS OF DETECTION RESULTS")
@@ -13,120 +27,116 @@ print("=" * 80)
 
 # Load results
 try:
-    with open('detection_results.json', 'r') as f:
-        data = json.load(f)
-    
-    results = data['results']
-    metrics = data['metrics']
-    
+    start = time.perf_counter()
+    results = ResultColumns(results_path)
+    load_ms = (time.perf_counter() - start) * 1000
+
+    predictions = results.predictions
+    actuals = results.labels
+    confidences = results.confidence
+    metrics = results.metrics or classification_metrics(actuals, predictions)
+
     print("\n[1] Loading Results...")
-    print(f"✓ Loaded {len(results)} cases")
-    
-    # Extract data for analysis
-    categories = [r['category'] for r in results]
-    predictions = [r['prediction'] for r in results]
-    actuals = [r['actual'] for r in results]
-    confidences = [r['confidence'] for r in results]
-    
-    # Category distribution
+    print(f"✓ Loaded {len(results)} cases ({load_ms:.1f} ms, memory-mapped)")
+
+    # Category distribution (categories are stored as codes into results.categories)
     print("\n[2] Category Distribution:")
-    category_counts = Counter(categories)
-    for cat, count in category_counts.most_common():
-        print(f"  {cat}: {count}")
-    
-    # Correct vs Incorrect by Category
+    has_category = results.category >= 0
+    codes = np.asarray(results.category[has_category], dtype=np.int64)
+    category_counts = np.bincount(codes, minlength=len(results.categories))
+    for code in np.argsort(-category_counts, kind='stable'):
+        if category_counts[code]:
+            print(f"  {results.categories[code]}: {category_counts[code]}")
+
+    # Correct vs Incorrect by Category (labeled cases only; unlabeled ones are -1)
     print("\n[3] Detection Accuracy by Category:")
+    labeled = actuals >= 0
+    labeled_codes = np.asarray(results.category[has_category & labeled], dtype=np.int64)
+    labeled_counts = np.bincount(labeled_codes, minlength=len(results.categories))
+    correct_mask = (predictions == actuals)[has_category & labeled]
+    correct_counts = np.bincount(labeled_codes, weights=correct_mask, minlength=len(results.categories))
     category_accuracy = {}
-    for cat in set(categories):
-        cat_results = [(r['prediction'], r['actual']) for r in results if r['category'] == cat]
-        correct = sum(1 for pred, actual in cat_results if pred == actual)
-        total = len(cat_results)
-        accuracy = correct / total if total > 0 else 0
+    for code, cat in enumerate(results.categories):
+        total = int(labeled_counts[code])
+        if total == 0:
+            continue
+        correct = int(correct_counts[code])
+        accuracy = correct / total
         category_accuracy[cat] = accuracy
         status = "✓" if accuracy >= 0.8 else "⚠"
         print(f"  {status} {cat}: {accuracy:.1%} ({correct}/{total})")
-    
+
     # Confidence distribution
     print("\n[4] Confidence Analysis:")
-    high_conf = sum(1 for c in confidences if c >= 0.8)
-    med_conf = sum(1 for c in confidences if 0.5 <= c < 0.8)
-    low_conf = sum(1 for c in confidences if c < 0.5)
+    high_conf = int(np.sum(confidences >= 0.8))
+    med_conf = int(np.sum((confidences >= 0.5) & (confidences < 0.8)))
+    low_conf = int(np.sum(confidences < 0.5))
     print(f"  High confidence (≥0.8): {high_conf}")
     print(f"  Medium confidence (0.5-0.8): {med_conf}")
     print(f"  Low confidence (<0.5): {low_conf}")
-    
+
     # False positives and negatives analysis
     print("\n[5] Error Analysis:")
-    false_positives = [r for r in results if r['prediction'] == 1 and r['actual'] == 0]
-    false_negatives = [r for r in results if r['prediction'] == 0 and r['actual'] == 1]
-    
-    if false_positives:
-        print(f"\n  False Positives ({len(false_positives)}):")
-        for fp in false_positives:
-            print(f"    - Case {fp['id']}: {fp['query'][:60]}...")
-            print(f"      Category: {fp['category']}")
-            print(f"      Confidence: {fp['confidence']:.3f}")
-    
-    if false_negatives:
-        print(f"\n  False Negatives ({len(false_negatives)}):")
-        for fn in false_negatives:
-            print(f"    - Case {fn['id']}: {fn['query'][:60]}...")
-            print(f"      Category: {fn['category']}")
-            print(f"      Confidence: {fn['confidence']:.3f}")
+    false_positives = np.flatnonzero((predictions == 1) & (actuals == 0))
+    false_negatives = np.flatnonzero((predictions == 0) & (actuals == 1))
+
+    def print_errors(title, rows):
+        print(f"\n  {title} ({len(rows)}):")
+        for row in rows[:MAX_LISTED_ERRORS]:
+            print(f"    - Case {results.case_id(row)}: {results.query(row)[:60]}...")
+            print(f"      Category: {results.category_name(row)}")
+            print(f"      Confidence: {results.confidence[row]:.3f}")
+        if len(rows) > MAX_LISTED_ERRORS:
+            print(f"    ... and {len(rows) - MAX_LISTED_ERRORS} more")
+
+    if len(false_positives):
+        print_errors("False Positives", false_positives)
+
+    if len(false_negatives):
+        print_errors("False Negatives", false_negatives)
     else:
         print("\n  ✓ No False Negatives - All hallucinations detected!")
-    
+
     # Detection method contribution
     print("\n[6] Detection Method Contribution:")
-    entailment_correct = 0
-    similarity_correct = 0
-    domain_correct = 0
-    
-    for r in results:
-        method_scores = r['method_scores']
-        ent_pred = method_scores['entailment'][0]
-        sim_pred = method_scores['similarity'][0]
-        dom_pred = method_scores['domain'][0]
-        
-        if ent_pred == r['actual']:
-            entailment_correct += 1
-        if sim_pred == r['actual']:
-            similarity_correct += 1
-        if dom_pred == r['actual']:
-            domain_correct += 1
-    
-    total = len(results)
-    print(f"  NLI Entailment: {entailment_correct}/{total} ({entailment_correct/total:.1%})")
-    print(f"  Semantic Similarity: {similarity_correct}/{total} ({similarity_correct/total:.1%})")
-    print(f"  Domain Classifier: {domain_correct}/{total} ({domain_correct/total:.1%})")
-    
+    total = int(labeled.sum())
+    for name, label in [('entailment', 'NLI Entailment'), ('similarity', 'Semantic Similarity'),
+                        ('domain', 'Domain Classifier')]:
+        correct = int(np.sum(results.method_votes[labeled, METHODS.index(name)] == actuals[labeled]))
+        print(f"  {label}: {correct}/{total} ({correct/total if total else 0:.1%})")
+
     # Recommendations
     print("\n[7] Recommendations:")
     if metrics['recall'] < 1.0:
         print("  ⚠ Improve recall to catch all hallucinations (patient safety critical)")
     else:
         print("  ✓ Perfect recall achieved - all hallucinations caught")
-    
+
     if metrics['precision'] < 0.9:
         print(f"  ⚠ {int((1-metrics['precision'])*100)}% false positive rate - consider tuning thresholds")
-    
+
     if len(results) < 50:
         print("  ⚠ Small dataset - expand to 100+ cases for robust evaluation")
-    
+
     print("\n[8] Key Findings:")
-    print(f"  • Best performing category: {max(category_accuracy, key=category_accuracy.get)}")
-    print(f"  • Most challenging category: {min(category_accuracy, key=category_accuracy.get)}")
+    if category_accuracy:
+        print(f"  • Best performing category: {max(category_accuracy, key=category_accuracy.get)}")
+        print(f"  • Most challenging category: {min(category_accuracy, key=category_accuracy.get)}")
+    else:
+        print("  • No labeled cases with a category")
     print(f"  • Average confidence: {np.mean(confidences):.3f}")
     print(f"  • System bias: {'Conservative (flags more)' if metrics['precision'] < 0.9 else 'Balanced'}")
-    
+
     print("\n" + "=" * 80)
     print("ANALYSIS COMPLETE")
     print("=" * 80)
-    print("\nFor detailed results, see detection_results.json")
+    print(f"\nFor single cases (with corrections), run: python3 result_columns.py {results_path} --case ROW")
     print("For full report, see final_report.md")
-    
+
 except FileNotFoundError:
-    print("\n❌ Error: detection_results.json not found")
+    print(f"\n❌ Error: {results_path}/ not found")
     print("Please run main.py first to generate results")
+    print("(convert an old detection_results.json with: "
+          f"python3 result_columns.py --convert detection_results.json {results_path})")
 except Exception as e:
     print(f"\n❌ Error: {e}")
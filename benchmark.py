@@ -0,0 +1,323 @@
+"""
+Reproducible Benchmark Suite for the Detection Pipeline
+Times cold start, model loading, every detector stage, the full ensemble,
+correction and result serialization on datasets synthesized from
+medical_dataset at 1x, 10x and 100x scale, and writes machine-readable
+results that can be diffed between commits
+
+Usage:
+    python benchmark.py --scales 1,10,100 --output benchmark_results.json
+    python benchmark.py --scales 1,10 --backend onnx-int8 --cascade --output onnx.json
+    python benchmark.py compare benchmark_results.json onnx.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+
+import numpy as np
+
+from onnx_backend import BACKENDS, DEFAULT_ONNX_DIR, run_in_fresh_process, peak_rss_mb
+from nli_models import NLI_PRESETS, DEFAULT_NLI_PRESET
+from main import HallucinationDetector, nli_kwargs
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SCALES = (1, 10, 100)
+SCALE_MODES = ('variant', 'copy')
+# Cases scored (and discarded) before timing, so lazy allocations are not billed to the run
+WARMUP_CASES = 4
+
+
+def scale_dataset(cases, factor, mode='variant'):
+    """factor copies of cases with unique ids
+
+    'variant' makes every copy after the first a distinct case (the output gets
+    a reference tag, so no cache or dedup can short-circuit it); 'copy' repeats
+    the cases verbatim, for measuring what caching and deduplication save.
+    Labels, evidence and queries are kept, so metrics stay meaningful.
+    """
+    if mode not in SCALE_MODES:
+        raise ValueError(f"Unknown scale mode: {mode} (choose from {', '.join(SCALE_MODES)})")
+    stride = max(int(item['id']) for item in cases) + 1
+    scaled = []
+    for k in range(factor):
+        for item in cases:
+            output = item['llm_output'] if k == 0 or mode == 'copy' else f"{item['llm_output']} [ref {k}]"
+            scaled.append({**item, 'id': int(item['id']) + k * stride, 'llm_output': output})
+    return scaled
+
+
+def git_revision():
+    """(commit hash, working tree has uncommitted changes) of the repo, or (None, None)"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+# ============================================================================
+# MEASUREMENTS
+# ============================================================================
+
+def measure_cold_start(repeats=3):
+    """Median seconds to start a fresh interpreter and import the pipeline"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import main'], cwd=REPO_DIR, check=True)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def _load_models(detector_kwargs):
+    """Load time of each model and the process's peak RSS; runs in a fresh process"""
+    from instrumentation import StageProfiler
+
+    detector = HallucinationDetector(profiler=StageProfiler(), **detector_kwargs)
+    detector.nli_model
+    detector.similarity_model
+    detector.domain_classifier
+    stages = detector.profiler.summary()['stages']
+    return {
+        'load_sec': {name.split(':', 1)[1]: stage['wall_sec'] for name, stage in stages.items()},
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def _run_scale(cases, detector_kwargs, repeats, cascade, workers):
+    """Per-repeat stage profiles, detection/serialization times and metrics, peak RSS, and the worker pool's
+    startup time (None without workers); runs in a fresh process"""
+    from main import HallucinationCorrector, run_evaluation, compute_metrics, save_results
+    from instrumentation import StageProfiler
+    from parallel_runner import DetectionPool
+    from score_matrix import ScoreMatrix
+
+    detector = HallucinationDetector(**detector_kwargs)
+    corrector = HallucinationCorrector([item['evidence'] for item in cases])
+    pool = None
+    pool_startup_sec = None
+    if workers > 1:
+        # One pool for all repeats; its startup (spawning workers, loading their models) is timed on its own.
+        # One-case shards give every worker a warm-up shard
+        start = time.perf_counter()
+        pool = DetectionPool(workers, detector_kwargs=detector_kwargs, profiler=StageProfiler())
+        pool.detect(cases[:WARMUP_CASES * workers], shard_size=1, cascade=cascade)
+        pool_startup_sec = time.perf_counter() - start
+    else:
+        detector.nli_model
+        detector.similarity_model
+        detector.domain_classifier
+        run_evaluation(detector, corrector, cases[:WARMUP_CASES], cascade=cascade)
+
+    runs = []
+    try:
+        for _ in range(repeats):
+            profiler = StageProfiler()
+            detector.profiler = corrector.profiler = profiler
+            start = time.perf_counter()
+            batch_detections = None
+            if pool is not None:
+                pool.profiler = profiler
+                batch_detections, _ = pool.detect(cases, cascade=cascade)
+            results, predictions, labels = run_evaluation(detector, corrector, cases, cascade=cascade,
+                                                          batch_detections=batch_detections)
+            detect_sec = time.perf_counter() - start
+
+            metrics = compute_metrics(labels, predictions)
+            matrix = ScoreMatrix.from_results(results, detector.DEFAULT_WEIGHTS, detector.thresholds())
+            # save_results writes to the working directory; keep the benchmark's copies out of the repo
+            cwd = os.getcwd()
+            with tempfile.TemporaryDirectory() as tmp, open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                os.chdir(tmp)
+                try:
+                    with profiler.span('save_results', len(results)):
+                        save_results(metrics, results, len(cases), matrix, os.path.join(tmp, 'detection_scores.npz'))
+                finally:
+                    os.chdir(cwd)
+
+            runs.append({'detect_sec': detect_sec, 'profile': profiler.summary(), 'metrics': metrics})
+    finally:
+        if pool is not None:
+            pool.close()
+    return runs, peak_rss_mb(), pool_startup_sec
+
+
+def summarize_runs(runs, n_cases):
+    """Median over repeats of the end-to-end and per-stage timings"""
+    def median(values):
+        values = [v for v in values if v is not None]
+        return float(np.median(values)) if values else None
+
+    detect_sec = median(r['detect_sec'] for r in runs)
+    stage_names = list(dict.fromkeys(name for r in runs for name in r['profile']['stages']))
+    stages = {}
+    for name in stage_names:
+        samples = [r['profile']['stages'][name] for r in runs if name in r['profile']['stages']]
+        stages[name] = {
+            'calls': samples[0]['calls'],
+            'items': samples[0]['items'],
+            'wall_sec': median(s['wall_sec'] for s in samples),
+            'cpu_sec': median(s['cpu_sec'] for s in samples),
+            'items_per_sec': median(s['items_per_sec'] for s in samples),
+            'latency_ms': {q: median(s['latency_ms'][q] for s in samples) for q in samples[0]['latency_ms']}
+        }
+    metrics = runs[0]['metrics']
+    return {
+        'cases': n_cases,
+        'repeats': len(runs),
+        'detect_sec': detect_sec,
+        'cases_per_sec': n_cases / detect_sec if detect_sec else None,
+        'stages': stages,
+        'accuracy': metrics['accuracy'],
+        'f1_score': metrics['f1_score']
+    }
+
+
+def run_benchmark(scales=DEFAULT_SCALES, mode='variant', repeats=3, cascade=False, workers=1, detector_kwargs=None,
+                  cases=None):
+    """Full benchmark report (a JSON-serializable dict)"""
+    detector_kwargs = detector_kwargs or {}
+    if cases is None:
+        from medical_dataset import get_dataset
+        cases = get_dataset()
+    commit, dirty = git_revision()
+
+    report = {
+        'meta': {
+            'commit': commit,
+            'dirty': dirty,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'detector': dict(detector_kwargs),
+            'cascade': cascade,
+            'workers': workers,
+            'scale_mode': mode,
+            'repeats': repeats,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+    }
+    print("  → Cold start...")
+    report['cold_start_sec'] = measure_cold_start(repeats)
+    print("  → Model load...")
+    report['model_load'] = run_in_fresh_process(_load_models, detector_kwargs)
+
+    report['scales'] = {}
+    for factor in scales:
+        scaled = scale_dataset(cases, factor, mode)
+        print(f"  → {factor}x ({len(scaled)} cases)...")
+        runs, rss, pool_startup_sec = run_in_fresh_process(_run_scale, scaled, detector_kwargs, repeats, cascade,
+                                                           workers)
+        report['scales'][f'{factor}x'] = {**summarize_runs(runs, len(scaled)), 'peak_rss_mb': rss,
+                                          'pool_startup_sec': pool_startup_sec}
+    return report
+
+
+# ============================================================================
+# REPORTING AND COMPARISON
+# ============================================================================
+
+def flatten(report, prefix=''):
+    """Numeric leaves of a report as {'dotted.path': value}"""
+    flat = {}
+    for key, value in report.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def compare_reports(base, new):
+    """(metric, base value, new value, new/base) for every numeric metric present in both reports"""
+    base_flat, new_flat = flatten(base), flatten(new)
+    rows = []
+    for key in base_flat:
+        if key in new_flat and not key.startswith('meta.'):
+            b, n = base_flat[key], new_flat[key]
+            rows.append((key, b, n, n / b if b else None))
+    return rows
+
+
+def print_report(report):
+    print(f"\nBenchmark ({report['meta']['commit'] or 'no git'}{' +dirty' if report['meta']['dirty'] else ''})")
+    print(f"  Cold start (import main): {report['cold_start_sec']:.2f} s")
+    loads = report['model_load']
+    print(f"  Model load: " + ", ".join(f"{name} {sec:.1f} s" for name, sec in loads['load_sec'].items())
+          + f" (peak {loads['peak_rss_mb']:.0f} MB)")
+    for scale, result in report['scales'].items():
+        print(f"\n  {scale}: {result['cases']} cases in {result['detect_sec']:.2f} s "
+              f"({result['cases_per_sec']:.1f} cases/s, peak {result['peak_rss_mb']:.0f} MB)")
+        if result.get('pool_startup_sec') is not None:
+            print(f"    Worker pool startup (not in detection time): {result['pool_startup_sec']:.2f} s")
+        print(f"    {'Stage':<16} {'Wall s':>8} {'CPU s':>8} {'Items/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+        for name, stage in result['stages'].items():
+            throughput = f"{stage['items_per_sec']:>10.1f}" if stage['items_per_sec'] is not None else f"{'-':>10}"
+            print(f"    {name:<16} {stage['wall_sec']:>8.3f} {stage['cpu_sec']:>8.3f} {throughput} "
+                  f"{stage['latency_ms']['p50']:>8.2f} {stage['latency_ms']['p99']:>8.2f}")
+
+
+def print_comparison(rows, min_change=0.05):
+    """Metrics whose new/base ratio moved by more than min_change"""
+    changed = [row for row in rows if row[3] is not None and abs(row[3] - 1) > min_change]
+    print(f"\n{len(changed)} of {len(rows)} metrics changed by more than {min_change:.0%}")
+    for key, b, n, ratio in sorted(changed, key=lambda row: -abs(np.log(row[3])) if row[3] > 0 else 0):
+        print(f"  {key:<55} {b:>12.4g} → {n:>12.4g}  ({ratio:.2f}x)")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == 'compare':
+        parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+        parser.add_argument('base')
+        parser.add_argument('new')
+        parser.add_argument('--min-change', type=float, default=0.05,
+                            help="only list metrics whose ratio moved by more than this (default 0.05)")
+        args = parser.parse_args(argv[1:])
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        print_comparison(compare_reports(base, new), args.min_change)
+        return
+
+    parser = argparse.ArgumentParser(description="Benchmark the detection pipeline on scaled-up datasets")
+    parser.add_argument('--scales', default=','.join(map(str, DEFAULT_SCALES)),
+                        help="comma-separated dataset scale factors (default: 1,10,100)")
+    parser.add_argument('--scale-mode', choices=SCALE_MODES, default='variant',
+                        help="'variant': every scaled case is distinct; 'copy': verbatim repeats")
+    parser.add_argument('--repeats', type=int, default=3, help="timed runs per scale (medians are reported)")
+    parser.add_argument('--cascade', action='store_true')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--backend', choices=BACKENDS, default='torch')
+    parser.add_argument('--onnx-dir', default=DEFAULT_ONNX_DIR)
+    parser.add_argument('--nli-model', default=DEFAULT_NLI_PRESET,
+                        help=f"NLI preset ({', '.join(NLI_PRESETS)}), hub id or local model path")
+    parser.add_argument('--nli-labels')
+    parser.add_argument('--nli-granularity', choices=HallucinationDetector.NLI_GRANULARITIES, default='output')
+    parser.add_argument('--nli-aggregate', choices=HallucinationDetector.NLI_AGGREGATES, default='max_contradiction')
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args(argv)
+
+    detector_kwargs = {'backend': args.backend, 'onnx_dir': args.onnx_dir, **nli_kwargs(args)}
+    report = run_benchmark([int(s) for s in args.scales.split(',')], args.scale_mode, args.repeats, args.cascade,
+                           args.workers, detector_kwargs)
+    print_report(report)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\n✓ Benchmark results saved to {args.output} (diff with: python3 benchmark.py compare OLD NEW)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""
+Ensemble Weight and Threshold Calibration
+Grid-searches ensemble weights and detector/decision thresholds over a saved
+detector-score matrix (see score_matrix.py) and reports the Pareto front of
+precision against recall, so the detector can be re-tuned for a recall target
+without running any model
+
+Every case falls into one of 2^5 vote patterns (which detectors flag it), and
+a weight vector gives the same hallucination weight to every case with the same
+pattern. So the search only counts positives/negatives per pattern for each
+detector-threshold combination, and scores all weight x decision-threshold
+combinations with one matrix product per chunk - the cost does not grow with
+the number of cases.
+
+Usage:
+    python calibrate.py detection_scores.npz --weight-step 0.05 --min-recall 0.9
+"""
+
+import json
+import time
+import argparse
+import itertools
+
+import numpy as np
+
+from score_matrix import METHODS, ScoreMatrix
+
+# Default search grids
+DEFAULT_WEIGHT_STEP = 0.1
+DEFAULT_DECISION_THRESHOLDS = np.round(np.arange(0.05, 0.951, 0.05), 4)
+DEFAULT_ENTAILMENT_THRESHOLDS = np.round(np.arange(0.3, 0.71, 0.1), 4)
+DEFAULT_SIMILARITY_THRESHOLDS = np.round(np.arange(0.3, 0.71, 0.1), 4)
+DEFAULT_DOMAIN_THRESHOLDS = np.round(np.arange(0.1, 0.51, 0.1), 4)
+
+# Upper bound on (threshold combos x weight combos x decision thresholds) scored per chunk
+CHUNK_CELLS = 4_000_000
+
+# VOTE_PATTERNS[p, k] == 1 if detector k votes "hallucination" in pattern p
+VOTE_PATTERNS = ((np.arange(2 ** len(METHODS))[:, None] >> np.arange(len(METHODS))) & 1).astype(np.float64)
+
+
+def weight_simplex(step, n_weights=len(METHODS)):
+    """All non-negative weight vectors on a step-sized grid that sum to 1
+
+    Only the ratio between weights and decision threshold matters, so
+    normalized weights cover every distinct ensemble.
+    """
+    k = int(round(1 / step))
+    if not np.isclose(k * step, 1):
+        raise ValueError(f"Weight step must divide 1 evenly, got {step}")
+    # Stars and bars: choose n_weights-1 divider positions among k + n_weights-1 slots
+    dividers = np.array(list(itertools.combinations(range(k + n_weights - 1), n_weights - 1)))
+    edges = np.hstack([
+        np.full((len(dividers), 1), -1),
+        dividers,
+        np.full((len(dividers), 1), k + n_weights - 1)
+    ])
+    return (np.diff(edges, axis=1) - 1) / k
+
+
+def pattern_counts(matrix, entailment, similarity, domain):
+    """Positive/negative case counts per vote pattern for every detector-threshold combination
+
+    Returns (grid, positives, negatives): grid is a (T, 3) array of
+    (entailment, similarity, domain) cutoffs; positives and negatives are
+    (T, 2^5) counts over labeled cases. NaN scores never vote, as in
+    ScoreMatrix.votes().
+    """
+    labeled = matrix.labels >= 0
+    s = matrix.scores[labeled]
+    y = matrix.labels[labeled] == 1
+
+    with np.errstate(invalid='ignore'):
+        ent = (s[:, 0, None] <= entailment[None, :]).astype(np.int64)
+        sim = (s[:, 1, None] < similarity[None, :]).astype(np.int64)
+        dom = (s[:, 2, None] < domain[None, :]).astype(np.int64)
+        fixed = (s[:, 3] > 0).astype(np.int64) * 8 + (s[:, 4] > 0).astype(np.int64) * 16
+
+    # (n, E, S, D) vote-pattern code of every case under every cutoff combination
+    codes = (
+        ent[:, :, None, None]
+        + 2 * sim[:, None, :, None]
+        + 4 * dom[:, None, None, :]
+        + fixed[:, None, None, None]
+    ).reshape(len(s), -1)
+
+    n_grid = codes.shape[1]
+    n_patterns = len(VOTE_PATTERNS)
+    flat = codes + np.arange(n_grid)[None, :] * n_patterns
+    positives = np.bincount(flat[y].ravel(), minlength=n_grid * n_patterns).reshape(n_grid, n_patterns)
+    negatives = np.bincount(flat[~y].ravel(), minlength=n_grid * n_patterns).reshape(n_grid, n_patterns)
+
+    grid = np.stack(np.meshgrid(entailment, similarity, domain, indexing='ij'), axis=-1).reshape(-1, 3)
+    return grid, positives.astype(np.float64), negatives.astype(np.float64)
+
+
+def pattern_weights(weights):
+    """(2^5, W) hallucination weight of each vote pattern under each weight vector
+
+    Accumulated column by column in METHODS order, like the detector's own
+    weighted vote, so ties at the decision threshold resolve identically.
+    """
+    hallucination_weight = np.zeros((len(VOTE_PATTERNS), len(weights)))
+    for k in range(len(METHODS)):
+        hallucination_weight += VOTE_PATTERNS[:, k, None] * weights[None, :, k]
+    return hallucination_weight
+
+
+def pareto_front(precision, recall, accuracy, rank=None):
+    """Indices of the configurations not dominated in (precision, recall)
+
+    Among configurations with identical precision and recall, the one with
+    the highest accuracy (then the lowest rank, default: index) represents
+    the point. The front is returned in order of decreasing recall.
+    """
+    rank = np.arange(len(precision)) if rank is None else rank
+    order = np.lexsort((rank, -accuracy, -precision, -recall))
+    best_so_far = np.maximum.accumulate(precision[order])
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = precision[order][1:] > best_so_far[:-1]
+    return order[keep]
+
+
+def grid_search(matrix, weights, decision, entailment, similarity, domain, chunk_cells=CHUNK_CELLS):
+    """Score every (detector thresholds, weights, decision threshold) combination
+
+    Returns (front, evaluated): the Pareto-optimal configurations as a dict of
+    arrays and the number of combinations evaluated.
+    """
+    grid, positives, negatives = pattern_counts(matrix, entailment, similarity, domain)
+    total_pos = positives.sum(axis=1, keepdims=True)
+    total = total_pos + negatives.sum(axis=1, keepdims=True)
+
+    weights_per_chunk = max(1, chunk_cells // (len(grid) * len(decision)))
+    candidates = []
+    for start in range(0, len(weights), weights_per_chunk):
+        chunk = weights[start:start + weights_per_chunk]
+        # (patterns, W * D) 0/1: does the pattern reach the decision threshold?
+        flagged = (pattern_weights(chunk)[:, :, None] >= decision[None, None, :]).reshape(len(VOTE_PATTERNS), -1)
+        flagged = flagged.astype(np.float64)
+
+        tp = positives @ flagged
+        fp = negatives @ flagged
+        fn = total_pos - tp
+        tn = total - tp - fp - fn
+        with np.errstate(invalid='ignore', divide='ignore'):
+            precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0).ravel()
+            recall = np.where(tp + fn > 0, tp / (tp + fn), 0.0).ravel()
+            accuracy = np.where(total > 0, (tp + tn) / total, 0.0).ravel()
+
+        idx = pareto_front(precision, recall, accuracy)
+        t_idx, rest = np.divmod(idx, len(chunk) * len(decision))
+        w_idx, d_idx = np.divmod(rest, len(decision))
+        candidates.append({
+            'precision': precision[idx],
+            'recall': recall[idx],
+            'accuracy': accuracy[idx],
+            'confusion': np.stack([tn.ravel()[idx], fp.ravel()[idx], fn.ravel()[idx], tp.ravel()[idx]], axis=1),
+            # Chunk-independent rank, so ties resolve the same for any chunk size
+            'order': ((w_idx + start) * len(grid) + t_idx) * len(decision) + d_idx,
+            't': t_idx,
+            'w': w_idx + start,
+            'd': d_idx
+        })
+
+    merged = {key: np.concatenate([c[key] for c in candidates]) for key in candidates[0]}
+    keep = pareto_front(merged['precision'], merged['recall'], merged['accuracy'], merged['order'])
+    front = {key: values[keep] for key, values in merged.items()}
+    front['weights'] = weights[front['w']]
+    front['decision'] = decision[front['d']]
+    front['detector_thresholds'] = grid[front['t']]
+    front['f1_score'] = np.where(
+        front['precision'] + front['recall'] > 0,
+        2 * front['precision'] * front['recall'] / np.maximum(front['precision'] + front['recall'], 1e-12),
+        0.0
+    )
+    evaluated = len(grid) * len(weights) * len(decision)
+    return front, evaluated
+
+
+def front_records(front):
+    """Pareto front as JSON-serializable config/metric records"""
+    records = []
+    for i in range(len(front['precision'])):
+        tn, fp, fn, tp = (int(v) for v in front['confusion'][i])
+        ent, sim, dom = (float(v) for v in front['detector_thresholds'][i])
+        records.append({
+            'weights': {name: round(float(w), 6) for name, w in zip(METHODS, front['weights'][i])},
+            'thresholds': {
+                'entailment': ent,
+                'similarity': sim,
+                'domain': dom,
+                'decision': float(front['decision'][i])
+            },
+            'precision': float(front['precision'][i]),
+            'recall': float(front['recall'][i]),
+            'f1_score': float(front['f1_score'][i]),
+            'accuracy': float(front['accuracy'][i]),
+            'confusion_matrix': [[tn, fp], [fn, tp]]
+        })
+    return records
+
+
+def pick_for_recall(records, min_recall):
+    """Highest-precision front configuration with recall >= min_recall (None if unreachable)"""
+    feasible = [r for r in records if r['recall'] >= min_recall - 1e-12]
+    return max(feasible, key=lambda r: (r['precision'], r['accuracy'])) if feasible else None
+
+
+def parse_grid(text, default):
+    """'0.3,0.4,0.5' or 'start:stop:step' (stop inclusive) -> sorted float array"""
+    if not text:
+        return default
+    if ':' in text:
+        start, stop, step = (float(v) for v in text.split(':'))
+        return np.round(np.arange(start, stop + step / 2, step), 6)
+    return np.array(sorted(float(v) for v in text.split(',')))
+
+
+def print_config(record, indent="  "):
+    weights = ', '.join(f"{name}={w:g}" for name, w in record['weights'].items())
+    thresholds = ', '.join(f"{name}={v:g}" for name, v in record['thresholds'].items())
+    print(f"{indent}Weights:    {weights}")
+    print(f"{indent}Thresholds: {thresholds}")
+    print(f"{indent}Precision {record['precision']:.3f} | Recall {record['recall']:.3f} | "
+          f"F1 {record['f1_score']:.3f} | Accuracy {record['accuracy']:.3f} | "
+          f"Confusion {record['confusion_matrix']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Calibrate ensemble weights and thresholds on a saved score matrix")
+    parser.add_argument('scores', nargs='?', default='detection_scores.npz')
+    parser.add_argument('--weight-step', type=float, default=DEFAULT_WEIGHT_STEP,
+                        help="grid step of the normalized weight simplex (0.05 -> 10,626 weight vectors)")
+    parser.add_argument('--decision-thresholds', help="'a,b,c' or 'start:stop:step'")
+    parser.add_argument('--entailment-thresholds', help="'a,b,c' or 'start:stop:step'")
+    parser.add_argument('--similarity-thresholds', help="'a,b,c' or 'start:stop:step'")
+    parser.add_argument('--domain-thresholds', help="'a,b,c' or 'start:stop:step'")
+    parser.add_argument('--min-recall', type=float, action='append', default=[],
+                        help="recall target to report the best configuration for (repeatable)")
+    parser.add_argument('--output', default='calibration_results.json')
+    args = parser.parse_args(argv)
+
+    matrix = ScoreMatrix.load(args.scores)
+    n_labeled = int(np.sum(matrix.labels >= 0))
+    if n_labeled == 0:
+        raise SystemExit(f"No labeled cases in {args.scores}; calibration needs ground truth")
+
+    skipped = int(np.isnan(matrix.scores).any(axis=1).sum())
+    if skipped:
+        print(f"⚠ {skipped} cases have skipped detectors (cascade or zero weight); "
+              f"calibrate on a full run for exact results")
+
+    weights = weight_simplex(args.weight_step)
+    decision = parse_grid(args.decision_thresholds, DEFAULT_DECISION_THRESHOLDS)
+    entailment = parse_grid(args.entailment_thresholds, DEFAULT_ENTAILMENT_THRESHOLDS)
+    similarity = parse_grid(args.similarity_thresholds, DEFAULT_SIMILARITY_THRESHOLDS)
+    domain = parse_grid(args.domain_thresholds, DEFAULT_DOMAIN_THRESHOLDS)
+
+    start = time.perf_counter()
+    front, evaluated = grid_search(matrix, weights, decision, entailment, similarity, domain)
+    elapsed = time.perf_counter() - start
+    records = front_records(front)
+
+    print("=" * 80)
+    print("ENSEMBLE CALIBRATION")
+    print("=" * 80)
+    print(f"Cases: {len(matrix)} ({n_labeled} labeled)")
+    print(f"Grid: {len(weights)} weight vectors x {len(decision)} decision x {len(entailment)} entailment "
+          f"x {len(similarity)} similarity x {len(domain)} domain thresholds")
+    print(f"Evaluated {evaluated:,} configurations in {elapsed:.2f}s "
+          f"({evaluated / max(elapsed, 1e-9):,.0f} configs/s)")
+
+    current_pred, _ = matrix.rescore()
+    current = matrix.metrics(current_pred)
+    print(f"\nCurrent configuration: Precision {current['precision']:.3f} | Recall {current['recall']:.3f} | "
+          f"F1 {current['f1_score']:.3f} | Accuracy {current['accuracy']:.3f}")
+
+    print(f"\nPareto front (precision vs recall), {len(records)} points:")
+    print(f"  {'Recall':>7} {'Precision':>9} {'F1':>6} {'Acc':>6}  Weights (E/S/D/U/R) | Thresholds (E/S/D/decision)")
+    for r in records:
+        w = '/'.join(f"{v:.2f}" for v in r['weights'].values())
+        t = '/'.join(f"{v:g}" for v in r['thresholds'].values())
+        print(f"  {r['recall']:>7.3f} {r['precision']:>9.3f} {r['f1_score']:>6.3f} {r['accuracy']:>6.3f}  {w} | {t}")
+
+    targets = {}
+    for min_recall in args.min_recall:
+        choice = pick_for_recall(records, min_recall)
+        targets[str(min_recall)] = choice
+        print(f"\nBest precision at recall >= {min_recall:g}:")
+        if choice is None:
+            print("  (no configuration in the grid reaches this recall)")
+        else:
+            print_config(choice)
+
+    best_f1 = max(records, key=lambda r: (r['f1_score'], r['accuracy']))
+    print("\nBest F1 on the front:")
+    print_config(best_f1)
+    if n_labeled < 200:
+        print(f"\n⚠ Only {n_labeled} labeled cases - expect these settings to overfit; "
+              f"confirm them on held-out cases")
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'scores': args.scores,
+            'cases': len(matrix),
+            'labeled_cases': n_labeled,
+            'configurations_evaluated': evaluated,
+            'current': {k: current[k] for k in ('precision', 'recall', 'f1_score', 'accuracy')},
+            'pareto_front': records,
+            'recall_targets': targets,
+            'best_f1': best_f1
+        }, f, indent=2)
+    print(f"\n✓ Calibration results saved to '{args.output}'")
+
+
+if __name__ == "__main__":
+    main()
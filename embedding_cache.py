@@ -0,0 +1,210 @@
+"""
+Persistent Embedding Cache for Sentence-Similarity Detection
+Avoids re-encoding evidence/output texts that have already been embedded,
+both within a run (in-memory LRU tier) and across runs (on-disk tier)
+"""
+
+import os
+import json
+import fcntl
+import hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+DEFAULT_EMBEDDING_CACHE_DIR = '.embedding_cache'
+
+
+class EmbeddingCache:
+    """Two-tier (LRU memory + memory-mapped disk) cache of text embeddings
+
+    Disk layout inside ``cache_dir``:
+      meta.json        - model name and embedding dimension (written last)
+      index.txt        - one "content-hash key<TAB>row" per line
+      embeddings.f32   - raw float32 matrix, one row per key
+      lock             - flock'ed by every writer while it appends
+    Both data files are append-only, so adding embeddings never rewrites them.
+    Several processes (e.g. a batch run and the service) can share one cache
+    directory: appends happen under an exclusive lock, with the row taken from
+    the data file's current size and the other writers' index lines read first.
+    """
+
+    def __init__(self, cache_dir, model_name, max_memory_items=10000):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.max_memory_items = max_memory_items
+
+        self.memory = OrderedDict()
+        self.disk_index = {}
+        self.dim = None
+        self._matrix = None
+        self._mapped_rows = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._meta_path = os.path.join(cache_dir, 'meta.json')
+        self._index_path = os.path.join(cache_dir, 'index.txt')
+        self._data_path = os.path.join(cache_dir, 'embeddings.f32')
+        self._lock_path = os.path.join(cache_dir, 'lock')
+        # Bytes and lines of index.txt already read into disk_index
+        self._index_offset = 0
+        self._index_lines = 0
+        self._load_index()
+
+    def _read_meta(self):
+        """Dimension from meta.json (None while the cache is still empty), checking the model"""
+        if not os.path.exists(self._meta_path):
+            return None
+        with open(self._meta_path) as f:
+            meta = json.load(f)
+        if meta['model'] != self.model_name:
+            raise ValueError(f"Cache at {self.cache_dir} belongs to model {meta['model']}, not {self.model_name}")
+        return meta['dim']
+
+    def _load_index(self):
+        self.dim = self._read_meta()
+        if self.dim is not None:
+            self._read_index_tail()
+
+    def _data_rows(self):
+        """Rows fully written to the data file"""
+        return os.path.getsize(self._data_path) // (4 * self.dim) if os.path.exists(self._data_path) else 0
+
+    def _read_index_tail(self):
+        """Add the index lines appended since the last read (by any process)"""
+        if not os.path.exists(self._index_path):
+            return
+        with open(self._index_path, 'rb') as f:
+            f.seek(self._index_offset)
+            tail = f.read()
+        # A line without its newline is still being written (or was cut off by a crash)
+        complete = tail[:tail.rfind(b'\n') + 1]
+        self._index_offset += len(complete)
+
+        # Only trust rows that were fully written to the data file
+        n_rows = self._data_rows()
+        for line in complete.decode('utf-8').splitlines():
+            key, tab, row = line.partition('\t')
+            # Caches written before rows were stored in the index use the line number
+            row = int(row) if row.isdigit() else None if tab else self._index_lines
+            self._index_lines += 1
+            if row is not None and row < n_rows:
+                self.disk_index[key] = row
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive lock on the cache directory, shared by all processes using it"""
+        with open(self._lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def key(self, text):
+        """Content hash of model name plus text"""
+        return hashlib.sha1(f"{self.model_name}\0{text}".encode('utf-8')).hexdigest()
+
+    def _remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def _disk_row(self, row):
+        if self._matrix is None or row >= self._mapped_rows:
+            self._mapped_rows = os.path.getsize(self._data_path) // (4 * self.dim)
+            self._matrix = np.memmap(self._data_path, dtype=np.float32, mode='r', shape=(self._mapped_rows, self.dim))
+        return np.array(self._matrix[row])
+
+    def get(self, text):
+        """Return the cached embedding for text, or None"""
+        key = self.key(text)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.memory_hits += 1
+            return self.memory[key]
+        if key in self.disk_index:
+            vector = self._disk_row(self.disk_index[key])
+            self._remember(key, vector)
+            self.disk_hits += 1
+            return vector
+        self.misses += 1
+        return None
+
+    def put_many(self, texts, vectors):
+        """Store embeddings for texts in both tiers"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        keys = [self.key(text) for text in texts]
+        for key, vector in zip(keys, vectors):
+            self._remember(key, vector)
+
+        with self._locked():
+            dim = self._read_meta()
+            if dim is None:
+                # No meta yet: any data or index file is left over from a crashed first write
+                for path in (self._data_path, self._index_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self._index_offset = 0
+                self._index_lines = 0
+                self.disk_index = {}
+                dim = vectors.shape[1]
+            elif dim != vectors.shape[1]:
+                raise ValueError(f"Cache at {self.cache_dir} holds {dim}-d embeddings, got {vectors.shape[1]}-d")
+            self.dim = dim
+            # Other processes may have appended since our last look
+            self._read_index_tail()
+
+            new = {}
+            for key, vector in zip(keys, vectors):
+                if key not in self.disk_index:
+                    new.setdefault(key, vector)
+
+            if new:
+                # The row is the data file's size, not our own count; a partial row from a crash is dropped
+                first_row = self._data_rows()
+                with open(self._data_path, 'ab') as f:
+                    f.truncate(first_row * 4 * self.dim)
+                    f.write(np.stack(list(new.values())).tobytes())
+                # Data before index: a crash between the two leaves unindexed rows, never dangling keys
+                lines = ''.join(f"{key}\t{first_row + i}\n" for i, key in enumerate(new))
+                with open(self._index_path, 'ab') as f:
+                    # Drop a line a crashed writer left unfinished (it could hold a cut-off row number)
+                    f.truncate(self._index_offset)
+                    f.write(lines.encode('utf-8'))
+                self._read_index_tail()
+
+            # Meta last: without it, the files above are treated as empty
+            if not os.path.exists(self._meta_path):
+                with open(self._meta_path, 'w') as f:
+                    json.dump({'model': self.model_name, 'dim': self.dim}, f)
+
+    def encode(self, model, texts, batch_size=32):
+        """Embed texts, encoding only cache misses (each distinct text once) with model"""
+        vectors = [self.get(text) for text in texts]
+        missing = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+
+        if missing:
+            encoded = model.encode(missing, batch_size=batch_size, convert_to_numpy=True)
+            self.put_many(missing, encoded)
+            lookup = dict(zip(missing, np.asarray(encoded, dtype=np.float32)))
+            vectors = [lookup[t] if v is None else v for t, v in zip(texts, vectors)]
+
+        return np.stack(vectors) if vectors else np.empty((0, self.dim or 0), dtype=np.float32)
+
+    def stats(self):
+        """Hit/miss counters for both tiers"""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            'memory_items': len(self.memory),
+            'disk_items': len(self.disk_index)
+        }
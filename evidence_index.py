@@ -0,0 +1,345 @@
+"""
+Persistent Evidence Retrieval Index for RAG Correction
+Embeds the evidence corpus once into an append-only vector index on disk and
+answers top-k evidence lookups for a query: exact (chunked NumPy dot products)
+for small corpora, or an inverted-file (IVF) approximate search over k-means
+clusters for large ones. New evidence is embedded and appended without
+rebuilding the index
+
+Usage:
+    python evidence_index.py build --corpus evidence.jsonl
+    python evidence_index.py query "Do antibiotics treat viral infections?" -k 3
+"""
+
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+
+DEFAULT_INDEX_DIR = '.evidence_index'
+# Corpora at least this large get an IVF index when built from the command line
+APPROX_MIN_ROWS = 20000
+# Rows scored per matrix product in exact search, bounding temporary memory
+CHUNK_ROWS = 65536
+
+
+def top_k(scores, k):
+    """Indices of the k highest scores along the last axis, best first"""
+    k = min(k, scores.shape[-1])
+    if k == 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.int64)
+    part = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(scores, part, axis=-1), axis=-1, kind='stable')
+    return np.take_along_axis(part, order, axis=-1)
+
+
+class EvidenceIndex:
+    """Append-only store of normalized evidence embeddings with exact and IVF search
+
+    Disk layout inside ``index_dir``:
+      meta.json      - model name, embedding dimension and IVF list count
+      texts.jsonl    - one evidence text per line; line number = row
+      vectors.f32    - raw float32 matrix of L2-normalized embeddings, one row per text
+      centroids.f32  - IVF cluster centroids (after train_ivf)
+      lists.i32      - IVF cluster of every row (after train_ivf)
+    Data files are appended to by add(); only train_ivf rewrites the IVF files.
+    The directory is only created once something is written to it.
+    load_encoder is called once, on first use, and must return a model with
+    SentenceTransformer.encode().
+    """
+
+    def __init__(self, index_dir, model_name, load_encoder):
+        self.index_dir = index_dir
+        self.model_name = model_name
+        self._load_encoder = load_encoder
+        self._encoder = None
+
+        self.texts = []
+        self.rows = {}
+        self.dim = None
+        self.nlist = 0
+        self._matrix = None
+        self._centroids = None
+        self._assignments = None
+        self._lists = None
+
+        self._meta_path = os.path.join(index_dir, 'meta.json')
+        self._texts_path = os.path.join(index_dir, 'texts.jsonl')
+        self._vectors_path = os.path.join(index_dir, 'vectors.f32')
+        self._centroids_path = os.path.join(index_dir, 'centroids.f32')
+        self._lists_path = os.path.join(index_dir, 'lists.i32')
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self._meta_path):
+            return
+        with open(self._meta_path) as f:
+            meta = json.load(f)
+        if meta['model'] != self.model_name:
+            raise ValueError(f"Index at {self.index_dir} belongs to model {meta['model']}, not {self.model_name}")
+        self.dim = meta['dim']
+        self.nlist = meta.get('nlist', 0)
+
+        # Vectors are written before texts: only rows with a text are trusted, and extra rows are dropped
+        # so that later appends stay aligned
+        n_vectors = os.path.getsize(self._vectors_path) // (4 * self.dim) if os.path.exists(self._vectors_path) else 0
+        if os.path.exists(self._texts_path):
+            with open(self._texts_path, encoding='utf-8') as f:
+                for line in f:
+                    if len(self.texts) >= n_vectors:
+                        break
+                    self._remember(json.loads(line))
+        if n_vectors > len(self.texts):
+            os.truncate(self._vectors_path, len(self.texts) * 4 * self.dim)
+
+        if self.nlist:
+            self._centroids = np.fromfile(self._centroids_path, dtype=np.float32).reshape(self.nlist, self.dim)
+            assignments = np.fromfile(self._lists_path, dtype=np.int32)
+            self._assignments = assignments[:len(self.texts)]
+            if len(assignments) != len(self._assignments):
+                os.truncate(self._lists_path, len(self.texts) * 4)
+
+    def _remember(self, text):
+        self.rows[text] = len(self.texts)
+        self.texts.append(text)
+
+    def __len__(self):
+        return len(self.texts)
+
+    @property
+    def encoder(self):
+        if self._encoder is None:
+            self._encoder = self._load_encoder()
+        return self._encoder
+
+    def embed(self, texts, batch_size=64):
+        """L2-normalized float32 embeddings of texts"""
+        vectors = np.asarray(self.encoder.encode(texts, batch_size=batch_size, convert_to_numpy=True),
+                             dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def _vectors(self):
+        """Memory-mapped matrix of all indexed rows"""
+        if self._matrix is None or len(self._matrix) != len(self.texts):
+            self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode='r', shape=(len(self.texts), self.dim))
+        return self._matrix
+
+    def add(self, texts, batch_size=64):
+        """Embed and append the texts not indexed yet (each distinct text once); returns how many were added"""
+        new = [text for text in dict.fromkeys(texts) if text not in self.rows]
+        if not new:
+            return 0
+        vectors = self.embed(new, batch_size=batch_size)
+        os.makedirs(self.index_dir, exist_ok=True)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            self._write_meta()
+
+        # Data before texts: a crash between the two leaves extra vectors, which _load drops
+        with open(self._vectors_path, 'ab') as f:
+            f.write(vectors.tobytes())
+        if self.nlist:
+            assignments = top_k(vectors @ self._centroids.T, 1)[:, 0].astype(np.int32)
+            with open(self._lists_path, 'ab') as f:
+                f.write(assignments.tobytes())
+            self._assignments = np.concatenate([self._assignments, assignments])
+            self._lists = None
+        with open(self._texts_path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(text, ensure_ascii=False) + '\n' for text in new))
+        for text in new:
+            self._remember(text)
+        return len(new)
+
+    def _write_meta(self):
+        with open(self._meta_path, 'w') as f:
+            json.dump({'model': self.model_name, 'dim': self.dim, 'nlist': self.nlist}, f)
+
+    # ------------------------------------------------------------------------
+    # Approximate (IVF) index
+    # ------------------------------------------------------------------------
+
+    def train_ivf(self, nlist=None, iterations=10, sample_size=None, seed=0):
+        """Cluster the corpus with spherical k-means and record every row's cluster
+
+        nlist defaults to about sqrt(rows). Centroids are fit on a sample of
+        sample_size rows (default 64 per list). Rows added later are assigned to
+        their nearest centroid; retrain once the corpus has grown several-fold.
+        """
+        n = len(self.texts)
+        if n == 0:
+            raise ValueError("Cannot train an IVF index on an empty corpus")
+        nlist = min(nlist or max(1, int(np.sqrt(n))), n)
+        rng = np.random.default_rng(seed)
+        matrix = self._vectors()
+        sample_size = min(n, sample_size or nlist * 64)
+        sample = np.asarray(matrix[np.sort(rng.choice(n, sample_size, replace=False))])
+
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = top_k(sample @ centroids.T, 1)[:, 0]
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # A cluster that lost all its points keeps its previous centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids).astype(np.float32)
+
+        assignments = np.concatenate([
+            top_k(np.asarray(matrix[start:start + CHUNK_ROWS]) @ centroids.T, 1)[:, 0]
+            for start in range(0, n, CHUNK_ROWS)
+        ]).astype(np.int32)
+        centroids.tofile(self._centroids_path)
+        assignments.tofile(self._lists_path)
+        self.nlist = nlist
+        self._centroids = centroids
+        self._assignments = assignments
+        self._lists = None
+        self._write_meta()
+
+    def _inverted_lists(self):
+        """(rows sorted by cluster, start offset of each cluster) for the current assignments"""
+        if self._lists is None:
+            order = np.argsort(self._assignments, kind='stable')
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(self._assignments, minlength=self.nlist))])
+            self._lists = (order, offsets)
+        return self._lists
+
+    # ------------------------------------------------------------------------
+    # Search
+    # ------------------------------------------------------------------------
+
+    def search_batch(self, queries, k=3, exact=None, nprobe=8):
+        """Top-k evidence for each query as lists of (text, cosine similarity), best first
+
+        exact=None uses the IVF index when one is trained, probing the nprobe
+        nearest clusters; exact=True always scans the whole corpus.
+        """
+        if not queries or not self.texts:
+            return [[] for _ in queries]
+        q = self.embed(queries)
+        if exact or (exact is None and not self.nlist):
+            rows, scores = self._exact_search(q, k)
+        else:
+            rows, scores = self._ivf_search(q, k, nprobe)
+        return [
+            [(self.texts[row], float(score)) for row, score in zip(row_list, score_list)]
+            for row_list, score_list in zip(rows, scores)
+        ]
+
+    def search(self, query, k=3, exact=None, nprobe=8):
+        """Top-k (text, cosine similarity) evidence for one query"""
+        return self.search_batch([query], k, exact, nprobe)[0]
+
+    def _exact_search(self, q, k):
+        """Brute-force top-k over all rows, one chunk of rows at a time"""
+        matrix = self._vectors()
+        best_rows = np.empty((len(q), 0), dtype=np.int64)
+        best_scores = np.empty((len(q), 0), dtype=np.float32)
+        for start in range(0, len(matrix), CHUNK_ROWS):
+            scores = q @ np.asarray(matrix[start:start + CHUNK_ROWS]).T
+            idx = top_k(scores, k)
+            rows = np.concatenate([best_rows, idx + start], axis=1)
+            merged = np.concatenate([best_scores, np.take_along_axis(scores, idx, axis=1)], axis=1)
+            keep = top_k(merged, k)
+            best_rows = np.take_along_axis(rows, keep, axis=1)
+            best_scores = np.take_along_axis(merged, keep, axis=1)
+        return best_rows, best_scores
+
+    def _ivf_search(self, q, k, nprobe):
+        """Top-k among the rows of each query's nprobe nearest clusters"""
+        matrix = self._vectors()
+        order, offsets = self._inverted_lists()
+        probes = top_k(q @ self._centroids.T, min(nprobe, self.nlist))
+        all_rows, all_scores = [], []
+        for vector, clusters in zip(q, probes):
+            candidates = np.sort(np.concatenate([order[offsets[c]:offsets[c + 1]] for c in clusters]))
+            scores = np.asarray(matrix[candidates]) @ vector
+            idx = top_k(scores, k)
+            all_rows.append(candidates[idx])
+            all_scores.append(scores[idx])
+        return all_rows, all_scores
+
+    def stats(self):
+        return {
+            'path': self.index_dir,
+            'rows': len(self.texts),
+            'dim': self.dim,
+            'ivf_lists': self.nlist
+        }
+
+
+def open_evidence_index(index_dir=DEFAULT_INDEX_DIR, backend='torch', onnx_dir=None, load_encoder=None):
+    """Evidence index keyed by the similarity model (per backend, like the embedding cache)
+
+    load_encoder defaults to the similarity model from the shared model
+    registry, the same instance a detector on this backend uses.
+    """
+    from main import SIMILARITY_MODEL_NAME, load_similarity_model
+    from model_registry import MODEL_REGISTRY
+    from onnx_backend import DEFAULT_ONNX_DIR
+
+    if load_encoder is None:
+        def load_encoder():
+            # Same registry key as a detector's similarity model, so both share one copy
+            return MODEL_REGISTRY.get('similarity', SIMILARITY_MODEL_NAME, load_similarity_model, backend=backend,
+                                      onnx_dir=onnx_dir or DEFAULT_ONNX_DIR, threads=None)
+    model_key = SIMILARITY_MODEL_NAME if backend == 'torch' else f"{SIMILARITY_MODEL_NAME}@{backend}"
+    return EvidenceIndex(index_dir, model_key, load_encoder)
+
+
+def main(argv=None):
+    from onnx_backend import BACKENDS
+
+    parser = argparse.ArgumentParser(description="Build and query the evidence retrieval index")
+    parser.add_argument('--index-dir', default=DEFAULT_INDEX_DIR)
+    parser.add_argument('--backend', choices=BACKENDS, default='torch')
+    parser.add_argument('--onnx-dir')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help="add evidence to the index (only new texts are embedded)")
+    build.add_argument('--corpus', metavar='CASES.jsonl',
+                       help="JSONL file whose lines have an 'evidence' field or are plain strings "
+                            "(default: the built-in dataset)")
+    build.add_argument('--ivf', type=int, nargs='?', const=0, metavar='NLIST',
+                       help=f"(re)train the approximate index (default: automatic from {APPROX_MIN_ROWS} rows)")
+
+    query = commands.add_parser('query', help="look up the top-k evidence for queries")
+    query.add_argument('queries', nargs='+')
+    query.add_argument('-k', type=int, default=3)
+    query.add_argument('--exact', action='store_true', help="scan the whole corpus even if an IVF index exists")
+    query.add_argument('--nprobe', type=int, default=8)
+    args = parser.parse_args(argv)
+
+    index = open_evidence_index(args.index_dir, args.backend, args.onnx_dir)
+    if args.command == 'build':
+        if args.corpus:
+            from medical_dataset import iter_jsonl_dataset
+            texts = [row['evidence'] if isinstance(row, dict) else row for row in iter_jsonl_dataset(args.corpus)]
+        else:
+            from medical_dataset import get_dataset
+            texts = [item['evidence'] for item in get_dataset()]
+        start = time.perf_counter()
+        added = index.add(texts)
+        print(f"✓ {added} new evidence texts embedded in {time.perf_counter() - start:.1f} s "
+              f"({len(index)} indexed in {args.index_dir})")
+        if args.ivf is not None or (len(index) >= APPROX_MIN_ROWS and not index.nlist):
+            start = time.perf_counter()
+            index.train_ivf(args.ivf or None)
+            print(f"✓ IVF index with {index.nlist} lists trained in {time.perf_counter() - start:.1f} s")
+        return
+
+    index.embed(args.queries[:1])  # load the encoder before timing
+    start = time.perf_counter()
+    results = index.search_batch(args.queries, args.k, exact=True if args.exact else None, nprobe=args.nprobe)
+    elapsed = (time.perf_counter() - start) * 1000
+    for text, hits in zip(args.queries, results):
+        print(f"\n{text}")
+        for evidence, score in hits:
+            print(f"  {score:.3f}  {evidence[:100]}")
+    print(f"\n{len(args.queries)} queries in {elapsed:.1f} ms "
+          f"({'IVF' if index.nlist and not args.exact else 'exact'} search over {len(index)} rows)")
+
+
+if __name__ == "__main__":
+    main()
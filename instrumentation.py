@@ -0,0 +1,169 @@
+"""
+Per-Stage Latency and Throughput Instrumentation
+Records wall time, CPU time, batch size and resident memory of every detector
+stage, model load and correction call, and exports a JSON summary with
+p50/p95/p99 latencies per stage plus an optional Chrome trace (open it in
+chrome://tracing or ui.perfetto.dev)
+
+Usage:
+    python main.py --profile profile.json --trace trace.json
+"""
+
+import os
+import json
+import time
+import resource
+import threading
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+PERCENTILES = (50, 95, 99)
+
+
+def memory_mb():
+    """(current, peak) resident memory of this process in MB"""
+    rss = peak = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) / 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return (peak if rss is None else rss), peak
+
+
+class StageProfiler:
+    """Collects one span per timed call
+
+    Each span records the stage name, start (perf_counter seconds), wall and
+    CPU seconds, batch size, resident memory before and after the call and the
+    process's peak resident memory when it ended. Spans may nest (a model load
+    inside the first call of its stage); child_wall is the time spent in nested
+    spans. A disabled profiler hands out no-op contexts, so instrumented code
+    pays nothing when profiling is off. With max_spans, only the most recent
+    spans are kept (for long-running services).
+    """
+
+    def __init__(self, enabled=True, max_spans=None):
+        self.enabled = enabled
+        self.max_spans = max_spans
+        self.spans = deque(maxlen=max_spans)
+        self._local = threading.local()
+
+    def span(self, name, batch_size=1):
+        """Context manager timing one call of stage name over batch_size cases"""
+        if not self.enabled:
+            return nullcontext()
+        return self._record(name, batch_size)
+
+    @contextmanager
+    def _record(self, name, batch_size):
+        stack = self._local.__dict__.setdefault('stack', [])
+        frame = {'child_wall': 0.0}
+        stack.append(frame)
+        rss_before, _ = memory_mb()
+        cpu = time.process_time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.process_time() - cpu
+            rss, peak = memory_mb()
+            stack.pop()
+            if stack:
+                stack[-1]['child_wall'] += wall
+            self.spans.append({
+                'name': name,
+                'start': start,
+                'wall': wall,
+                'cpu': cpu,
+                'child_wall': frame['child_wall'],
+                'batch_size': batch_size,
+                'rss_before_mb': rss_before,
+                'rss_mb': rss,
+                'peak_rss_mb': peak,
+                'pid': os.getpid(),
+                'tid': threading.get_ident()
+            })
+
+    def extend(self, spans):
+        """Merge spans recorded elsewhere (e.g. by worker processes)"""
+        self.spans.extend(spans)
+
+    def drain(self):
+        """Spans recorded so far, removing them from the profiler"""
+        spans, self.spans = list(self.spans), deque(maxlen=self.max_spans)
+        return spans
+
+    def summary(self):
+        """Per-stage call counts, totals, throughput, latency percentiles and memory
+
+        Latencies are per call (one call covers batch_size cases); self_wall_sec
+        excludes time spent in nested spans such as lazy model loads.
+        """
+        # Snapshot first: spans may be appended from another thread meanwhile
+        all_spans = list(self.spans)
+        by_stage = {}
+        for span in all_spans:
+            by_stage.setdefault(span['name'], []).append(span)
+
+        stages = {}
+        for name, spans in by_stage.items():
+            wall = np.array([s['wall'] for s in spans])
+            batch = np.array([s['batch_size'] for s in spans], dtype=np.float64)
+            per_item = wall / np.maximum(batch, 1)
+            total_wall = float(wall.sum())
+            stages[name] = {
+                'calls': len(spans),
+                'items': int(batch.sum()),
+                'wall_sec': total_wall,
+                'self_wall_sec': total_wall - sum(s['child_wall'] for s in spans),
+                'cpu_sec': sum(s['cpu'] for s in spans),
+                'items_per_sec': float(batch.sum() / total_wall) if total_wall > 0 else None,
+                'batch_size': {'mean': float(batch.mean()), 'max': int(batch.max())},
+                'latency_ms': {f'p{q}': float(np.percentile(wall, q) * 1000) for q in PERCENTILES},
+                'latency_ms_per_item': {f'p{q}': float(np.percentile(per_item, q) * 1000) for q in PERCENTILES},
+                'peak_rss_mb': max(s['peak_rss_mb'] for s in spans),
+                'max_rss_growth_mb': max(s['rss_mb'] - s['rss_before_mb'] for s in spans)
+            }
+        return {
+            'spans': len(all_spans),
+            'processes': len({s['pid'] for s in all_spans}),
+            'stages': stages
+        }
+
+    def chrome_trace(self):
+        """Spans as Chrome trace-event JSON (complete 'X' events, microseconds)"""
+        origin = min((s['start'] for s in self.spans), default=0.0)
+        events = [{
+            'name': s['name'],
+            'cat': s['name'].split(':')[0],
+            'ph': 'X',
+            'ts': (s['start'] - origin) * 1e6,
+            'dur': s['wall'] * 1e6,
+            'pid': s['pid'],
+            'tid': s['tid'],
+            'args': {
+                'batch_size': s['batch_size'],
+                'cpu_ms': s['cpu'] * 1000,
+                'rss_mb': round(s['rss_mb'], 1),
+                'peak_rss_mb': round(s['peak_rss_mb'], 1)
+            }
+        } for s in self.spans]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save_summary(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def save_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
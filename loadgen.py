@@ -0,0 +1,123 @@
+"""
+Load Generator for the Detection Service
+Replays medical_dataset cases against POST /detect from many concurrent
+keep-alive connections and reports throughput, errors and p50/p95/p99
+latency (standard library only)
+
+Usage:
+    python loadgen.py --url http://127.0.0.1:8080 --concurrency 64 --requests 2000
+    python loadgen.py --concurrency 1,8,64 --requests 1000 --output load.json
+"""
+
+import json
+import time
+import asyncio
+import argparse
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from instrumentation import PERCENTILES
+
+
+async def _post(reader, writer, host, path, payload):
+    """(status, parsed JSON body) of one keep-alive POST"""
+    body = json.dumps(payload).encode('utf-8')
+    writer.write((f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                  f"Content-Length: {len(body)}\r\n\r\n").encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def run_load(url, cases, concurrency, total):
+    """Latencies (s) of successful requests, status counts and wall time for total requests"""
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    next_case = iter(range(total))
+    latencies = []
+    statuses = {}
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for i in next_case:
+                item = cases[i % len(cases)]
+                payload = {'query': item['query'], 'evidence': item['evidence'], 'llm_output': item['llm_output']}
+                start = time.perf_counter()
+                status, _ = await _post(reader, writer, host, '/detect', payload)
+                elapsed = time.perf_counter() - start
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 200:
+                    latencies.append(elapsed)
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, statuses, time.perf_counter() - start
+
+
+def summarize(latencies, statuses, wall, concurrency):
+    latencies = np.array(latencies)
+    return {
+        'concurrency': concurrency,
+        'requests': sum(statuses.values()),
+        'statuses': {str(k): v for k, v in sorted(statuses.items())},
+        'wall_sec': wall,
+        'requests_per_sec': len(latencies) / wall if wall else None,
+        'latency_ms': {f'p{q}': float(np.percentile(latencies, q) * 1000) for q in PERCENTILES}
+        if len(latencies) else None
+    }
+
+
+async def fetch_metrics(url):
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    try:
+        writer.write(f"GET /metrics HTTP/1.1\r\nHost: {parts.hostname}\r\nConnection: close\r\n\r\n".encode('latin-1'))
+        await writer.drain()
+        head, _, body = (await reader.read()).partition(b'\r\n\r\n')
+        return json.loads(body)
+    finally:
+        writer.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the detection service")
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--concurrency', default='32',
+                        help="concurrent connections; a comma-separated list runs one load level after another")
+    parser.add_argument('--requests', type=int, default=1000, help="requests per load level")
+    parser.add_argument('--output', help="also write the results as JSON")
+    args = parser.parse_args(argv)
+
+    from medical_dataset import get_dataset
+    cases = get_dataset()
+    report = []
+    print(f"{'Conc':>5} {'Req':>6} {'Req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  {'Statuses'}")
+    for concurrency in (int(c) for c in args.concurrency.split(',')):
+        result = summarize(*asyncio.run(run_load(args.url, cases, concurrency, args.requests)), concurrency)
+        report.append(result)
+        latency = result['latency_ms'] or dict.fromkeys(('p50', 'p95', 'p99'), float('nan'))
+        print(f"{concurrency:>5} {result['requests']:>6} {result['requests_per_sec'] or 0:>8.1f} "
+              f"{latency['p50']:>8.1f} {latency['p95']:>8.1f} {latency['p99']:>8.1f}  {result['statuses']}")
+
+    metrics = asyncio.run(fetch_metrics(args.url))
+    print(f"\nServer: {metrics['batches']} batches, mean size {metrics['mean_batch_size'] or 0:.1f}, "
+          f"max {metrics['max_batch_size']}, {metrics['rejected']} rejected")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'levels': report, 'server_metrics': metrics}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,57 +2,105 @@
 Hallucination Detection and Correction in LLMs - Healthcare Domain
 Author: NLP Course Project
 Description: Comprehensive system for detecting and correcting hallucinations in medical LLM outputs
+
+Importing this module is cheap: the transformer models are loaded lazily the
+first time a detection method needs them, and the evaluation pipeline only
+runs through main().
 """
 
 import numpy as np
-import json
-import re
-from transformers import pipeline, AutoTokenizer, AutoModelForSequenceClassification
-import torch
-from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, confusion_matrix
+import argparse
+import logging
 import warnings
+from collections import Counter
 warnings.filterwarnings('ignore')
 
 # Import the medical dataset
-from medical_dataset import get_dataset, get_dataset_statistics
+from medical_dataset import get_dataset, get_dataset_statistics, iter_jsonl_dataset
+from embedding_cache import EmbeddingCache, DEFAULT_EMBEDDING_CACHE_DIR
+from text_patterns import PhraseMatcher, PhraseRewriter, split_sentences, content_key
+from medical_rules import MedicalRuleEngine, DEFAULT_RULES_PATH
+from parallel_runner import DetectionPool
+from streaming import chunked, JsonlResultWriter, StreamingMetrics
+from result_store import ResultStore, case_key, config_fingerprint
+from score_matrix import ScoreMatrix, ScoreMatrixBuilder
+from result_columns import ResultColumnsWriter, save_result_columns
+from onnx_backend import BACKENDS, DEFAULT_ONNX_DIR
+from nli_models import NLI_PRESETS, DEFAULT_NLI_PRESET, resolve_nli_model, model_id2label, nli_label_map
+from instrumentation import StageProfiler
+from evidence_index import DEFAULT_INDEX_DIR, open_evidence_index
+from model_registry import MODEL_REGISTRY
+
+# Per-case detector output is logged at DEBUG and model loading at INFO; both are silent by default
+logger = logging.getLogger(__name__)
 
-print("=" * 80)
-print("HALLUCINATION DETECTION & CORRECTION IN HEALTHCARE LLMs")
-print("=" * 80)
+NLI_MODEL_NAME = "facebook/bart-large-mnli"
+SIMILARITY_MODEL_NAME = "all-MiniLM-L6-v2"
+DOMAIN_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
 
 
 # ============================================================================
-# 1. LOAD MEDICAL DATASET
+# 1. MODEL LOADING
 # ============================================================================
-print("\n[1] Loading Healthcare Dataset...")
+# Heavy imports (torch, transformers, sentence-transformers) happen inside the
+# loaders so they are only paid for by the detection methods that need them.
+# backend='onnx' / 'onnx-int8' loads the models exported by onnx_backend.py
+# into onnxruntime instead of PyTorch, behind the same calling API.
+# Detectors get their models through the shared MODEL_REGISTRY, so each model
+# is loaded once per process however many detectors use it.
 
-medical_dataset = get_dataset()
-dataset_stats = get_dataset_statistics()
+def load_nli_model(model_name=NLI_MODEL_NAME, backend='torch', onnx_dir=DEFAULT_ONNX_DIR, threads=None):
+    """Method 1 model: Entailment-Based Detection (NLI)"""
+    if backend != 'torch':
+        from onnx_backend import load_onnx_model
+        return load_onnx_model('nli', model_name, backend, onnx_dir, threads)
+    # Same calling API as a transformers text-classification pipeline, over tokenize-once pair encoding
+    from scorers import CrossEncoderScorer, PairClassificationPipeline
+    return PairClassificationPipeline(CrossEncoderScorer(model_name, max_length=None))
 
-print(f"✓ Loaded {dataset_stats['total']} medical cases")
-print(f"  - Non-hallucinated: {dataset_stats['factual']}")
-print(f"  - Hallucinated: {dataset_stats['hallucinated']}")
 
+def load_similarity_model(model_name=SIMILARITY_MODEL_NAME, backend='torch', onnx_dir=DEFAULT_ONNX_DIR, threads=None):
+    """Method 2 model: Sentence Similarity (Semantic Coherence)"""
+    if backend != 'torch':
+        from onnx_backend import load_onnx_model
+        return load_onnx_model('similarity', model_name, backend, onnx_dir, threads)
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
 
-# ============================================================================
-# 2. DETECTION METHODS
-# ============================================================================
-print("\n[2] Initializing Detection Methods...")
 
-# Method 1: Entailment-Based Detection (NLI)
-print("  → Loading NLI model for entailment detection...")
-nli_model = pipeline("text-classification", model="facebook/bart-large-mnli", device=-1)
+def load_domain_classifier(model_name=DOMAIN_MODEL_NAME, backend='torch', onnx_dir=DEFAULT_ONNX_DIR, threads=None):
+    """Method 3 model: Medical Domain Classifier (cross-encoder)"""
+    if backend != 'torch':
+        from onnx_backend import load_onnx_model
+        return load_onnx_model('domain', model_name, backend, onnx_dir, threads)
+    from scorers import CrossEncoderScorer
+    return CrossEncoderScorer(model_name)
 
-# Method 2: Sentence Similarity (Semantic Coherence)
-print("  → Loading sentence similarity model...")
-from sentence_transformers import SentenceTransformer, util
-similarity_model = SentenceTransformer('all-MiniLM-L6-v2')
 
-# Method 3: Medical Domain Classifier
-print("  → Loading domain-specific classifier...")
-domain_classifier = pipeline("text-classification", model="cross-encoder/ms-marco-MiniLM-L-6-v2", device=-1)
+def nli_kwargs(args):
+    """HallucinationDetector arguments for the --nli-model / --nli-labels choice"""
+    model_name, labels = resolve_nli_model(args.nli_model, args.nli_labels)
+    return {'nli_model_name': model_name, 'nli_labels': labels, 'nli_granularity': args.nli_granularity,
+            'nli_aggregate': args.nli_aggregate}
 
 
+def detector_args(args):
+    """HallucinationDetector arguments from the command line (the same in the parent and in workers)"""
+    return {'risk_phrases_path': args.risk_phrases, 'rules_path': args.rules, 'backend': args.backend,
+            'onnx_dir': args.onnx_dir, 'dedup': args.dedup, **nli_kwargs(args)}
+
+
+def open_embedding_cache(backend='torch', cache_dir=DEFAULT_EMBEDDING_CACHE_DIR):
+    """Persistent embedding cache for the similarity model on this backend"""
+    # ONNX/INT8 embeddings differ slightly from PyTorch ones, so each backend keeps its own entries
+    model_key = SIMILARITY_MODEL_NAME if backend == 'torch' else f"{SIMILARITY_MODEL_NAME}@{backend}"
+    return EmbeddingCache(cache_dir, model_key)
+
+
+# ============================================================================
+# 2. DETECTION METHODS
+# ============================================================================
+
 class HallucinationDetector:
     """Multi-method hallucination detection system"""
     
@@ -63,64 +111,254 @@ class HallucinationDetector:
         "absolutely", "impossible", "certain", "definitely safe"
     ]
     
-    def __init__(self, nli_model, similarity_model, domain_classifier):
-        self.nli_model = nli_model
-        self.similarity_model = similarity_model
-        self.domain_classifier = domain_classifier
+    # Detectors in ensemble-weight order, and the same detectors from cheapest to most expensive
+    METHODS = ['entailment', 'similarity', 'domain', 'uncertainty', 'medical_rules']
+    CASCADE_ORDER = ['uncertainty', 'medical_rules', 'similarity', 'domain', 'entailment']
+    DEFAULT_WEIGHTS = [0.3, 0.2, 0.15, 0.2, 0.15]
+    DECISION_THRESHOLD = 0.4
+    
+    # Entailment hypothesis: the whole output, or each sentence with the weakest one deciding
+    NLI_GRANULARITIES = ('output', 'sentence')
+    NLI_AGGREGATES = ('max_contradiction', 'min_entailment')
+    
+    # Texts each detector reads; rows of a batch whose normalized inputs match are scored once
+    STAGE_INPUTS = {
+        'entailment': ('evidence', 'output'),
+        'similarity': ('evidence', 'output'),
+        'domain': ('evidence', 'output'),
+        'uncertainty': ('output',),
+        'medical_rules': ('query', 'output')
+    }
+    
+    # Per-detector cutoffs
+    ENTAILMENT_THRESHOLD = 0.5
+    SIMILARITY_THRESHOLD = 0.5
+    DOMAIN_THRESHOLD = 0.3
+    
+    def __init__(self, nli_model=None, similarity_model=None, domain_classifier=None, embedding_cache=None,
+                 risk_phrases_path=None, rules_path=DEFAULT_RULES_PATH, nli_model_name=NLI_MODEL_NAME,
+                 similarity_model_name=SIMILARITY_MODEL_NAME, domain_model_name=DOMAIN_MODEL_NAME,
+                 backend='torch', onnx_dir=DEFAULT_ONNX_DIR, onnx_threads=None, nli_labels=None,
+                 nli_granularity='output', nli_aggregate='max_contradiction', profiler=None, registry=None,
+                 dedup=True):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown inference backend: {backend} (choose from {', '.join(BACKENDS)})")
+        if nli_granularity not in self.NLI_GRANULARITIES or nli_aggregate not in self.NLI_AGGREGATES:
+            raise ValueError(f"Unknown NLI mode: {nli_granularity}/{nli_aggregate}")
+        # Models not passed in are loaded on first use of the method that needs them
+        self._nli_model = nli_model
+        self._similarity_model = similarity_model
+        self._domain_classifier = domain_classifier
+        self.model_names = {
+            'entailment': nli_model_name,
+            'similarity': similarity_model_name,
+            'domain': domain_model_name
+        }
+        # Canonical label of each NLI class index; None reads the labels from the model config
+        self.nli_labels = nli_labels
+        self._nli_label_map = None
+        self.nli_granularity = nli_granularity
+        self.nli_aggregate = nli_aggregate
+        self.claim_stats = Counter()
+        self.backend = backend
+        self.onnx_dir = onnx_dir
+        self.onnx_threads = onnx_threads
+        self.embedding_cache = embedding_cache
+        self.registry = registry or MODEL_REGISTRY
+        self.skipped_stages = Counter()
+        # Rows sent to each stage by the batched path, and the distinct inputs actually scored
+        self.dedup = dedup
+        self.dedup_stats = {'rows': Counter(), 'unique': Counter()}
+        # Stage timings go to a disabled (no-op) profiler unless one is passed in
+        self.profiler = profiler or StageProfiler(enabled=False)
+        
+        # Risk lexicon compiled once; a phrase file (one per line) replaces the built-in list
+        if risk_phrases_path:
+            self.risk_matcher = PhraseMatcher.from_file(risk_phrases_path)
+        else:
+            self.risk_matcher = PhraseMatcher(self.RISK_PHRASES)
+        
+        # Medical safety rules are data (medical_rules.json), indexed by query trigger keyword
+        self.rule_engine = MedicalRuleEngine.from_file(rules_path)
+    
+    @property
+    def nli_model(self):
+        if self._nli_model is None:
+            logger.info("  → Loading NLI model for entailment detection...")
+            with self.profiler.span('load:entailment'):
+                self._nli_model = self.registry.get(
+                    'nli', self.model_names['entailment'], load_nli_model, **self._backend_kwargs()
+                )
+        return self._nli_model
+    
+    @property
+    def nli_label_map(self):
+        """Raw NLI model label -> entailment / neutral / contradiction"""
+        if self._nli_label_map is None:
+            self._nli_label_map = nli_label_map(model_id2label(self.nli_model), self.nli_labels)
+        return self._nli_label_map
+    
+    @property
+    def similarity_model(self):
+        if self._similarity_model is None:
+            logger.info("  → Loading sentence similarity model...")
+            with self.profiler.span('load:similarity'):
+                self._similarity_model = self.registry.get(
+                    'similarity', self.model_names['similarity'], load_similarity_model, **self._backend_kwargs()
+                )
+        return self._similarity_model
+    
+    @property
+    def domain_classifier(self):
+        if self._domain_classifier is None:
+            logger.info("  → Loading domain-specific classifier...")
+            with self.profiler.span('load:domain'):
+                self._domain_classifier = self.registry.get(
+                    'domain', self.model_names['domain'], load_domain_classifier, **self._backend_kwargs()
+                )
+        return self._domain_classifier
+    
+    def _backend_kwargs(self):
+        return {'backend': self.backend, 'onnx_dir': self.onnx_dir, 'threads': self.onnx_threads}
         
     def detect_via_entailment(self, evidence, output):
         """Method 1: NLI-based detection - checks if evidence entails output"""
         # Proper NLI format: premise (evidence) entails hypothesis (output)
-        input_text = f"{evidence}</s></s>{output}"
-        result = self.nli_model(input_text)[0]
+        result = self.entailment_results([(evidence, output)])[0]
         
         # Check if the relationship is entailment or contradiction
         label = result['label'].lower()
         score = result['score']
         
-        print(f"    NLI: {label} ({score:.3f})")
+        claim = f" on claim: {result['claim'][:60]}" if 'claim' in result else ""
+        logger.debug("    NLI: %s (%.3f)%s", label, score, claim)
         
-        # Entailment = factual, Contradiction = hallucination
-        if 'entailment' in label and score > 0.5:
-            return 0, score  # Not hallucinated
-        elif 'contradiction' in label and score > 0.5:
-            return 1, score  # Hallucinated
-        else:  # neutral or low confidence
-            return 1, score  # Flag as potential hallucination
+        return self._entailment_decision(result)
+    
+    def detect_via_entailment_batch(self, pairs, batch_size=16):
+        """Method 1 (batched): NLI detection over a list of (evidence, output) pairs"""
+        return [self._entailment_decision(r) for r in self.entailment_results(pairs, batch_size=batch_size)]
+    
+    def entailment_results(self, pairs, batch_size=16):
+        """Case-level NLI results for the configured granularity (whole output or per sentence)"""
+        if self.nli_granularity == 'sentence':
+            return self.claim_nli_batch(pairs, batch_size=batch_size)
+        return self.nli_batch(pairs, batch_size=batch_size)
+    
+    def claim_nli_batch(self, pairs, batch_size=16):
+        """Sentence-level NLI: the evidence against every sentence of every output, in one batched call
+        
+        Identical (evidence, sentence) pairs, within a case or across cases, are
+        scored once. Each case then takes the result of its weakest claim: the
+        sentence with the highest contradiction probability (max_contradiction)
+        or the lowest entailment probability (min_entailment), marked 'claim'.
+        """
+        claims = [split_sentences(output) or [output] for _, output in pairs]
+        unique = list(dict.fromkeys(
+            (evidence, sentence) for (evidence, _), sentences in zip(pairs, claims) for sentence in sentences
+        ))
+        scored = dict(zip(unique, self.nli_batch(unique, batch_size=batch_size)))
+        self.claim_stats.update(claims=sum(len(sentences) for sentences in claims), scored_pairs=len(unique))
+        
+        label, sign = ('contradiction', 1) if self.nli_aggregate == 'max_contradiction' else ('entailment', -1)
+        results = []
+        for (evidence, _), sentences in zip(pairs, claims):
+            weakest = max(sentences, key=lambda s: sign * scored[(evidence, s)]['scores'].get(label, 0.0))
+            results.append({**scored[(evidence, weakest)], 'claim': weakest})
+        return results
+    
+    def nli_batch(self, pairs, batch_size=16):
+        """Run the NLI model over (premise, hypothesis) pairs in padded batches.
+        
+        Pairs are sorted by length before batching so each batch is padded to
+        similarly sized inputs; results come back in the original order as
+        dicts with the top 'label', its 'score', and the full label -> probability
+        distribution under 'scores', with labels mapped to the canonical
+        entailment / neutral / contradiction names.
+        """
+        if not pairs:
+            return []
+        order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][0]) + len(pairs[i][1]), reverse=True)
+        inputs = [{'text': pairs[i][0], 'text_pair': pairs[i][1]} for i in order]
+        outputs = self.nli_model(inputs, batch_size=batch_size, truncation=True, top_k=None)
+        label_map = self.nli_label_map
+        
+        results = [None] * len(pairs)
+        for i, out in zip(order, outputs):
+            ranked = sorted(out, key=lambda r: r['score'], reverse=True)
+            labels = [label_map.get(r['label'].lower(), r['label'].lower()) for r in ranked]
+            results[i] = {
+                'label': labels[0],
+                'score': ranked[0]['score'],
+                'scores': dict(zip(labels, (r['score'] for r in ranked)))
+            }
+        return results
+    
+    def _entailment_decision(self, result):
+        """Map an NLI result to (is_hallucination, entailment probability)
+        
+        Only a confident entailment counts as factual; contradiction, neutral and
+        low-confidence entailment are all flagged. For thresholds >= 0.5 this is
+        the same as requiring an 'entailment' top label scoring above the
+        threshold, but it leaves a single score that can be re-thresholded.
+        """
+        entailment = result['scores'].get('entailment', 0.0)
+        return (0 if entailment > self.ENTAILMENT_THRESHOLD else 1), entailment
     
     def detect_via_similarity(self, evidence, output):
         """Method 2: Semantic similarity - low similarity indicates hallucination"""
-        emb1 = self.similarity_model.encode(evidence, convert_to_tensor=True)
-        emb2 = self.similarity_model.encode(output, convert_to_tensor=True)
-        similarity = util.pytorch_cos_sim(emb1, emb2).item()
+        if self.embedding_cache is not None:
+            emb1, emb2 = self.embedding_cache.encode(self.similarity_model, [evidence, output])
+        else:
+            emb1, emb2 = self.similarity_model.encode([evidence, output], convert_to_numpy=True)
+        similarity = float(np.dot(emb1, emb2) / (np.linalg.norm(emb1) * np.linalg.norm(emb2)))
         
-        print(f"    Similarity: {similarity:.3f}")
+        logger.debug("    Similarity: %.3f", similarity)
         
         # Threshold: similarity < 0.5 suggests hallucination
-        is_hallucination = 1 if similarity < 0.5 else 0
+        is_hallucination = 1 if similarity < self.SIMILARITY_THRESHOLD else 0
         return is_hallucination, similarity
     
+    def detect_via_similarity_batch(self, evidences, outputs, batch_size=64):
+        """Method 2 (batched): paired cosine similarity for whole lists of texts"""
+        if self.embedding_cache is not None:
+            emb1 = self.embedding_cache.encode(self.similarity_model, evidences, batch_size=batch_size)
+            emb2 = self.embedding_cache.encode(self.similarity_model, outputs, batch_size=batch_size)
+        else:
+            emb1 = self.similarity_model.encode(evidences, batch_size=batch_size, convert_to_numpy=True)
+            emb2 = self.similarity_model.encode(outputs, batch_size=batch_size, convert_to_numpy=True)
+        
+        # Normalize once, then row-wise dot product = paired cosine similarity
+        emb1 = emb1 / np.linalg.norm(emb1, axis=1, keepdims=True)
+        emb2 = emb2 / np.linalg.norm(emb2, axis=1, keepdims=True)
+        similarities = np.einsum('ij,ij->i', emb1, emb2)
+        
+        # Threshold: similarity < 0.5 suggests hallucination
+        predictions = (similarities < self.SIMILARITY_THRESHOLD).astype(int)
+        return [(int(p), float(sim)) for p, sim in zip(predictions, similarities)]
+    
     def detect_via_domain_classifier(self, evidence, output):
         """Method 3: Cross-encoder relevance scoring"""
-        input_text = f"{evidence} [SEP] {output}"
-        result = self.domain_classifier(input_text)[0]
-        score = result['score']
+        score = float(self.domain_classifier.score([(evidence, output)])[0])
         
-        print(f"    Domain: {score:.3f}")
+        logger.debug("    Domain: %.3f", score)
         
         # Low relevance score indicates hallucination
-        is_hallucination = 1 if score < 0.3 else 0
+        is_hallucination = 1 if score < self.DOMAIN_THRESHOLD else 0
         return is_hallucination, score
     
+    def detect_via_domain_classifier_batch(self, evidences, outputs, batch_size=32):
+        """Method 3 (batched): cross-encoder scores for (evidence, output) sentence pairs"""
+        scores = self.domain_classifier.score(list(zip(evidences, outputs)), batch_size=batch_size)
+        predictions = (scores < self.DOMAIN_THRESHOLD).astype(int)
+        return [(int(p), float(score)) for p, score in zip(predictions, scores)]
+    
     def detect_via_uncertainty(self, output):
         """Method 4: Uncertainty-based detection - flags overconfident/absolute statements"""
-        score = 0
-        text_lower = output.lower()
-        for phrase in self.RISK_PHRASES:
-            if re.search(rf"\b{phrase}\b", text_lower):
-                score += 1
+        phrase_counts = self.risk_matcher.count(output)
+        score = len(phrase_counts)
         
-        print(f"    Uncertainty: {score} risky phrases found")
+        logger.debug("    Uncertainty: %d risky phrases found", score)
         
         # Any risky phrase is suspicious in medical context
         is_hallucination = 1 if score > 0 else 0
@@ -129,115 +367,293 @@ class HallucinationDetector:
     
     def detect_via_medical_rules(self, query, output):
         """Method 5: Rule-based medical safety checks"""
-        q = query.lower()
-        r = output.lower()
-        violations = []
-        
-        # Paracetamol dosage rule (max 4000mg, not 6000mg)
-        if "paracetamol" in q or "acetaminophen" in q:
-            if any(dose in r for dose in ["6000", "5000", "8000"]):
-                violations.append("excessive_paracetamol_dose")
-        
-        # Antibiotics for viruses rule
-        if "antibiotic" in q and "viral" in q:
-            if "effective" in r or "treat" in r and "not" not in r:
-                violations.append("antibiotics_for_virus")
-        
-        # Pregnancy medication safety
-        if "pregnancy" in q or "pregnant" in q:
-            if "ibuprofen" in r and "third trimester" in q and "safe" in r:
-                violations.append("nsaid_third_trimester")
-            if "completely safe" in r or "no risk" in r:
-                violations.append("pregnancy_overconfidence")
-        
-        # Aspirin and children (Reye's syndrome risk)
-        if ("child" in q or "pediatric" in q) and "aspirin" in r:
-            if "safe" in r and "reye" not in r:
-                violations.append("aspirin_children_risk")
-        
-        print(f"    Medical Rules: {len(violations)} violations - {violations if violations else 'none'}")
+        violations = self.rule_engine.evaluate(query, output)
+        
+        logger.debug("    Medical Rules: %d violations - %s", len(violations), violations if violations else 'none')
         
         is_hallucination = 1 if violations else 0
         confidence = min(len(violations) / 2.0, 1.0)
         return is_hallucination, confidence
     
-    def ensemble_detection(self, query, evidence, output, weights=[0.3, 0.2, 0.15, 0.2, 0.15]):
-        """Ensemble method combining all five detectors"""
-        print(f"  Detection scores:")
-        pred1, score1 = self.detect_via_entailment(evidence, output)
-        pred2, score2 = self.detect_via_similarity(evidence, output)
-        pred3, score3 = self.detect_via_domain_classifier(evidence, output)
-        pred4, score4 = self.detect_via_uncertainty(output)
-        pred5, score5 = self.detect_via_medical_rules(query, output)
+    def ensemble_detection(self, query, evidence, output, weights=DEFAULT_WEIGHTS, cascade=False):
+        """Ensemble method combining all five detectors
         
-        # Weighted voting - sum weights of methods that predict hallucination
+        With cascade=True the detectors run from cheapest to most expensive and
+        stop as soon as the weighted vote can no longer change; stages that were
+        not run are reported as (None, None) in the method scores, and the
+        confidence is a lower bound of the full ensemble's (see _weighted_vote).
+        """
+        logger.debug("  Detection scores:")
+        stages = {
+            'entailment': lambda: self.detect_via_entailment(evidence, output),
+            'similarity': lambda: self.detect_via_similarity(evidence, output),
+            'domain': lambda: self.detect_via_domain_classifier(evidence, output),
+            'uncertainty': lambda: self.detect_via_uncertainty(output),
+            'medical_rules': lambda: self.detect_via_medical_rules(query, output)
+        }
+        
+        method_scores = dict.fromkeys(self.METHODS, (None, None))
         hallucination_weight = 0
-        hallucination_weight += weights[0] if pred1 == 1 else 0
-        hallucination_weight += weights[1] if pred2 == 1 else 0
-        hallucination_weight += weights[2] if pred3 == 1 else 0
-        hallucination_weight += weights[3] if pred4 == 1 else 0
-        hallucination_weight += weights[4] if pred5 == 1 else 0
+        remaining_weight = sum(weights)
+        for name in (self.CASCADE_ORDER if cascade else self.METHODS):
+            weight = weights[self.METHODS.index(name)]
+            remaining_weight -= weight
+            # A zero-weight stage cannot change the vote, so skip its computation
+            if weight == 0:
+                continue
+            with self.profiler.span(name):
+                method_scores[name] = stages[name]()
+            hallucination_weight += weight if method_scores[name][0] == 1 else 0
+            if cascade and self._vote_is_fixed(hallucination_weight, remaining_weight):
+                break
         
-        # Decision: if majority of weighted votes say hallucination
-        final_pred = 1 if hallucination_weight >= 0.4 else 0
-        confidence = hallucination_weight if final_pred == 1 else (1 - hallucination_weight)
+        self.skipped_stages.update(name for name, (pred, _) in method_scores.items() if pred is None)
+        final_pred, confidence = self._weighted_vote(method_scores, weights)
         
-        print(f"  → Final: {'HALLUCINATION' if final_pred == 1 else 'FACTUAL'} (confidence: {confidence:.3f})")
+        logger.debug("  → Final: %s (confidence: %.3f)", 'HALLUCINATION' if final_pred == 1 else 'FACTUAL', confidence)
+        
+        return final_pred, confidence, method_scores
+    
+    def ensemble_detection_batch(self, queries, evidences, outputs, weights=DEFAULT_WEIGHTS, batch_size=16, cascade=False,
+                                 cached_scores=None):
+        """Ensemble detection over many cases; all model stages run batched
         
-        return final_pred, confidence, {
-            'entailment': (pred1, score1),
-            'similarity': (pred2, score2),
-            'domain': (pred3, score3),
-            'uncertainty': (pred4, score4),
-            'medical_rules': (pred5, score5)
+        In cascade mode each stage only runs on the cases whose vote is still
+        open after the cheaper stages, so model batches shrink as cases settle.
+        cached_scores optionally gives, per case, a dict stage -> (pred, score)
+        of results computed earlier; those stages are not run again. Rows whose
+        inputs to a stage are identical (after whitespace normalization) are
+        scored once and share the result, e.g. one canned answer graded under
+        many prompts runs through the models once.
+        """
+        n = len(outputs)
+        stage_results = {name: [(None, None)] * n for name in self.METHODS}
+        hallucination_weight = [0] * n
+        remaining_weight = sum(weights)
+        active = list(range(n))
+        
+        for name in (self.CASCADE_ORDER if cascade else self.METHODS):
+            weight = weights[self.METHODS.index(name)]
+            remaining_weight -= weight
+            # A zero-weight stage cannot change the vote, so skip its computation
+            if weight == 0 or not active:
+                continue
+            
+            if cached_scores is not None:
+                for i in active:
+                    if name in cached_scores[i]:
+                        stage_results[name][i] = cached_scores[i][name]
+            todo = [i for i in active if stage_results[name][i][0] is None]
+            
+            if todo:
+                unique, slots = self._dedup_rows(name, todo, queries, evidences, outputs)
+                stage_output = self._run_stage_batch(
+                    name,
+                    [queries[i] for i in unique],
+                    [evidences[i] for i in unique],
+                    [outputs[i] for i in unique],
+                    batch_size
+                )
+                for i, slot in zip(todo, slots):
+                    stage_results[name][i] = stage_output[slot]
+            for i in active:
+                hallucination_weight[i] += weight if stage_results[name][i][0] == 1 else 0
+            
+            if cascade:
+                active = [i for i in active if not self._vote_is_fixed(hallucination_weight[i], remaining_weight)]
+        
+        results = []
+        for i in range(n):
+            method_scores = {name: stage_results[name][i] for name in self.METHODS}
+            self.skipped_stages.update(name for name, (pred, _) in method_scores.items() if pred is None)
+            final_pred, confidence = self._weighted_vote(method_scores, weights)
+            results.append((final_pred, confidence, method_scores))
+        return results
+    
+    def _dedup_rows(self, name, rows, queries, evidences, outputs):
+        """Rows holding the first copy of each distinct input to stage name, and each row's index among them"""
+        if not self.dedup:
+            return rows, range(len(rows))
+        texts = {'query': queries, 'evidence': evidences, 'output': outputs}
+        fields = self.STAGE_INPUTS[name]
+        first = {}
+        unique, slots = [], []
+        for i in rows:
+            key = content_key(*(texts[field][i] for field in fields))
+            if key not in first:
+                first[key] = len(unique)
+                unique.append(i)
+            slots.append(first[key])
+        self.dedup_stats['rows'][name] += len(rows)
+        self.dedup_stats['unique'][name] += len(unique)
+        return unique, slots
+    
+    def _run_stage_batch(self, name, queries, evidences, outputs, batch_size=16):
+        """Run one detector over a list of cases"""
+        with self.profiler.span(name, len(outputs)):
+            return self._detect_batch(name, queries, evidences, outputs, batch_size)
+    
+    def _detect_batch(self, name, queries, evidences, outputs, batch_size):
+        if name == 'entailment':
+            return self.detect_via_entailment_batch(list(zip(evidences, outputs)), batch_size=batch_size)
+        if name == 'similarity':
+            return self.detect_via_similarity_batch(evidences, outputs)
+        if name == 'domain':
+            return self.detect_via_domain_classifier_batch(evidences, outputs)
+        if name == 'uncertainty':
+            return [self.detect_via_uncertainty(output) for output in outputs]
+        if name == 'medical_rules':
+            return [self.detect_via_medical_rules(query, output) for query, output in zip(queries, outputs)]
+        raise ValueError(f"Unknown detection method: {name}")
+    
+    def thresholds(self):
+        """Per-detector cutoffs and the ensemble decision threshold"""
+        return {
+            'entailment': self.ENTAILMENT_THRESHOLD,
+            'similarity': self.SIMILARITY_THRESHOLD,
+            'domain': self.DOMAIN_THRESHOLD,
+            'decision': self.DECISION_THRESHOLD
         }
-
-detector = HallucinationDetector(nli_model, similarity_model, domain_classifier)
-print("✓ Detection methods initialized")
+    
+    def stage_fingerprints(self):
+        """Hash of everything that determines each detector's (pred, score) output"""
+        configs = {
+            'entailment': {'model': self.model_names['entailment'], 'threshold': self.ENTAILMENT_THRESHOLD,
+                           'score': 'p_entailment', 'backend': self.backend, 'labels': self.nli_labels,
+                           'granularity': self.nli_granularity, 'aggregate': self.nli_aggregate},
+            'similarity': {'model': self.model_names['similarity'], 'threshold': self.SIMILARITY_THRESHOLD,
+                           'backend': self.backend},
+            'domain': {'model': self.model_names['domain'], 'threshold': self.DOMAIN_THRESHOLD,
+                       'backend': self.backend},
+            'uncertainty': {'phrases': sorted(self.risk_matcher.phrases)},
+            'medical_rules': {'rules': self.rule_engine.specs}
+        }
+        return {name: config_fingerprint({'stage': name, **config}) for name, config in configs.items()}
+    
+    def needs_scoring(self, cached, weights=DEFAULT_WEIGHTS, cascade=False):
+        """True if ensemble_detection_batch would still run a stage for a case whose known scores are cached"""
+        hallucination_weight = 0
+        remaining_weight = sum(weights)
+        for name in (self.CASCADE_ORDER if cascade else self.METHODS):
+            weight = weights[self.METHODS.index(name)]
+            remaining_weight -= weight
+            if weight == 0:
+                continue
+            if name not in cached:
+                return True
+            hallucination_weight += weight if cached[name][0] == 1 else 0
+            if cascade and self._vote_is_fixed(hallucination_weight, remaining_weight):
+                return False
+        return False
+    
+    def _vote_is_fixed(self, hallucination_weight, remaining_weight):
+        """True once the remaining stages can no longer move the vote across the threshold"""
+        # Small margin so float summation order never flips a borderline decision
+        margin = 1e-9
+        return (hallucination_weight >= self.DECISION_THRESHOLD + margin or
+                hallucination_weight + remaining_weight < self.DECISION_THRESHOLD - margin)
+    
+    def _weighted_vote(self, method_scores, weights):
+        """Combine per-method predictions into (final_pred, confidence)
+        
+        Stages the cascade skipped have an unknown vote, so their weight could
+        have gone either way; the confidence is then the lowest the full
+        ensemble's could be (its exact value when no weighted stage was skipped).
+        """
+        # Weighted voting - sum weights of methods that predict hallucination
+        hallucination_weight = 0
+        unknown_weight = 0
+        for weight, name in zip(weights, self.METHODS):
+            if method_scores[name][0] is None:
+                unknown_weight += weight
+            hallucination_weight += weight if method_scores[name][0] == 1 else 0
+        
+        # Decision: if majority of weighted votes say hallucination
+        final_pred = 1 if hallucination_weight >= self.DECISION_THRESHOLD else 0
+        confidence = hallucination_weight if final_pred == 1 else (1 - hallucination_weight - unknown_weight)
+        return final_pred, confidence
 
 
 # ============================================================================
 # 3. CORRECTION STRATEGIES
 # ============================================================================
-print("\n[3] Setting up Correction Strategies...")
 
 class HallucinationCorrector:
     """Multiple correction strategies for detected hallucinations"""
     
-    def __init__(self, dataset_evidence):
+    # Absolute claims softened by rule-based correction: (pattern, replacement)
+    DANGEROUS_PATTERNS = [
+        ('cure', 'treatment options include'),
+        ('definitely', 'may'),
+        ('never', 'typically not recommended'),
+        ('always', 'generally'),
+        ('all', 'some')
+    ]
+    
+    def __init__(self, dataset_evidence, profiler=None, evidence_index=None, rewrite_rules_path=None, open_index=None):
         self.evidence_db = dataset_evidence
+        # Rewrite table compiled once; a rule file ('pattern => replacement' per line) replaces the built-in table
+        if rewrite_rules_path:
+            self.rewriter = PhraseRewriter.from_file(rewrite_rules_path)
+        else:
+            self.rewriter = PhraseRewriter(self.DANGEROUS_PATTERNS)
+        self.profiler = profiler or StageProfiler(enabled=False)
+        # Vector index over evidence_db, for queries that come without evidence; filled on first lookup.
+        # open_index (a callable) defers opening it until a case actually needs retrieval
+        self.evidence_index = evidence_index
+        self._open_index = open_index
+        self._evidence_indexed = False
+    
+    def retrieve_evidence(self, query, k=3):
+        """Top-k (evidence, similarity) passages for query from the evidence index"""
+        if self.evidence_index is None and self._open_index is not None:
+            self.evidence_index = self._open_index()
+        if self.evidence_index is None:
+            raise ValueError("No evidence given and no evidence index configured")
+        if not self._evidence_indexed:
+            # Only evidence not yet in the persisted index is embedded
+            self.evidence_index.add([e for e in self.evidence_db if e])
+            self._evidence_indexed = True
+        return self.evidence_index.search(query, k)
+        
+    def rag_correction(self, query, evidence=None, k=3):
+        """Strategy 1: Retrieval-Augmented Generation
         
-    def rag_correction(self, query, evidence):
-        """Strategy 1: Retrieval-Augmented Generation"""
+        Without evidence, the k passages most similar to the query are
+        retrieved from the evidence index and listed under 'sources'.
+        """
+        sources = None
+        if evidence is None:
+            hits = self.retrieve_evidence(query, k)
+            evidence = ' '.join(text for text, _ in hits)
+            sources = [{'evidence': text, 'similarity': score} for text, score in hits]
         corrected = f"Based on medical evidence: {evidence}"
-        return {
+        result = {
             'method': 'RAG',
             'corrected_output': corrected,
             'explanation': 'Response grounded in verified medical literature'
         }
+        if sources is not None:
+            result['sources'] = sources
+        return result
     
     def rule_based_correction(self, llm_output, evidence):
-        """Strategy 2: Domain-specific rule application"""
-        dangerous_patterns = [
-            ('cure', 'treatment options include'),
-            ('definitely', 'may'),
-            ('never', 'typically not recommended'),
-            ('always', 'generally'),
-            ('all', 'some')
-        ]
+        """Strategy 2: Domain-specific rule application
         
-        corrected = llm_output
-        applied_rules = []
-        
-        for wrong, correct in dangerous_patterns:
-            if wrong in corrected.lower():
-                corrected = corrected.replace(wrong, correct)
-                applied_rules.append(f"Replaced '{wrong}' with '{correct}'")
+        Whole words and phrases only, matched case-insensitively and replaced
+        in the original capitalization, in one pass; 'edits' gives the
+        character offsets of every replacement.
+        """
+        corrected, edits = self.rewriter.rewrite(llm_output)
+        applied_rules = [
+            f"Replaced '{rule}' with '{self.rewriter.rules[rule]}'" for rule in dict.fromkeys(e['rule'] for e in edits)
+        ]
         
         return {
             'method': 'Rule-Based',
             'corrected_output': corrected,
             'applied_rules': applied_rules,
+            'edits': edits,
             'explanation': 'Applied medical safety rules to reduce absolute claims'
         }
     
@@ -262,150 +678,522 @@ class HallucinationCorrector:
                           for word in ['cure', 'never', 'always', 'definitely']) else 'MEDIUM'
         }
 
-corrector = HallucinationCorrector([d['evidence'] for d in medical_dataset])
-print("✓ Correction strategies ready")
-
 
 # ============================================================================
 # 4. EVALUATION PIPELINE
 # ============================================================================
-print("\n[4] Running Detection & Evaluation...")
-print("-" * 80)
-
-results = []
-all_predictions = []
-all_labels = []
 
-for item in medical_dataset:
-    print(f"\nCase {item['id']}: {item['query'][:60]}...")
-    # Run ensemble detection
-    prediction, confidence, method_scores = detector.ensemble_detection(
-        item['query'],
-        item['evidence'], 
-        item['llm_output']
-    )
+def detect_cases(detector, cases, cascade=False, store=None, pool=None):
+    """ensemble_detection_batch over a list of cases
+    
+    With a ResultStore, detector scores already stored under the current
+    fingerprints are reused and newly computed ones are checkpointed. With a
+    DetectionPool, the cases are scored by its worker processes; only cases
+    that still need a detector run are sent to the workers.
+    """
+    if store is None and pool is None:
+        with detector.profiler.span('ensemble', len(cases)):
+            return detector.ensemble_detection_batch(*case_texts(cases), cascade=cascade)
+    if store is None:
+        detections, skipped_stages = pool.detect(cases, cascade=cascade)
+        detector.skipped_stages.update(skipped_stages)
+        return detections
     
-    all_predictions.append(prediction)
-    all_labels.append(item['label'])
+    fingerprints = detector.stage_fingerprints()
+    keys = [case_key(item) for item in cases]
+    cached = store.get_many(keys, fingerprints)
+    if pool is None:
+        with detector.profiler.span('ensemble', len(cases)):
+            detections = detector.ensemble_detection_batch(*case_texts(cases), cascade=cascade,
+                                                           cached_scores=cached)
+    else:
+        todo = [i for i, scores in enumerate(cached) if detector.needs_scoring(scores, cascade=cascade)]
+        done = sorted(set(range(len(cases))) - set(todo))
+        detections = [None] * len(cases)
+        # Fully stored cases are settled here; the vote over stored scores runs no model
+        settled = detector.ensemble_detection_batch(*case_texts([cases[i] for i in done]), cascade=cascade,
+                                                    cached_scores=[cached[i] for i in done])
+        scored, skipped_stages = pool.detect([cases[i] for i in todo], cascade=cascade,
+                                             cached_scores=[cached[i] for i in todo])
+        detector.skipped_stages.update(skipped_stages)
+        for rows, rows_detections in ((done, settled), (todo, scored)):
+            for i, detection in zip(rows, rows_detections):
+                detections[i] = detection
+    store.put_many(keys, [method_scores for _, _, method_scores in detections], fingerprints)
+    return detections
+
+
+def case_texts(cases):
+    """(queries, evidences, outputs) lists of a list of cases"""
+    return ([item['query'] for item in cases], [item['evidence'] for item in cases],
+            [item['llm_output'] for item in cases])
+
+
+def run_evaluation(detector, corrector, dataset, cascade=False, batch_detections=None, store=None, chunk_size=256,
+                   pool=None):
+    """Run ensemble detection over the dataset and build correction records
     
+    batch_detections can carry ensemble outputs computed elsewhere; otherwise
+    the dataset is scored here (by the workers of pool, if given), in
+    checkpointed chunks when a ResultStore is given.
+    """
+    results = []
+    all_predictions = []
+    all_labels = []
+
+    # Model stages for the whole dataset run through the batched paths
+    if batch_detections is None:
+        if store is None:
+            batch_detections = detect_cases(detector, dataset, cascade=cascade, pool=pool)
+        else:
+            batch_detections = []
+            for chunk in chunked(dataset, chunk_size):
+                batch_detections.extend(detect_cases(detector, chunk, cascade=cascade, store=store, pool=pool))
+
+    for item, (prediction, confidence, method_scores) in zip(dataset, batch_detections):
+        logger.debug("\nCase %s: %s...", item['id'], item['query'][:60])
+        logger.debug("  → Final: %s (confidence: %.3f)", 'HALLUCINATION' if prediction == 1 else 'FACTUAL', confidence)
+
+        all_predictions.append(prediction)
+        all_labels.append(item['label'])
+        results.append(build_result(item, prediction, confidence, method_scores, corrector))
+    return results, all_predictions, all_labels
+
+
+def build_result(item, prediction, confidence, method_scores, corrector):
+    """Result record for one case, with corrections if a hallucination was detected"""
     # Determine correction if hallucination detected
     correction = None
     if prediction == 1:
-        correction = {
-            'rag': corrector.rag_correction(item['query'], item['evidence']),
-            'rule': corrector.rule_based_correction(item['llm_output'], item['evidence']),
-            'explanation': corrector.explanation_feedback(item['query'], item['llm_output'], item['evidence']),
-            'human_loop': corrector.human_in_loop_template(item['query'], item['llm_output'], item['evidence'])
-        }
+        with corrector.profiler.span('correction'):
+            correction = {
+                # A case without evidence gets passages retrieved from the evidence index
+                'rag': corrector.rag_correction(item['query'], item['evidence'] or None),
+                'rule': corrector.rule_based_correction(item['llm_output'], item['evidence']),
+                'explanation': corrector.explanation_feedback(item['query'], item['llm_output'], item['evidence']),
+                'human_loop': corrector.human_in_loop_template(item['query'], item['llm_output'], item['evidence'])
+            }
     
-    results.append({
+    return {
         'id': item['id'],
         'query': item['query'],
         'prediction': prediction,
-        'actual': item['label'],
+        'actual': item.get('label'),
         'confidence': confidence,
         'method_scores': method_scores,
         'correction': correction,
-        'category': item['category']
-    })
-
-# Calculate metrics
-accuracy = accuracy_score(all_labels, all_predictions)
-precision = precision_score(all_labels, all_predictions)
-recall = recall_score(all_labels, all_predictions)
-f1 = f1_score(all_labels, all_predictions)
-cm = confusion_matrix(all_labels, all_predictions)
-
-print("\n" + "=" * 80)
-print("EVALUATION RESULTS")
-print("=" * 80)
-print(f"\nOverall Metrics:")
-print(f"  Accuracy:  {accuracy:.3f}")
-print(f"  Precision: {precision:.3f}")
-print(f"  Recall:    {recall:.3f}")
-print(f"  F1-Score:  {f1:.3f}")
-
-print(f"\nConfusion Matrix:")
-print(f"                 Predicted")
-print(f"               Non-H  Hall")
-print(f"  Actual Non-H    {cm[0][0]:3d}   {cm[0][1]:3d}")
-print(f"         Hall     {cm[1][0]:3d}   {cm[1][1]:3d}")
-
-tn, fp, fn, tp = cm.ravel()
-print(f"\nDetailed Breakdown:")
-print(f"  True Positives (Correctly detected hallucinations):  {tp}")
-print(f"  True Negatives (Correctly identified non-halluc.):   {tn}")
-print(f"  False Positives (False alarms):                      {fp}")
-print(f"  False Negatives (Missed hallucinations):             {fn}")
+        'category': item.get('category')
+    }
+
+
+def run_streaming_evaluation(detector, corrector, cases, output_path, chunk_size=256, cascade=False, store=None,
+                             scores_path=None, results_path=None, pool=None):
+    """Constant-memory evaluation: cases are scored in bounded chunks and each
+    result is appended to a JSONL file as soon as its chunk is done.
+    
+    cases can be any iterable (e.g. iter_jsonl_dataset(path)); returns the
+    incrementally computed metrics. With scores_path (opt-in, since it keeps
+    a few bytes per case in memory until the end), the raw detector scores
+    are also collected into a ScoreMatrix file, and
+    with results_path the results are also written as a columnar results
+    directory. With a DetectionPool, each chunk is sharded across its workers.
+    """
+    metrics = StreamingMetrics()
+    score_builder = ScoreMatrixBuilder() if scores_path else None
+    columns = ResultColumnsWriter(results_path) if results_path else None
+    with JsonlResultWriter(output_path) as writer:
+        for chunk in chunked(cases, chunk_size):
+            detections = detect_cases(detector, chunk, cascade=cascade, store=store, pool=pool)
+            records = []
+            for item, (prediction, confidence, method_scores) in zip(chunk, detections):
+                record = build_result(item, prediction, confidence, method_scores, corrector)
+                writer.write(record)
+                records.append(record)
+                metrics.update(item.get('label'), prediction)
+            writer.flush()
+            if score_builder is not None:
+                score_builder.add(records)
+            if columns is not None:
+                columns.add(records)
+            logger.info("  → %d cases written to %s", writer.count, output_path)
+    
+    if score_builder is not None:
+        score_builder.build(detector.DEFAULT_WEIGHTS, detector.thresholds()).save(scores_path)
+        print(f"  → Detector scores saved to {scores_path}")
+    if columns is not None:
+        columns.close(metrics.to_dict() if metrics.total else None)
+        print(f"  → Columnar results saved to {results_path}/")
+    return metrics
+
+
+def compute_metrics(all_labels, all_predictions):
+    """Standard classification metrics for the hallucination label"""
+    from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, confusion_matrix
+    
+    return {
+        'accuracy': float(accuracy_score(all_labels, all_predictions)),
+        'precision': float(precision_score(all_labels, all_predictions)),
+        'recall': float(recall_score(all_labels, all_predictions)),
+        'f1_score': float(f1_score(all_labels, all_predictions)),
+        'confusion_matrix': confusion_matrix(all_labels, all_predictions, labels=[0, 1]).tolist()
+    }
+
+
+def print_metrics(metrics):
+    cm = metrics['confusion_matrix']
+    
+    print("\n" + "=" * 80)
+    print("EVALUATION RESULTS")
+    print("=" * 80)
+    print(f"\nOverall Metrics:")
+    print(f"  Accuracy:  {metrics['accuracy']:.3f}")
+    print(f"  Precision: {metrics['precision']:.3f}")
+    print(f"  Recall:    {metrics['recall']:.3f}")
+    print(f"  F1-Score:  {metrics['f1_score']:.3f}")
+    
+    print(f"\nConfusion Matrix:")
+    print(f"                 Predicted")
+    print(f"               Non-H  Hall")
+    print(f"  Actual Non-H    {cm[0][0]:3d}   {cm[0][1]:3d}")
+    print(f"         Hall     {cm[1][0]:3d}   {cm[1][1]:3d}")
+    
+    (tn, fp), (fn, tp) = cm
+    print(f"\nDetailed Breakdown:")
+    print(f"  True Positives (Correctly detected hallucinations):  {tp}")
+    print(f"  True Negatives (Correctly identified non-halluc.):   {tn}")
+    print(f"  False Positives (False alarms):                      {fp}")
+    print(f"  False Negatives (Missed hallucinations):             {fn}")
+
+
+def print_store_stats(store):
+    store_stats = store.stats()
+    print(f"\nCheckpoint Store ({store_stats['path']}):")
+    print(f"  Detector scores reused:   {store_stats['hits']}")
+    print(f"  Detector scores computed: {store_stats['misses']}")
+    print(f"  Stored scores:            {store_stats['stored_scores']}")
+
+
+def print_claim_stats(claim_stats):
+    print(f"\nClaim-Level NLI:")
+    print(f"  Sentences checked:      {claim_stats['claims']}")
+    print(f"  Unique pairs scored:    {claim_stats['scored_pairs']}")
+
+
+def print_dedup_stats(dedup_stats):
+    print(f"\nInput Deduplication (rows → distinct inputs scored):")
+    for name in HallucinationDetector.METHODS:
+        rows, unique = dedup_stats['rows'][name], dedup_stats['unique'][name]
+        if rows:
+            print(f"  {name:<14} {rows:>7} → {unique:<7} dedup ratio {rows / unique:.2f}x "
+                  f"({1 - unique / rows:.1%} of detector calls saved)")
+
+
+def print_model_memory(report):
+    print(f"\nModels Loaded ({len(report)}, shared by every detector in this process):")
+    for entry in report:
+        weights = f"{entry['weights_mb']:.0f} MB weights" if entry['weights_mb'] is not None else "weights n/a"
+        shared = ", shared memory" if entry['shared_memory'] else ""
+        print(f"  {entry['kind']:<11} {entry['model'][:40]:<40} {entry['backend']:<9} {weights}, "
+              f"+{entry['rss_growth_mb']:.0f} MB RSS, {entry['load_sec']:.1f} s{shared}")
+
+
+def print_profile(summary):
+    print(f"\nStage Profile ({summary['spans']} spans, {summary['processes']} process(es)):")
+    print(f"  {'Stage':<18} {'Calls':>6} {'Items':>7} {'Wall s':>8} {'CPU s':>8} {'Items/s':>9} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'Peak MB':>8}")
+    for name, stage in summary['stages'].items():
+        latency = stage['latency_ms']
+        throughput = f"{stage['items_per_sec']:>9.1f}" if stage['items_per_sec'] is not None else f"{'-':>9}"
+        print(f"  {name:<18} {stage['calls']:>6} {stage['items']:>7} {stage['wall_sec']:>8.3f} "
+              f"{stage['cpu_sec']:>8.3f} {throughput} {latency['p50']:>8.2f} {latency['p95']:>8.2f} "
+              f"{latency['p99']:>8.2f} {stage['peak_rss_mb']:>8.0f}")
+
+
+def save_profile(profiler, profile_path=None, trace_path=None):
+    """Print the stage profile and write its JSON summary and Chrome trace"""
+    print_profile(profiler.summary())
+    if profile_path:
+        profiler.save_summary(profile_path)
+        print(f"✓ Stage profile saved to {profile_path}")
+    if trace_path:
+        profiler.save_trace(trace_path)
+        print(f"✓ Chrome trace saved to {trace_path} (open in chrome://tracing or ui.perfetto.dev)")
 
 
 # ============================================================================
 # 5. DETAILED CASE ANALYSIS
 # ============================================================================
-print("\n" + "=" * 80)
-print("SAMPLE CASE ANALYSIS")
-print("=" * 80)
 
-# Show 3 examples: correct detection, false positive, false negative
-for i, res in enumerate(results[:3]):
-    print(f"\n--- Case {res['id']}: {res['category']} ---")
-    print(f"Query: {res['query'][:80]}...")
-    print(f"Actual Label: {'HALLUCINATION' if res['actual'] == 1 else 'FACTUAL'}")
-    print(f"Predicted: {'HALLUCINATION' if res['prediction'] == 1 else 'FACTUAL'}")
-    print(f"Confidence: {res['confidence']:.3f}")
-    print(f"Detection Verdict: {'✓ CORRECT' if res['prediction'] == res['actual'] else '✗ INCORRECT'}")
+def print_case_analysis(results):
+    print("\n" + "=" * 80)
+    print("SAMPLE CASE ANALYSIS")
+    print("=" * 80)
+    
+    # Show 3 examples: correct detection, false positive, false negative
+    for i, res in enumerate(results[:3]):
+        print(f"\n--- Case {res['id']}: {res['category']} ---")
+        print(f"Query: {res['query'][:80]}...")
+        print(f"Actual Label: {'HALLUCINATION' if res['actual'] == 1 else 'FACTUAL'}")
+        print(f"Predicted: {'HALLUCINATION' if res['prediction'] == 1 else 'FACTUAL'}")
+        print(f"Confidence: {res['confidence']:.3f}")
+        print(f"Detection Verdict: {'✓ CORRECT' if res['prediction'] == res['actual'] else '✗ INCORRECT'}")
     
-    if res['prediction'] == 1 and res['correction']:
-        print(f"\nCorrection Applied (RAG Method):")
-        print(f"  {res['correction']['rag']['corrected_output'][:100]}...")
+        if res['prediction'] == 1 and res['correction']:
+            print(f"\nCorrection Applied (RAG Method):")
+            print(f"  {res['correction']['rag']['corrected_output'][:100]}...")
 
 
 # ============================================================================
 # 6. SAVE RESULTS
 # ============================================================================
-print("\n" + "=" * 80)
-print("SAVING RESULTS")
-print("=" * 80)
-
-# Save detailed results
-output_data = {
-    'metrics': {
-        'accuracy': float(accuracy),
-        'precision': float(precision),
-        'recall': float(recall),
-        'f1_score': float(f1),
-        'confusion_matrix': cm.tolist()
-    },
-    'results': results
-}
-
-with open('detection_results.json', 'w') as f:
-    json.dump(output_data, f, indent=2, default=str)
-
-print("✓ Results saved to detection_results.json")
-
-# Save evaluation report
-with open('evaluation_report.txt', 'w') as f:
-    f.write("HALLUCINATION DETECTION & CORRECTION - EVALUATION REPORT\n")
-    f.write("=" * 80 + "\n\n")
-    f.write(f"Dataset Size: {len(medical_dataset)}\n")
-    f.write(f"Accuracy: {accuracy:.3f}\n")
-    f.write(f"Precision: {precision:.3f}\n")
-    f.write(f"Recall: {recall:.3f}\n")
-    f.write(f"F1-Score: {f1:.3f}\n\n")
-    f.write(f"Confusion Matrix:\n{cm}\n\n")
-    f.write(f"True Positives: {tp}\n")
-    f.write(f"True Negatives: {tn}\n")
-    f.write(f"False Positives: {fp}\n")
-    f.write(f"False Negatives: {fn}\n")
-
-print("✓ Report saved to evaluation_report.txt")
-
-print("\n" + "=" * 80)
-print("EXECUTION COMPLETE")
-print("=" * 80)
-print("\nNext Steps:")
-print("  1. Review detection_results.json for detailed analysis")
-print("  2. Read evaluation_report.txt for summary metrics")
-print("  3. Check final_report.md for comprehensive documentation")
-print("=" * 80)
\ No newline at end of file
+
+def save_results(metrics, results, dataset_size, score_matrix=None, scores_path='detection_scores.npz',
+                 results_path='detection_results'):
+    print("\n" + "=" * 80)
+    print("SAVING RESULTS")
+    print("=" * 80)
+    
+    (tn, fp), (fn, tp) = metrics['confusion_matrix']
+
+    # Save detailed results as columnar arrays (memory-mapped by analyze_results.py), corrections in a side file
+    save_result_columns(results_path, results, metrics, dataset_size=dataset_size)
+
+    print(f"✓ Results saved to {results_path}/ (inspect with: python3 result_columns.py {results_path})")
+
+    # Save evaluation report
+    with open('evaluation_report.txt', 'w') as f:
+        f.write("HALLUCINATION DETECTION & CORRECTION - EVALUATION REPORT\n")
+        f.write("=" * 80 + "\n\n")
+        f.write(f"Dataset Size: {dataset_size}\n")
+        f.write(f"Accuracy: {metrics['accuracy']:.3f}\n")
+        f.write(f"Precision: {metrics['precision']:.3f}\n")
+        f.write(f"Recall: {metrics['recall']:.3f}\n")
+        f.write(f"F1-Score: {metrics['f1_score']:.3f}\n\n")
+        f.write(f"Confusion Matrix:\n{np.array(metrics['confusion_matrix'])}\n\n")
+        f.write(f"True Positives: {tp}\n")
+        f.write(f"True Negatives: {tn}\n")
+        f.write(f"False Positives: {fp}\n")
+        f.write(f"False Negatives: {fn}\n")
+
+    print("✓ Report saved to evaluation_report.txt")
+
+    if score_matrix is not None:
+        score_matrix.save(scores_path)
+        print(f"✓ Detector scores saved to {scores_path} (re-score with: python3 score_matrix.py {scores_path})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Hallucination detection & correction pipeline")
+    parser.add_argument('--cascade', action='store_true',
+                        help="run detectors cheapest-first and skip stages once the vote is decided")
+    parser.add_argument('--no-dedup', dest='dedup', action='store_false',
+                        help="score every row, even when its detector inputs repeat another row's")
+    parser.add_argument('--risk-phrases', metavar='PATH',
+                        help="file with one risk phrase per line, replacing the built-in list")
+    parser.add_argument('--rules', metavar='PATH', default=DEFAULT_RULES_PATH,
+                        help="JSON file with medical safety rules (default: medical_rules.json)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="shard detection across this many worker processes")
+    parser.add_argument('--share-models', action='store_true',
+                        help="with --workers: load the models once and fork workers that share them copy-on-write")
+    parser.add_argument('--torch-threads', type=int, default=None,
+                        help="torch/onnxruntime threads per worker (default: cores / workers)")
+    parser.add_argument('--backend', choices=BACKENDS, default='torch',
+                        help="inference runtime for the transformer detectors (onnx backends need "
+                             "'python3 onnx_backend.py export' first)")
+    parser.add_argument('--onnx-dir', metavar='DIR', default=DEFAULT_ONNX_DIR,
+                        help="directory of the exported ONNX models")
+    parser.add_argument('--nli-model', default=DEFAULT_NLI_PRESET,
+                        help=f"NLI preset ({', '.join(NLI_PRESETS)}), hub id or local model path")
+    parser.add_argument('--nli-labels', metavar='LABELS',
+                        help="label of each NLI class index, e.g. contradiction,entailment,neutral "
+                             "(needed for models whose config only says LABEL_0, LABEL_1, ...)")
+    parser.add_argument('--nli-granularity', choices=HallucinationDetector.NLI_GRANULARITIES, default='output',
+                        help="NLI hypothesis: the whole output, or each sentence (claim-level)")
+    parser.add_argument('--nli-aggregate', choices=HallucinationDetector.NLI_AGGREGATES,
+                        default='max_contradiction',
+                        help="how sentence-level NLI results decide a case")
+    parser.add_argument('--input', metavar='CASES.jsonl',
+                        help="stream cases from a JSONL file instead of the built-in dataset")
+    parser.add_argument('--output', metavar='RESULTS.jsonl', default='detection_results.jsonl',
+                        help="JSONL file that streaming mode appends results to")
+    parser.add_argument('--chunk-size', type=int, default=256,
+                        help="cases scored per batch in streaming and checkpointed runs")
+    parser.add_argument('--checkpoint', metavar='STORE.sqlite',
+                        help="reuse and checkpoint per-detector scores in this SQLite store")
+    parser.add_argument('--results', metavar='DIR',
+                        help="columnar results directory (default: detection_results; "
+                             "streaming mode writes one only when this is given)")
+    parser.add_argument('--scores', metavar='SCORES.npz',
+                        help="where to save the raw detector-score matrix for offline re-scoring (default: "
+                             "detection_scores.npz; streaming mode only collects one when this is given, since "
+                             "it holds every case's scores in memory)")
+    parser.add_argument('--rewrite-rules', metavar='PATH',
+                        help="file of 'pattern => replacement' lines for rule-based correction, "
+                             "replacing the built-in table")
+    parser.add_argument('--evidence-index', metavar='DIR', default=DEFAULT_INDEX_DIR,
+                        help="persisted vector index that RAG correction retrieves evidence from")
+    parser.add_argument('--profile', metavar='PROFILE.json',
+                        help="record per-stage wall/CPU time, batch sizes and memory; write the summary here")
+    parser.add_argument('--trace', metavar='TRACE.json',
+                        help="also write the recorded stage spans as a Chrome trace")
+    parser.add_argument('--log-level', choices=['WARNING', 'INFO', 'DEBUG'], default='WARNING',
+                        help="INFO logs model loading and progress, DEBUG every detector score of every case")
+    args = parser.parse_args(argv)
+    
+    logging.basicConfig(format='%(message)s')
+    logger.setLevel(args.log_level)
+    profiler = StageProfiler(enabled=bool(args.profile or args.trace))
+    
+    print("=" * 80)
+    print("HALLUCINATION DETECTION & CORRECTION IN HEALTHCARE LLMs")
+    print("=" * 80)
+    
+    if args.input:
+        return main_streaming(args, profiler)
+    
+    print("\n[1] Loading Healthcare Dataset...")
+    medical_dataset = get_dataset()
+    dataset_stats = get_dataset_statistics()
+    
+    print(f"✓ Loaded {dataset_stats['total']} medical cases")
+    print(f"  - Non-hallucinated: {dataset_stats['factual']}")
+    print(f"  - Hallucinated: {dataset_stats['hallucinated']}")
+    
+    print("\n[2] Initializing Detection Methods...")
+    detector_kwargs = detector_args(args)
+    embedding_cache = open_embedding_cache(args.backend)
+    detector = HallucinationDetector(embedding_cache=embedding_cache, profiler=profiler, **detector_kwargs)
+    print("✓ Detection methods initialized (models load on first use)")
+    
+    print("\n[3] Setting up Correction Strategies...")
+    # The evidence index is only opened if a case comes without evidence
+    corrector = HallucinationCorrector([d['evidence'] for d in medical_dataset], profiler=profiler,
+                                       rewrite_rules_path=args.rewrite_rules,
+                                       open_index=lambda: open_evidence_index(
+                                           args.evidence_index, args.backend, args.onnx_dir,
+                                           load_encoder=lambda: detector.similarity_model))
+    print("✓ Correction strategies ready")
+    
+    print("\n[4] Running Detection & Evaluation...")
+    print("-" * 80)
+    store = ResultStore(args.checkpoint) if args.checkpoint else None
+    pool = open_detection_pool(args, detector_kwargs, detector, profiler)
+    try:
+        results, all_predictions, all_labels = run_evaluation(detector, corrector, medical_dataset,
+                                                              cascade=args.cascade, store=store,
+                                                              chunk_size=args.chunk_size, pool=pool)
+    finally:
+        if pool is not None:
+            pool.close()
+    metrics = compute_metrics(all_labels, all_predictions)
+    print_metrics(metrics)
+    
+    # Cache and rule counters live in whichever process did the scoring
+    if args.workers <= 1:
+        cache_stats = embedding_cache.stats()
+        print(f"\nEmbedding Cache:")
+        print(f"  Hits (memory/disk): {cache_stats['memory_hits']}/{cache_stats['disk_hits']}")
+        print(f"  Misses:             {cache_stats['misses']}")
+        print(f"  Hit rate:           {cache_stats['hit_rate']:.1%}")
+        
+        rule_stats = detector.rule_engine.stats()
+        print(f"\nMedical Rules ({rule_stats['rules']} rules, {rule_stats['eval_time_sec'] * 1000:.1f} ms total):")
+        for rule_id, hits in sorted(rule_stats['hits'].items(), key=lambda kv: -kv[1]):
+            print(f"  {rule_id:<28} {hits} hits / {rule_stats['evaluations'][rule_id]} evaluated")
+    
+    if args.cascade:
+        print(f"\nCascade (stages skipped per {len(medical_dataset)} cases):")
+        for name in detector.METHODS:
+            print(f"  {name:<14} {detector.skipped_stages[name]}")
+    
+    if store is not None:
+        print_store_stats(store)
+    
+    if detector.claim_stats:
+        print_claim_stats(detector.claim_stats)
+    
+    if detector.dedup_stats['rows']:
+        print_dedup_stats(detector.dedup_stats)
+    
+    model_memory = detector.registry.memory_report()
+    if model_memory:
+        print_model_memory(model_memory)
+    
+    print_case_analysis(results)
+    score_matrix = ScoreMatrix.from_results(results, detector.DEFAULT_WEIGHTS, detector.thresholds())
+    with profiler.span('save_results', len(results)):
+        save_results(metrics, results, len(medical_dataset), score_matrix, args.scores or 'detection_scores.npz',
+                     args.results or 'detection_results')
+    
+    if profiler.enabled:
+        save_profile(profiler, args.profile, args.trace)
+    
+    print("\n" + "=" * 80)
+    print("EXECUTION COMPLETE")
+    print("=" * 80)
+    print("\nNext Steps:")
+    print("  1. Run analyze_results.py for a breakdown of the results")
+    print("  2. Read evaluation_report.txt for summary metrics")
+    print("  3. Check final_report.md for comprehensive documentation")
+    print("=" * 80)
+
+
+
+def open_detection_pool(args, detector_kwargs, detector, profiler):
+    """DetectionPool for --workers > 1 (None otherwise); its dedup counts go to detector.dedup_stats"""
+    if args.workers <= 1:
+        return None
+    print(f"  → Sharding detection across {args.workers} worker processes...")
+    return DetectionPool(workers=args.workers, torch_threads=args.torch_threads, detector_kwargs=detector_kwargs,
+                         profiler=profiler, share_models=args.share_models, dedup_stats=detector.dedup_stats)
+
+
+def main_streaming(args, profiler):
+    """Streaming variant of main(): JSONL in, JSONL out, constant memory"""
+    print(f"\n[1] Streaming cases from {args.input} (chunks of {args.chunk_size})...")
+    
+    print("\n[2] Initializing Detection Methods...")
+    detector_kwargs = detector_args(args)
+    embedding_cache = open_embedding_cache(args.backend)
+    detector = HallucinationDetector(embedding_cache=embedding_cache, profiler=profiler, **detector_kwargs)
+    # Evidence travels with each case, so no evidence database is held in memory; retrieval uses
+    # whatever the persisted evidence index already holds
+    corrector = HallucinationCorrector([], profiler=profiler, rewrite_rules_path=args.rewrite_rules,
+                                       open_index=lambda: open_evidence_index(
+                                           args.evidence_index, args.backend, args.onnx_dir,
+                                           load_encoder=lambda: detector.similarity_model))
+    
+    print("\n[3] Running Detection & Evaluation...")
+    print("-" * 80)
+    store = ResultStore(args.checkpoint) if args.checkpoint else None
+    pool = open_detection_pool(args, detector_kwargs, detector, profiler)
+    try:
+        metrics = run_streaming_evaluation(detector, corrector, iter_jsonl_dataset(args.input), args.output,
+                                           chunk_size=args.chunk_size, cascade=args.cascade, store=store,
+                                           scores_path=args.scores, results_path=args.results, pool=pool)
+    finally:
+        if pool is not None:
+            pool.close()
+    if metrics.total:
+        print_metrics(metrics.to_dict())
+    if metrics.unlabeled:
+        print(f"\n  {metrics.unlabeled} unlabeled cases scored (not included in metrics)")
+    if store is not None:
+        print_store_stats(store)
+    if detector.claim_stats:
+        print_claim_stats(detector.claim_stats)
+    if detector.dedup_stats['rows']:
+        print_dedup_stats(detector.dedup_stats)
+    if profiler.enabled:
+        save_profile(profiler, args.profile, args.trace)
+    
+    print("\n" + "=" * 80)
+    print("EXECUTION COMPLETE")
+    print("=" * 80)
+    print(f"\nResults streamed to {args.output}")
+    print("=" * 80)
+
+
+if __name__ == "__main__":
+    main()
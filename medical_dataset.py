@@ -3,6 +3,8 @@ Medical Dataset for Hallucination Detection
 Contains labeled medical cases with queries, LLM outputs, evidence, and categories
 """
 
+import json
+
 # Comprehensive Medical Dataset
 # Labels: 0 = Non-Hallucinated (Factual), 1 = Hallucinated
 medical_dataset = [
@@ -421,6 +423,28 @@ def get_dataset():
     return medical_dataset
 
 
+def iter_jsonl_dataset(path):
+    """Lazily yield cases from a JSONL file (one case object per line)
+
+    A case without an 'evidence' field gets an empty one; RAG correction then
+    retrieves evidence for it from the evidence index.
+    """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                case = json.loads(line)
+                if isinstance(case, dict):
+                    case['evidence'] = case.get('evidence') or ''
+                yield case
+
+
+def write_dataset_jsonl(path, dataset=None):
+    """Write cases (default: the built-in dataset) as JSONL for streaming runs"""
+    with open(path, 'w', encoding='utf-8') as f:
+        for item in (medical_dataset if dataset is None else dataset):
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+
 def get_dataset_statistics():
     """Return statistics about the dataset"""
     total = len(medical_dataset)
@@ -0,0 +1,219 @@
+"""
+Declarative Medical Safety Rule Engine
+Loads safety rules from a JSON file and indexes them by query trigger keyword,
+so only the rules whose triggers appear in a query are evaluated
+
+Rule format (see medical_rules.json):
+  id          - violation name reported by the detector
+  triggers    - query keywords; the rule is a candidate if any one appears
+  query_all   - further keywords that must all appear in the query
+  when        - list of output clauses; the rule fires if any clause holds.
+                A clause holds when all of its conditions hold:
+                  output_any     at least one term appears in the output
+                  output_all     every term appears in the output
+                  output_none    no term appears in the output
+                  dose_above_mg  a dose stated in the output exceeds this limit
+                  unitless_dose_above  a dose stated without a unit, i.e. a bare
+                                 number in dosing context ("6000 per day",
+                                 "a dose of 6000"), exceeds this limit
+All keyword checks are case-insensitive substring matches.
+"""
+
+import os
+import re
+import json
+import time
+from collections import Counter
+
+from text_patterns import trie_pattern
+
+DEFAULT_RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'medical_rules.json')
+
+# "8000mg", "4,000 mg", "1.5 g", "500 milligrams"
+DOSE_PATTERN = re.compile(r'(\d{1,3}(?:,\d{3})+|\d+(?:\.\d+)?)\s*(mg|milligrams?|g|grams?)\b', re.IGNORECASE)
+
+# Whole numbers ("6000", "4,000", "1.5")
+NUMBER_PATTERN = re.compile(r'(?<![\d.,])(\d{1,3}(?:,\d{3})+|\d+(?:\.\d+)?)(?!\d|[.,]\d)')
+# Dosing context right after a number ("6000 per day", "6000 daily", "6000/day") ...
+DOSING_AFTER = re.compile(r'\s*(?:(?:per|a|each|every|/)\s*(?:day|24\s*h(?:ours?)?)|daily|tablets?)\b',
+                          re.IGNORECASE)
+# ... or right before a number that ends its phrase ("take 6000.", "the maximum dose is 6000,")
+DOSING_BEFORE = re.compile(r'(?:\bdos(?:e|es|age|ing)|\btake|\btaking|\bup to|\bmaximum|\bmax)\b[^\d.;:]{0,15}$',
+                           re.IGNORECASE)
+PHRASE_END = re.compile(r'\s*(?:[.,;:!?)]|$)')
+# A number followed by one of these is an amount of something else, not a unitless dose
+OTHER_UNIT_PATTERN = re.compile(r'\s*(?:mcg|micrograms?|µg|kg|kilograms?|ml|milliliters?|millilitres?|l|liters?|litres?'
+                                r'|iu|units?)\b|\s*%', re.IGNORECASE)
+
+
+def parse_doses_mg(text):
+    """All doses stated in text, converted to milligrams"""
+    doses = []
+    for amount, unit in DOSE_PATTERN.findall(text):
+        value = float(amount.replace(',', ''))
+        doses.append(value if unit.lower().startswith('m') else value * 1000)
+    return doses
+
+
+def parse_unitless_doses(text):
+    """Numbers stated without a unit but in dosing context ("6000 per day"); other numbers
+    (years, phone numbers, study sizes, prices) are not doses"""
+    doses = []
+    for m in NUMBER_PATTERN.finditer(text):
+        if DOSE_PATTERN.match(text, m.start()) or OTHER_UNIT_PATTERN.match(text, m.end()):
+            continue
+        if DOSING_AFTER.match(text, m.end()) or (PHRASE_END.match(text, m.end()) and
+                                                 DOSING_BEFORE.search(text[max(0, m.start() - 40):m.start()])):
+            doses.append(float(m.group(1).replace(',', '')))
+    return doses
+
+
+class MedicalRule:
+    """One compiled rule: lower-cased term tuples and clause predicates"""
+
+    def __init__(self, spec, order):
+        self.id = spec['id']
+        self.description = spec.get('description', '')
+        self.order = order
+        self.triggers = tuple(t.lower() for t in spec['triggers'])
+        self.query_all = tuple(t.lower() for t in spec.get('query_all', []))
+        self.clauses = [
+            (
+                tuple(t.lower() for t in clause.get('output_any', [])),
+                tuple(t.lower() for t in clause.get('output_all', [])),
+                tuple(t.lower() for t in clause.get('output_none', [])),
+                clause.get('dose_above_mg'),
+                clause.get('unitless_dose_above')
+            )
+            for clause in spec.get('when', [{}])
+        ]
+
+    def matches(self, q, r, numbers):
+        """q and r are the lower-cased query and output; numbers(kind) lazily parses 'doses' or 'unitless' doses"""
+        if not all(term in q for term in self.query_all):
+            return False
+        for output_any, output_all, output_none, dose_limit, unitless_limit in self.clauses:
+            if output_any and not any(term in r for term in output_any):
+                continue
+            if not all(term in r for term in output_all):
+                continue
+            if any(term in r for term in output_none):
+                continue
+            if dose_limit is not None and not any(dose > dose_limit for dose in numbers('doses')):
+                continue
+            if unitless_limit is not None and not any(dose > unitless_limit for dose in numbers('unitless')):
+                continue
+            return True
+        return False
+
+
+class MedicalRuleEngine:
+    """Trigger-indexed evaluation of declarative medical safety rules"""
+
+    def __init__(self, rule_specs):
+        self.specs = rule_specs
+        self.rules = [MedicalRule(spec, i) for i, spec in enumerate(rule_specs)]
+
+        # Trigger keyword -> rules, plus every trigger implied by a longer one
+        # (a hit on "pregnancy" is also a hit on "pregnan" if both are triggers)
+        self.index = {}
+        for rule in self.rules:
+            for trigger in rule.triggers:
+                self.index.setdefault(trigger, []).append(rule)
+        self.implied = {t: [s for s in self.index if s in t] for t in self.index}
+
+        # Lookahead makes every start position a candidate, so overlapping triggers are all seen
+        self.trigger_regex = re.compile(f'(?=({trie_pattern(self.index)}))') if self.index else None
+
+        self.hits = Counter()
+        self.evaluations = Counter()
+        self.eval_time = 0.0
+        self.calls = 0
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_RULES_PATH):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f)['rules'])
+
+    def candidate_rules(self, q):
+        """Rules with at least one trigger in the lower-cased query, in file order"""
+        if self.trigger_regex is None:
+            return []
+        found = set()
+        for m in self.trigger_regex.finditer(q):
+            found.update(self.implied[m.group(1)])
+        candidates = {rule.order: rule for trigger in found for rule in self.index[trigger]}
+        return [candidates[order] for order in sorted(candidates)]
+
+    def evaluate(self, query, output):
+        """Return the ids of the rules violated by output for query"""
+        start = time.perf_counter()
+        q = query.lower()
+        r = output.lower()
+
+        parsed = {}
+
+        def numbers(kind):
+            if kind not in parsed:
+                parsed[kind] = parse_doses_mg(r) if kind == 'doses' else parse_unitless_doses(r)
+            return parsed[kind]
+
+        violations = []
+        for rule in self.candidate_rules(q):
+            self.evaluations[rule.id] += 1
+            if rule.matches(q, r, numbers):
+                self.hits[rule.id] += 1
+                violations.append(rule.id)
+
+        self.eval_time += time.perf_counter() - start
+        self.calls += 1
+        return violations
+
+    def stats(self):
+        """Per-rule hit/evaluation counts and total evaluation time"""
+        return {
+            'rules': len(self.rules),
+            'calls': self.calls,
+            'eval_time_sec': self.eval_time,
+            'hits': dict(self.hits),
+            'evaluations': dict(self.evaluations)
+        }
+
+
+# Paracetamol answers and whether the daily-dose rule must flag them: unitless overdoses
+# are caught, numbers that are not doses (years, phone numbers, study sizes, prices) are not
+UNITLESS_DOSE_EXAMPLES = [
+    ("Take 6000 per day.", True),
+    ("Up to 6,000 daily is fine.", True),
+    ("6000 a day", True),
+    ("6000/day", True),
+    ("The maximum dose is 6000.", True),
+    ("You can take 5000, it is safe.", True),
+    ("Adults may take 8000mg daily.", True),
+    ("Adults: 1000 mg every 6 hours, max 4000 mg/day.", False),
+    ("In 2024 guidance, take 1000 mg up to 4 times daily.", False),
+    ("Call 1-800-555-0199 or 18005550199 for advice.", False),
+    ("A 2019 study of 10000 patients found paracetamol safe at 1 g.", False),
+    ("Up to 5000 people a year are treated for overdose.", False),
+    ("A pack costs 5000 rupees.", False),
+    ("Take 6000 mcg per day.", False),
+]
+
+
+def check_unitless_doses(engine=None):
+    """UNITLESS_DOSE_EXAMPLES the paracetamol rule gets wrong; an empty list means all pass"""
+    engine = engine or MedicalRuleEngine.from_file()
+    query = "What is the maximum daily dose of paracetamol?"
+    return [(output, expected) for output, expected in UNITLESS_DOSE_EXAMPLES
+            if ('excessive_paracetamol_dose' in engine.evaluate(query, output)) != expected]
+
+
+if __name__ == "__main__":
+    import sys
+
+    # Usage: python medical_rules.py  - check the unitless-dose examples against medical_rules.json
+    failures = check_unitless_doses()
+    print(f"Unitless dose examples: {len(UNITLESS_DOSE_EXAMPLES) - len(failures)}/{len(UNITLESS_DOSE_EXAMPLES)} pass")
+    for output, expected in failures:
+        print(f"  expected {'flag' if expected else 'no flag'}: {output}")
+    sys.exit(1 if failures else 0)
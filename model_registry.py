@@ -0,0 +1,128 @@
+"""
+Shared Model Registry
+Loads each model once per process and hands out shared references, so that
+several detectors (different configurations, the service, benchmark runs)
+do not each hold a copy of the weights, and prepares the loaded models to be
+shared copy-on-write with forked workers; reports the memory held by every model
+"""
+
+import gc
+import os
+import sys
+import time
+import threading
+
+from instrumentation import memory_mb
+
+
+def torch_module(model):
+    """The torch.nn.Module holding a model's weights (itself, or a pipeline's/scorer's .model), or None"""
+    # A model can only be a torch module if torch is already imported; never import it just to check
+    torch = sys.modules.get('torch')
+    if torch is None:
+        return None
+    for candidate in (model, getattr(model, 'model', None)):
+        if isinstance(candidate, torch.nn.Module):
+            return candidate
+    return None
+
+
+def weights_mb(model):
+    """Size of a model's weights in MB: torch parameters and buffers, or the ONNX graph file"""
+    module = torch_module(model)
+    if module is not None:
+        tensors = list(module.parameters()) + list(module.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors) / 1e6
+    onnx = getattr(model, 'onnx', None) or getattr(getattr(model, 'scorer', None), 'onnx', None)
+    if onnx is not None:
+        return os.path.getsize(onnx.model_file) / 1e6
+    return None
+
+
+def process_memory_mb():
+    """Resident (RSS), proportional (PSS) and shared memory of this process in MB
+
+    PSS splits each shared page among the processes mapping it, so the PSS of
+    forked workers that share weights sums to the real memory footprint.
+    """
+    memory = {'rss': memory_mb()[0], 'pss': None, 'shared': None}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line and not line.startswith(' '))
+    except OSError:
+        return memory
+    kb = {name: int(value.split()[0]) for name, value in fields.items() if value.strip().endswith('kB')}
+    memory['pss'] = kb.get('Pss', 0) / 1024
+    memory['shared'] = (kb.get('Shared_Clean', 0) + kb.get('Shared_Dirty', 0)) / 1024
+    return memory
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded models keyed by kind, model name and loader options
+
+    get() loads a model on its first request and returns the same object to
+    every later caller; loads are serialized by a lock, so concurrent first
+    requests (e.g. from service threads) never load a model twice.
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._info = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind, model_name, loader, **options):
+        """The shared model for (kind, model_name, options), loaded with loader(model_name, **options) if new"""
+        key = (kind, model_name, tuple(sorted(options.items())))
+        with self._lock:
+            if key not in self._models:
+                rss_before, _ = memory_mb()
+                start = time.perf_counter()
+                self._models[key] = loader(model_name, **options)
+                self._info[key] = {
+                    'kind': kind,
+                    'model': model_name,
+                    **options,
+                    'load_sec': time.perf_counter() - start,
+                    'rss_growth_mb': memory_mb()[0] - rss_before,
+                    'shared_memory': False
+                }
+            return self._models[key]
+
+    def __len__(self):
+        return len(self._models)
+
+    def clear(self):
+        """Drop every reference held by the registry (detectors keep the models they already have)"""
+        with self._lock:
+            self._models.clear()
+            self._info.clear()
+
+    def share_memory(self):
+        """Prepare the loaded models for fork-based workers
+
+        Torch weights move into shared memory, so forked children map the
+        parent's pages and writes never copy them, and gc.freeze() keeps the
+        garbage collector from touching (and so copying) the pages of every
+        object loaded so far. ONNX sessions are shared copy-on-write as is.
+        Call after loading and before forking; run no inference in the parent
+        before the fork, since intra-op thread pools do not survive it.
+        """
+        with self._lock:
+            for key, model in self._models.items():
+                module = torch_module(model)
+                if module is not None:
+                    module.share_memory()
+                    self._info[key]['shared_memory'] = True
+        gc.freeze()
+
+    def memory_report(self):
+        """Per model: kind, name, loader options, weight size, RSS growth while loading, load time"""
+        with self._lock:
+            return [
+                {**self._info[key], 'weights_mb': weights_mb(model)}
+                for key, model in self._models.items()
+            ]
+
+
+# Registry used by HallucinationDetector unless one is passed in
+MODEL_REGISTRY = ModelRegistry()
@@ -0,0 +1,219 @@
+"""
+Pluggable NLI Models for the Entailment Detector
+Presets for smaller distilled NLI cross-encoders, a per-model mapping of
+class labels onto entailment / neutral / contradiction, and a benchmark mode
+that compares latency, memory and precision/recall of NLI models on the
+medical dataset
+
+Usage:
+    python main.py --nli-model minilm
+    python main.py --nli-model ./models/my-nli --nli-labels contradiction,entailment,neutral
+    python nli_models.py --models bart-large-mnli,deberta-v3-small,minilm
+"""
+
+import json
+import time
+import argparse
+
+import numpy as np
+
+from onnx_backend import BACKENDS, DEFAULT_ONNX_DIR, run_in_fresh_process, peak_rss_mb
+
+# Preset name -> hub id and the label of each class index (from the model cards)
+NLI_PRESETS = {
+    'bart-large-mnli': {
+        'model': 'facebook/bart-large-mnli',
+        'labels': ['contradiction', 'neutral', 'entailment']
+    },
+    'deberta-v3-small': {
+        'model': 'cross-encoder/nli-deberta-v3-small',
+        'labels': ['contradiction', 'entailment', 'neutral']
+    },
+    'distilroberta': {
+        'model': 'cross-encoder/nli-distilroberta-base',
+        'labels': ['contradiction', 'entailment', 'neutral']
+    },
+    'minilm': {
+        'model': 'cross-encoder/nli-MiniLM2-L6-H768',
+        'labels': ['contradiction', 'entailment', 'neutral']
+    }
+}
+DEFAULT_NLI_PRESET = 'bart-large-mnli'
+
+# Label spellings found in model configs -> canonical NLI label
+NLI_LABEL_ALIASES = {
+    'entailment': 'entailment', 'entails': 'entailment', 'entail': 'entailment',
+    'neutral': 'neutral',
+    'contradiction': 'contradiction', 'contradicts': 'contradiction', 'contradict': 'contradiction',
+    'not_entailment': 'not_entailment', 'non_entailment': 'not_entailment'
+}
+
+
+def resolve_nli_model(spec, labels=None):
+    """(model name, per-index labels or None) for a preset name, hub id or local path
+
+    labels (a list or a comma-separated string) overrides the preset's mapping.
+    """
+    if isinstance(labels, str):
+        labels = [label.strip().lower() for label in labels.split(',')]
+    preset = NLI_PRESETS.get(spec)
+    if preset is not None:
+        return preset['model'], labels or preset['labels']
+    return spec, labels
+
+
+def model_id2label(model):
+    """Class index -> raw label of a loaded NLI model (pipeline or ONNX stand-in), if known"""
+    id2label = getattr(model, 'id2label', None)
+    if id2label is None:
+        config = getattr(getattr(model, 'model', None), 'config', None)
+        id2label = getattr(config, 'id2label', None)
+    return {int(i): label for i, label in id2label.items()} if id2label else None
+
+
+def nli_label_map(id2label, labels=None):
+    """Raw (lower-cased) model label -> canonical NLI label
+
+    With labels, class index i is mapped to labels[i]; otherwise the model's
+    own label names are canonicalized. Models whose labels are only generic
+    ("LABEL_0", ...) need explicit labels.
+    """
+    if id2label is None:
+        # Model without a config (e.g. injected): its labels are taken as given
+        return {}
+    if labels is not None:
+        if len(labels) != len(id2label):
+            raise ValueError(f"{len(labels)} NLI labels given for a model with {len(id2label)} classes")
+        unknown = [label for label in labels if label not in NLI_LABEL_ALIASES]
+        if unknown:
+            raise ValueError(f"Unknown NLI labels {unknown}; use {sorted(set(NLI_LABEL_ALIASES.values()))}")
+        return {id2label[i].lower(): NLI_LABEL_ALIASES[labels[i]] for i in sorted(id2label)}
+
+    mapping = {label.lower(): NLI_LABEL_ALIASES.get(label.lower()) for label in id2label.values()}
+    if 'entailment' not in mapping.values():
+        raise ValueError(
+            f"Cannot tell which class is entailment from the model labels {list(id2label.values())}; "
+            f"pass the label of each class index (e.g. --nli-labels contradiction,entailment,neutral)"
+        )
+    return {raw: canonical for raw, canonical in mapping.items() if canonical is not None}
+
+
+# ============================================================================
+# BENCHMARK
+# ============================================================================
+
+def _benchmark_model(model_name, labels, backend, onnx_dir, cases, detector_kwargs):
+    """Load time, NLI latency, peak RSS and (pred, p_entailment) per case; runs in a fresh process"""
+    from main import HallucinationDetector
+
+    detector = HallucinationDetector(backend=backend, onnx_dir=onnx_dir,
+                                     **{**detector_kwargs, 'nli_model_name': model_name, 'nli_labels': labels})
+    start = time.perf_counter()
+    detector.nli_label_map
+    load_time = time.perf_counter() - start
+
+    pairs = [(item['evidence'], item['llm_output']) for item in cases]
+    # One warm-up batch so lazy allocations are not billed to the first cases
+    detector.detect_via_entailment_batch(pairs[:2])
+    start = time.perf_counter()
+    results = detector.detect_via_entailment_batch(pairs)
+    elapsed = time.perf_counter() - start
+    return results, load_time, elapsed, peak_rss_mb()
+
+
+def _other_stage_scores(backend, onnx_dir, cases, detector_kwargs):
+    """Ensemble results with the entailment stage skipped (zero weight), for swapping NLI scores in"""
+    from main import HallucinationDetector
+
+    detector = HallucinationDetector(backend=backend, onnx_dir=onnx_dir, **detector_kwargs)
+    weights = [0.0] + list(detector.DEFAULT_WEIGHTS[1:])
+    detections = detector.ensemble_detection_batch(
+        [item['query'] for item in cases],
+        [item['evidence'] for item in cases],
+        [item['llm_output'] for item in cases],
+        weights=weights
+    )
+    return [
+        {'id': item['id'], 'actual': item['label'], 'prediction': prediction, 'method_scores': method_scores}
+        for item, (prediction, _, method_scores) in zip(cases, detections)
+    ], detector.DEFAULT_WEIGHTS, detector.thresholds()
+
+
+def benchmark_nli_models(specs, backend='torch', onnx_dir=DEFAULT_ONNX_DIR, cases=None, labels=None,
+                         detector_kwargs=None):
+    """Compare NLI models on the labeled cases
+
+    Each model runs alone in a fresh process (so load time and peak memory are
+    its own). The other four detectors run once; each model's entailment
+    scores are then slotted into the score matrix to get ensemble metrics
+    without re-running them. detector_kwargs go to every HallucinationDetector.
+    """
+    from score_matrix import ScoreMatrix, classification_metrics
+
+    detector_kwargs = detector_kwargs or {}
+    if cases is None:
+        from medical_dataset import get_dataset
+        cases = get_dataset()
+
+    records, weights, thresholds = run_in_fresh_process(_other_stage_scores, backend, onnx_dir, cases,
+                                                          detector_kwargs)
+    matrix = ScoreMatrix.from_results(records, weights, thresholds)
+    y = matrix.labels
+
+    report = []
+    for spec in specs:
+        model_name, model_labels = resolve_nli_model(spec, None if spec in NLI_PRESETS else labels)
+        print(f"  → Benchmarking {spec} ({model_name})...")
+        results, load_time, elapsed, rss = run_in_fresh_process(
+            _benchmark_model, model_name, model_labels, backend, onnx_dir, cases, detector_kwargs)
+
+        preds = np.array([pred for pred, _ in results], dtype=np.int8)
+        matrix.scores[:, 0] = [score for _, score in results]
+        ensemble_preds, _ = matrix.rescore()
+        report.append({
+            'model': spec,
+            'model_name': model_name,
+            'backend': backend,
+            'load_time_sec': load_time,
+            'latency_ms_per_case': elapsed / len(cases) * 1000,
+            'peak_rss_mb': rss,
+            'nli_only': classification_metrics(y, preds),
+            'ensemble': classification_metrics(y, ensemble_preds)
+        })
+    return report
+
+
+def print_benchmark(report, n_cases):
+    print(f"\nNLI models on {n_cases} cases")
+    print(f"  {'Model':<18} {'Load s':>7} {'ms/case':>8} {'Peak MB':>8} | "
+          f"{'NLI P':>6} {'NLI R':>6} {'NLI F1':>6} | {'Ens P':>6} {'Ens R':>6} {'Ens F1':>6}")
+    for r in report:
+        nli, ens = r['nli_only'], r['ensemble']
+        print(f"  {r['model'][:18]:<18} {r['load_time_sec']:>7.1f} {r['latency_ms_per_case']:>8.1f} "
+              f"{r['peak_rss_mb']:>8.0f} | {nli['precision']:>6.3f} {nli['recall']:>6.3f} {nli['f1_score']:>6.3f} | "
+              f"{ens['precision']:>6.3f} {ens['recall']:>6.3f} {ens['f1_score']:>6.3f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark NLI models for the entailment detector")
+    parser.add_argument('--models', default=','.join(NLI_PRESETS),
+                        help="comma-separated presets, hub ids or local paths "
+                             f"(presets: {', '.join(NLI_PRESETS)})")
+    parser.add_argument('--nli-labels', help="label of each class index, applied to every non-preset model")
+    parser.add_argument('--backend', choices=BACKENDS, default='torch')
+    parser.add_argument('--onnx-dir', default=DEFAULT_ONNX_DIR)
+    parser.add_argument('--output', help="also write the report as JSON")
+    args = parser.parse_args(argv)
+
+    from medical_dataset import get_dataset
+    cases = get_dataset()
+    report = benchmark_nli_models([m.strip() for m in args.models.split(',') if m.strip()], args.backend,
+                                  args.onnx_dir, cases, args.nli_labels)
+    print_benchmark(report, len(cases))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,428 @@
+"""
+ONNX Runtime Inference Backend
+Exports the three transformer detectors (BART-MNLI, MiniLM, ms-marco
+cross-encoder) to ONNX, applies dynamic INT8 quantization, and serves them
+through onnxruntime behind the same scoring API as the PyTorch models:
+an NLI callable shaped like the transformers pipeline, an encoder with
+SentenceTransformer.encode(), and a PairScorer for the cross-encoder
+
+Usage:
+    python onnx_backend.py export --output-dir onnx_models
+    python onnx_backend.py parity --backend onnx-int8 --model-dir onnx_models
+
+Requires the optional packages onnxruntime and onnx (export also needs torch).
+"""
+
+import os
+import json
+import time
+import argparse
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from scorers import PairScorer, PairClassificationPipeline
+
+BACKENDS = ('torch', 'onnx', 'onnx-int8')
+DEFAULT_ONNX_DIR = 'onnx_models'
+METADATA_FILE = 'onnx_config.json'
+FP32_FILE = 'model.onnx'
+INT8_FILE = 'model.int8.onnx'
+
+
+def onnx_model_dir(root, model_name):
+    """Export directory of one model under root"""
+    return os.path.join(root, model_name.replace('/', '__'))
+
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+def _traceable(model, kind, input_names):
+    """torch.nn.Module around model taking the tokenizer outputs positionally and returning one tensor"""
+    import torch
+
+    class Traceable(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *tensors):
+            features = dict(zip(input_names, tensors))
+            if kind == 'sentence-embedding':
+                return self.model(dict(features))['sentence_embedding']
+            return self.model(**features).logits
+
+    return Traceable().eval()
+
+
+def export_model(model_name, output_dir, kind, quantize=True, opset=17):
+    """Export one model to output_dir as model.onnx (+ model.int8.onnx)
+
+    kind is 'sequence-classification' (NLI, cross-encoder) or
+    'sentence-embedding' (SentenceTransformer, exported together with its
+    pooling and normalization so the graph returns the final embeddings).
+    """
+    import torch
+
+    os.makedirs(output_dir, exist_ok=True)
+    metadata = {'model_name': model_name, 'kind': kind}
+
+    if kind == 'sequence-classification':
+        from transformers import AutoTokenizer, AutoModelForSequenceClassification
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModelForSequenceClassification.from_pretrained(model_name).eval()
+        # Two pairs of different lengths so padding is part of the traced graph
+        features = tokenizer(['Evidence sentence one.', 'A second, longer evidence sentence here.'],
+                             ['Output one.', 'Output two is somewhat longer.'], padding=True, return_tensors='pt')
+        metadata['max_length'] = min(tokenizer.model_max_length,
+                                     getattr(model.config, 'max_position_embeddings', 512))
+        metadata['id2label'] = {str(i): label for i, label in model.config.id2label.items()}
+        metadata['output'] = 'logits'
+    elif kind == 'sentence-embedding':
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(model_name, device='cpu').eval()
+        tokenizer = model.tokenizer
+        features = tokenizer(['A short sentence.', 'A second, somewhat longer sentence.'],
+                             padding=True, return_tensors='pt')
+        metadata['max_length'] = model.max_seq_length
+        metadata['output'] = 'sentence_embedding'
+    else:
+        raise ValueError(f"Unknown model kind: {kind}")
+
+    if not tokenizer.is_fast:
+        raise ValueError(f"{model_name} has no fast tokenizer; the ONNX runtime reads tokenizer.json")
+    metadata['pad_token'] = tokenizer.pad_token
+    metadata['pad_token_id'] = tokenizer.pad_token_id
+    metadata['inputs'] = list(features)
+    path = os.path.join(output_dir, FP32_FILE)
+    with torch.inference_mode():
+        torch.onnx.export(
+            _traceable(model, kind, metadata['inputs']),
+            tuple(features[name] for name in metadata['inputs']),
+            path,
+            input_names=metadata['inputs'],
+            output_names=[metadata['output']],
+            dynamic_axes={
+                **{name: {0: 'batch', 1: 'sequence'} for name in metadata['inputs']},
+                metadata['output']: {0: 'batch'}
+            },
+            opset_version=opset,
+            dynamo=False
+        )
+    tokenizer.save_pretrained(output_dir)
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        # Dynamic quantization: INT8 weights, activations quantized per batch at run time
+        quantize_dynamic(path, os.path.join(output_dir, INT8_FILE), weight_type=QuantType.QInt8)
+
+    with open(os.path.join(output_dir, METADATA_FILE), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return output_dir
+
+
+# ============================================================================
+# RUNTIME
+# ============================================================================
+
+class FastTokenizer:
+    """tokenizer.json through the `tokenizers` library, called like a transformers tokenizer
+
+    Loading transformers pulls in torch, which alone costs several hundred MB
+    of resident memory; the ONNX runtime path avoids both.
+    """
+
+    def __init__(self, path, max_length, pad_token, pad_token_id):
+        from tokenizers import Tokenizer
+        self.tokenizer = Tokenizer.from_file(path)
+        self.tokenizer.enable_truncation(max_length, strategy='longest_first')
+        self.tokenizer.enable_padding(pad_id=pad_token_id, pad_token=pad_token)
+        self.pad_token_id = pad_token_id
+        # Same attributes as a transformers fast tokenizer, for scorers.PairEncoder
+        self.backend_tokenizer = self.tokenizer
+        self.model_input_names = ['input_ids', 'attention_mask', 'token_type_ids']
+
+    def __call__(self, texts, text_pairs=None, **kwargs):
+        """Padded, truncated numpy features; padding/truncation are fixed at load time"""
+        inputs = list(zip(texts, text_pairs)) if text_pairs is not None else list(texts)
+        encodings = self.tokenizer.encode_batch(inputs)
+        return {
+            'input_ids': np.array([e.ids for e in encodings], dtype=np.int64),
+            'attention_mask': np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            'token_type_ids': np.array([e.type_ids for e in encodings], dtype=np.int64)
+        }
+
+
+class OnnxModel:
+    """onnxruntime session plus tokenizer and metadata of one exported model"""
+
+    def __init__(self, model_dir, quantized=True, threads=None):
+        import onnxruntime as ort
+
+        metadata_path = os.path.join(model_dir, METADATA_FILE)
+        if not os.path.exists(metadata_path):
+            raise FileNotFoundError(
+                f"No exported ONNX model in {model_dir}; run: python onnx_backend.py export"
+            )
+        with open(metadata_path) as f:
+            self.metadata = json.load(f)
+        self.model_dir = model_dir
+        self.model_file = os.path.join(model_dir, INT8_FILE if quantized else FP32_FILE)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(self.model_file, options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.max_length = self.metadata['max_length']
+        self.tokenizer = FastTokenizer(os.path.join(model_dir, 'tokenizer.json'), self.max_length,
+                                       self.metadata['pad_token'], self.metadata['pad_token_id'])
+
+    def run(self, features):
+        """Run the graph on tokenizer output (numpy tensors)"""
+        feed = {name: features[name] for name in self.input_names}
+        return self.session.run(None, feed)[0]
+
+
+class OnnxPairScorer(PairScorer):
+    """PairScorer over an exported sequence-classification model
+
+    Drop-in for scorers.CrossEncoderScorer (logits/score).
+    """
+
+    def __init__(self, model_dir, quantized=True, threads=None):
+        self.onnx = OnnxModel(model_dir, quantized=quantized, threads=threads)
+        self.model_name = self.onnx.metadata['model_name']
+        self.tokenizer = self.onnx.tokenizer
+        self.max_length = self.onnx.max_length
+        self.id2label = {int(i): label for i, label in self.onnx.metadata['id2label'].items()}
+        self.num_labels = len(self.id2label)
+
+    def _forward(self, features):
+        return self.onnx.run(features).astype(np.float32)
+
+
+class OnnxNLIPipeline(PairClassificationPipeline):
+    """Stands in for the transformers text-classification pipeline used by nli_batch"""
+
+    def __init__(self, model_dir, quantized=True, threads=None):
+        super().__init__(OnnxPairScorer(model_dir, quantized=quantized, threads=threads))
+
+
+class OnnxSentenceEncoder:
+    """SentenceTransformer.encode() over an exported sentence-embedding model"""
+
+    def __init__(self, model_dir, quantized=True, threads=None):
+        self.onnx = OnnxModel(model_dir, quantized=quantized, threads=threads)
+        self.model_name = self.onnx.metadata['model_name']
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+
+        # Sort by length so each padded batch holds similarly sized texts
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+        embeddings = [None] * len(texts)
+        for start in range(0, len(order), batch_size):
+            idx = order[start:start + batch_size]
+            features = self.onnx.tokenizer([texts[i] for i in idx], padding=True, truncation=True,
+                                           max_length=self.onnx.max_length, return_tensors='np')
+            for i, vector in zip(idx, self.onnx.run(features)):
+                embeddings[i] = vector
+        embeddings = np.stack(embeddings).astype(np.float32)
+        return embeddings[0] if single else embeddings
+
+
+def load_onnx_model(kind, model_name, backend, onnx_dir=DEFAULT_ONNX_DIR, threads=None):
+    """ONNX stand-in for one detector model: kind is 'nli', 'similarity' or 'domain'"""
+    model_dir = onnx_model_dir(onnx_dir, model_name)
+    quantized = backend == 'onnx-int8'
+    if kind == 'nli':
+        return OnnxNLIPipeline(model_dir, quantized=quantized, threads=threads)
+    if kind == 'similarity':
+        return OnnxSentenceEncoder(model_dir, quantized=quantized, threads=threads)
+    if kind == 'domain':
+        return OnnxPairScorer(model_dir, quantized=quantized, threads=threads)
+    raise ValueError(f"Unknown model kind: {kind}")
+
+
+# ============================================================================
+# PARITY CHECK
+# ============================================================================
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB"""
+    # VmHWM is reset by exec; ru_maxrss (KB on Linux) can carry over the parent's peak through fork
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _score_backend(backend, onnx_dir, cases, threads, detector_kwargs):
+    """Detector (pred, score) outputs, stage latency and peak RSS for one backend
+
+    Runs in its own process so the memory figure belongs to this backend only.
+    """
+    from main import HallucinationDetector
+
+    detector = HallucinationDetector(backend=backend, onnx_dir=onnx_dir, onnx_threads=threads, **detector_kwargs)
+    evidences = [item['evidence'] for item in cases]
+    outputs = [item['llm_output'] for item in cases]
+    stages = {
+        'entailment': lambda: detector.detect_via_entailment_batch(list(zip(evidences, outputs))),
+        'similarity': lambda: detector.detect_via_similarity_batch(evidences, outputs),
+        'domain': lambda: detector.detect_via_domain_classifier_batch(evidences, outputs)
+    }
+
+    start = time.perf_counter()
+    detector.nli_model, detector.similarity_model, detector.domain_classifier
+    load_time = time.perf_counter() - start
+
+    results, timings = {}, {}
+    for name, run in stages.items():
+        start = time.perf_counter()
+        results[name] = run()
+        timings[name] = time.perf_counter() - start
+
+    return results, timings, load_time, peak_rss_mb()
+
+
+def run_in_fresh_process(fn, *args):
+    """fn(*args) in a new spawned interpreter, so its load time and memory are measured in isolation"""
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(fn, *args).result()
+
+
+def parity_check(backend, onnx_dir=DEFAULT_ONNX_DIR, cases=None, threads=None, min_agreement=0.98,
+                 detector_kwargs=None):
+    """Compare an ONNX backend's detector scores and decisions against PyTorch
+
+    detector_kwargs go to both HallucinationDetectors (e.g. other model names).
+    Returns (report, passed); passed is False if any stage's decision agreement
+    falls below min_agreement.
+    """
+    detector_kwargs = detector_kwargs or {}
+    if cases is None:
+        from medical_dataset import get_dataset
+        cases = get_dataset()
+
+    reference, ref_timings, ref_load, ref_rss = run_in_fresh_process(
+        _score_backend, 'torch', onnx_dir, cases, threads, detector_kwargs)
+    candidate, timings, load, rss = run_in_fresh_process(
+        _score_backend, backend, onnx_dir, cases, threads, detector_kwargs)
+
+    report = {
+        'backend': backend,
+        'cases': len(cases),
+        'load_time_sec': {'torch': ref_load, backend: load},
+        'peak_rss_mb': {'torch': ref_rss, backend: rss},
+        'stages': {}
+    }
+    passed = True
+    for name in reference:
+        ref_preds, ref_scores = map(np.array, zip(*reference[name]))
+        preds, scores = map(np.array, zip(*candidate[name]))
+        agreement = float(np.mean(ref_preds == preds))
+        passed &= agreement >= min_agreement
+        report['stages'][name] = {
+            'decision_agreement': agreement,
+            'max_abs_score_diff': float(np.max(np.abs(ref_scores - scores))),
+            'mean_abs_score_diff': float(np.mean(np.abs(ref_scores - scores))),
+            'latency_ms_per_case': {
+                'torch': ref_timings[name] / len(cases) * 1000,
+                backend: timings[name] / len(cases) * 1000
+            }
+        }
+    return report, passed
+
+
+def print_parity_report(report, min_agreement):
+    backend = report['backend']
+    print(f"\nParity: {backend} vs torch on {report['cases']} cases")
+    print(f"  {'Stage':<12} {'Agreement':>9} {'Max |Δ|':>9} {'Mean |Δ|':>9} "
+          f"{'torch ms':>9} {backend + ' ms':>14} {'Speedup':>8}")
+    for name, stage in report['stages'].items():
+        latency = stage['latency_ms_per_case']
+        speedup = latency['torch'] / latency[backend] if latency[backend] else float('inf')
+        flag = '' if stage['decision_agreement'] >= min_agreement else '  ⚠'
+        print(f"  {name:<12} {stage['decision_agreement']:>9.1%} {stage['max_abs_score_diff']:>9.4f} "
+              f"{stage['mean_abs_score_diff']:>9.4f} {latency['torch']:>9.2f} {latency[backend]:>14.2f} "
+              f"{speedup:>7.1f}x{flag}")
+    print(f"  Model load:  torch {report['load_time_sec']['torch']:.1f}s, "
+          f"{backend} {report['load_time_sec'][backend]:.1f}s")
+    print(f"  Peak RSS:    torch {report['peak_rss_mb']['torch']:.0f} MB, "
+          f"{backend} {report['peak_rss_mb'][backend]:.0f} MB")
+
+
+def main(argv=None):
+    from main import NLI_MODEL_NAME, SIMILARITY_MODEL_NAME, DOMAIN_MODEL_NAME
+
+    parser = argparse.ArgumentParser(description="Export detector models to ONNX and check parity with PyTorch")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help="export (and INT8-quantize) the three transformer detectors")
+    export.add_argument('--output-dir', default=DEFAULT_ONNX_DIR)
+    export.add_argument('--no-quantize', action='store_true', help="skip the INT8 copy")
+    export.add_argument('--opset', type=int, default=17)
+    export.add_argument('--nli-model', default=NLI_MODEL_NAME,
+                        help="NLI preset, hub id or local path to export instead of BART-MNLI")
+
+    parity = commands.add_parser('parity', help="compare ONNX detector outputs against PyTorch")
+    parity.add_argument('--backend', choices=[b for b in BACKENDS if b != 'torch'], default='onnx-int8')
+    parity.add_argument('--model-dir', default=DEFAULT_ONNX_DIR)
+    parity.add_argument('--threads', type=int, help="intra-op threads for both backends")
+    parity.add_argument('--min-agreement', type=float, default=0.98,
+                        help="minimum per-stage decision agreement with PyTorch (exit 1 below it)")
+    parity.add_argument('--output', help="also write the report as JSON")
+    parity.add_argument('--nli-model', default=NLI_MODEL_NAME,
+                        help="NLI preset, hub id or local path to compare (the one given to export)")
+    parity.add_argument('--nli-labels', metavar='LABELS',
+                        help="label of each NLI class index, for models whose config only says LABEL_0, ...")
+    args = parser.parse_args(argv)
+
+    from nli_models import resolve_nli_model
+    if args.command == 'export':
+        models = [
+            (resolve_nli_model(args.nli_model)[0], 'sequence-classification'),
+            (SIMILARITY_MODEL_NAME, 'sentence-embedding'),
+            (DOMAIN_MODEL_NAME, 'sequence-classification')
+        ]
+        for model_name, kind in models:
+            print(f"Exporting {model_name} ({kind})...")
+            model_dir = export_model(model_name, onnx_model_dir(args.output_dir, model_name), kind,
+                                     quantize=not args.no_quantize, opset=args.opset)
+            for filename in (FP32_FILE, INT8_FILE):
+                path = os.path.join(model_dir, filename)
+                if os.path.exists(path):
+                    print(f"  ✓ {path} ({os.path.getsize(path) / 1e6:.0f} MB)")
+        return
+
+    nli_model_name, nli_labels = resolve_nli_model(args.nli_model, args.nli_labels)
+    report, passed = parity_check(args.backend, args.model_dir, threads=args.threads,
+                                  min_agreement=args.min_agreement,
+                                  detector_kwargs={'nli_model_name': nli_model_name, 'nli_labels': nli_labels})
+    print_parity_report(report, args.min_agreement)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if not passed:
+        print(f"\n✗ Decision agreement below {args.min_agreement:.0%} for at least one stage")
+        raise SystemExit(1)
+    print("\n✓ ONNX backend within parity tolerance")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Process-Pool Parallel Evaluation Runner
+Shards the dataset across worker processes; each worker loads the detection
+models once in its initializer (or, with share_models, inherits the parent's
+copy through fork) and scores whole shards through the batched ensemble, and
+shard results are merged back in the original order. A DetectionPool keeps the
+workers (and their loaded models) alive across calls, e.g. for streaming chunks
+"""
+
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+from text_patterns import content_key
+
+# Per-process detector, created by _init_worker
+_worker_detector = None
+
+
+def _worker_kwargs(detector_kwargs, torch_threads):
+    """Detector arguments of a worker (ONNX sessions are sized through onnx_threads)"""
+    if detector_kwargs.get('backend', 'torch') == 'torch':
+        return detector_kwargs
+    return {**detector_kwargs, 'onnx_threads': torch_threads}
+
+
+def _init_worker(detector_kwargs, torch_threads, profile=False):
+    """Limit intra-op threads, then build the detector and load its models once
+
+    In forked workers the models are already in the inherited model registry,
+    so nothing is loaded again.
+    """
+    global _worker_detector
+    # Thread pools must be sized before torch/tokenizers start them
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[var] = str(torch_threads)
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+
+    if detector_kwargs.get('backend', 'torch') == 'torch':
+        import torch
+        torch.set_num_threads(torch_threads)
+    detector_kwargs = _worker_kwargs(detector_kwargs, torch_threads)
+
+    from main import HallucinationDetector
+    from instrumentation import StageProfiler
+    _worker_detector = HallucinationDetector(profiler=StageProfiler(enabled=profile), **detector_kwargs)
+    _worker_detector.nli_model
+    _worker_detector.similarity_model
+    _worker_detector.domain_classifier
+
+
+def _detect_shard(shard):
+    queries, evidences, outputs, cached_scores, kwargs = shard
+    before = Counter(_worker_detector.skipped_stages)
+    dedup_before = {kind: Counter(counts) for kind, counts in _worker_detector.dedup_stats.items()}
+    profiler = _worker_detector.profiler
+    with profiler.span('ensemble', len(outputs)):
+        results = _worker_detector.ensemble_detection_batch(queries, evidences, outputs,
+                                                            cached_scores=cached_scores, **kwargs)
+    dedup = {kind: counts - dedup_before[kind] for kind, counts in _worker_detector.dedup_stats.items()}
+    # Spans (including the model loads of _init_worker) travel back with the first shard that follows them
+    return results, _worker_detector.skipped_stages - before, dedup, profiler.drain()
+
+
+class DetectionPool:
+    """A pool of worker processes with loaded detectors, reused across detect() calls
+
+    Workers run without the persistent embedding cache, which is not safe
+    for concurrent writers. With an enabled StageProfiler, each worker's
+    stage spans are merged into it (tagged with the worker's pid); the
+    workers' dedup counts are added to dedup_stats if given.
+
+    With share_models, the models are loaded once here (into the shared model
+    registry) and moved to shared memory, and the workers are forked, so all
+    of them map one copy of the weights instead of loading their own. The
+    calling process must not have run inference yet.
+    """
+
+    def __init__(self, workers=None, torch_threads=None, detector_kwargs=None, profiler=None, share_models=False,
+                 dedup_stats=None):
+        self.workers = workers or os.cpu_count() or 1
+        torch_threads = torch_threads or max(1, (os.cpu_count() or 1) // self.workers)
+        self.profiler = profiler
+        self.dedup_stats = dedup_stats
+
+        if share_models:
+            from main import HallucinationDetector
+            from model_registry import MODEL_REGISTRY
+            preload = HallucinationDetector(**_worker_kwargs(detector_kwargs or {}, torch_threads))
+            preload.nli_model
+            preload.similarity_model
+            preload.domain_classifier
+            MODEL_REGISTRY.share_memory()
+
+        # spawn unless sharing preloaded models: never fork a parent that may already hold torch thread pools
+        context = multiprocessing.get_context('fork' if share_models else 'spawn')
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_init_worker,
+                                        initargs=(detector_kwargs or {}, torch_threads,
+                                                  profiler is not None and profiler.enabled))
+
+    def detect(self, dataset, shard_size=None, cached_scores=None, **ensemble_kwargs):
+        """Score dataset with ensemble_detection_batch across the workers
+
+        Returns (results, skipped_stages): per-case (prediction, confidence,
+        method_scores) tuples in dataset order, and the merged cascade skip
+        counts. cached_scores optionally gives per case the stage scores that
+        are already known (see ensemble_detection_batch). Cases with the same
+        (evidence, output) pair are sharded together, so the workers' input
+        deduplication sees them in one batch.
+        """
+        dataset = list(dataset)
+        if not dataset:
+            return [], Counter()
+        # A few shards per worker keeps the pool busy when shards finish unevenly
+        shard_size = shard_size or max(1, -(-len(dataset) // (self.workers * 4)))
+
+        # Group identical (normalized) pairs, then shard the cases in that order
+        order = sorted(range(len(dataset)),
+                       key=lambda i: content_key(dataset[i]['evidence'], dataset[i]['llm_output']))
+        shards = []
+        for start in range(0, len(order), shard_size):
+            rows = order[start:start + shard_size]
+            chunk = [dataset[i] for i in rows]
+            shards.append((
+                [item['query'] for item in chunk],
+                [item['evidence'] for item in chunk],
+                [item['llm_output'] for item in chunk],
+                None if cached_scores is None else [cached_scores[i] for i in rows],
+                ensemble_kwargs
+            ))
+
+        results = []
+        skipped_stages = Counter()
+        for shard_results, shard_skipped, shard_dedup, shard_spans in self.pool.map(_detect_shard, shards):
+            results.extend(shard_results)
+            skipped_stages.update(shard_skipped)
+            if self.dedup_stats is not None:
+                for kind, counts in shard_dedup.items():
+                    self.dedup_stats[kind].update(counts)
+            if self.profiler is not None:
+                self.profiler.extend(shard_spans)
+
+        # Back to dataset order
+        ordered = [None] * len(dataset)
+        for i, result in zip(order, results):
+            ordered[i] = result
+        return ordered, skipped_stages
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_parallel_detection(dataset, workers=None, torch_threads=None, detector_kwargs=None,
+                           shard_size=None, profiler=None, share_models=False, dedup_stats=None, **ensemble_kwargs):
+    """Score dataset with ensemble_detection_batch across a one-off DetectionPool
+
+    Returns (results, skipped_stages) as DetectionPool.detect does.
+    """
+    with DetectionPool(workers, torch_threads, detector_kwargs, profiler, share_models, dedup_stats) as pool:
+        return pool.detect(dataset, shard_size=shard_size, **ensemble_kwargs)
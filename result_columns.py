@@ -0,0 +1,351 @@
+"""
+Columnar Detection Results
+Stores a run's per-case results as a directory of flat NumPy arrays (ids,
+labels, predictions, confidences, per-detector votes and scores), strings as
+one UTF-8 buffer plus offsets, and corrections in a JSONL side file with a
+byte-offset index. Readers memory-map the arrays, so opening millions of
+results costs milliseconds and a single case is read without parsing the rest
+
+Layout of a results directory:
+  meta.json                   - format version, row count, methods, category names, metrics
+  ids.npy                     - int64 case ids (string ids: ids.bin + ids.offsets.npy)
+  labels.npy                  - int8 ground truth, -1 = unlabeled
+  predictions.npy             - int8 ensemble prediction
+  confidence.npy              - float32 ensemble confidence
+  method_votes.npy            - int8 (rows, 5) per-detector vote, -1 = detector not run
+  method_scores.npy           - float32 (rows, 5) per-detector score, NaN = no score
+  category.npy                - int16 index into meta['categories'], -1 = none
+  query.bin, query.offsets.npy - UTF-8 queries and their rows + 1 byte offsets
+  corrections.jsonl           - one JSON correction per flagged case
+  correction_rows.npy, corrections.offsets.npy - row of each correction and its byte span
+
+Usage:
+    python result_columns.py detection_results
+    python result_columns.py detection_results --case 17
+    python result_columns.py --convert detection_results.json detection_results
+"""
+
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+
+from score_matrix import METHODS
+
+FORMAT = 'detection-results-columns'
+VERSION = 1
+
+
+# Bytes reserved for a column's .npy header, rewritten with the final row count on close
+_NPY_HEADER_BYTES = 128
+
+
+def _npy_header(dtype, shape):
+    """Version 1.0 .npy header for dtype and shape, padded to _NPY_HEADER_BYTES"""
+    header = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False,
+                   'shape': tuple(shape)})
+    prefix = np.lib.format.MAGIC_PREFIX + bytes([1, 0])
+    padding = _NPY_HEADER_BYTES - len(prefix) - 2 - len(header) - 1
+    return prefix + np.uint16(_NPY_HEADER_BYTES - len(prefix) - 2).tobytes() + (header + ' ' * padding + '\n').encode(
+        'latin-1')
+
+
+class _ColumnFile:
+    """A .npy array written chunk by chunk: rows go to disk as they arrive"""
+
+    def __init__(self, path, dtype, width=None, first=None):
+        self.dtype = np.dtype(dtype)
+        self.width = width
+        self.rows = 0
+        self.file = open(path, 'wb')
+        self.file.write(_npy_header(self.dtype, self._shape()))
+        if first is not None:
+            self.append(first)
+
+    def _shape(self):
+        return (self.rows,) if self.width is None else (self.rows, self.width)
+
+    def append(self, values):
+        array = np.asarray(values, dtype=self.dtype)
+        if self.width is not None:
+            array = array.reshape(-1, self.width)
+        self.file.write(array.tobytes())
+        self.rows += len(array)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(_npy_header(self.dtype, self._shape()))
+        self.file.close()
+
+
+class _OffsetsFile(_ColumnFile):
+    """rows + 1 int64 byte offsets, appended from per-row byte lengths"""
+
+    def __init__(self, path):
+        super().__init__(path, np.int64, first=[0])
+        self.end = 0
+
+    def append_lengths(self, lengths):
+        ends = self.end + np.cumsum(np.asarray(lengths, dtype=np.int64))
+        if len(ends):
+            self.end = int(ends[-1])
+        self.append(ends)
+
+
+def _map_bytes(path, mmap):
+    """uint8 view of a whole file (an empty file maps to an empty array)"""
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=np.uint8)
+    if mmap:
+        return np.memmap(path, dtype=np.uint8, mode='r')
+    return np.fromfile(path, dtype=np.uint8)
+
+
+class ResultColumnsWriter:
+    """Builds a results directory chunk by chunk
+
+    Every column, the query strings and the corrections are written to their
+    files as each chunk is added; only the category names are kept in memory,
+    so streaming runs write results of any size in bounded memory.
+    """
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.count = 0
+        self.categories = {}
+
+        def column(name, dtype, width=None):
+            return _ColumnFile(os.path.join(path, f'{name}.npy'), dtype, width)
+
+        self.columns = {
+            'labels': column('labels', np.int8),
+            'predictions': column('predictions', np.int8),
+            'confidence': column('confidence', np.float32),
+            'method_votes': column('method_votes', np.int8, len(METHODS)),
+            'method_scores': column('method_scores', np.float32, len(METHODS)),
+            'category': column('category', np.int16),
+            'correction_rows': column('correction_rows', np.int64)
+        }
+        # Ids are written both ways until close() knows whether they are all integers
+        self.int_ids = True
+        self._int_ids = column('ids', np.int64)
+        self._id_file = open(os.path.join(path, 'ids.bin'), 'wb')
+        self._id_offsets = _OffsetsFile(os.path.join(path, 'ids.offsets.npy'))
+        self._query_file = open(os.path.join(path, 'query.bin'), 'wb')
+        self._query_offsets = _OffsetsFile(os.path.join(path, 'query.offsets.npy'))
+        self._corrections_file = open(os.path.join(path, 'corrections.jsonl'), 'wb')
+        self._correction_offsets = _OffsetsFile(os.path.join(path, 'corrections.offsets.npy'))
+
+    def add(self, results):
+        """Append result records (dicts shaped like main.build_result output)"""
+        if not results:
+            return
+        columns = self.columns
+        columns['labels'].append([-1 if r['actual'] is None else r['actual'] for r in results])
+        columns['predictions'].append([r['prediction'] for r in results])
+        columns['confidence'].append([r['confidence'] for r in results])
+        columns['method_votes'].append([
+            [-1 if r['method_scores'][name][0] is None else r['method_scores'][name][0] for name in METHODS]
+            for r in results
+        ])
+        columns['method_scores'].append([
+            [np.nan if r['method_scores'][name][1] is None else r['method_scores'][name][1] for name in METHODS]
+            for r in results
+        ])
+        columns['category'].append([
+            -1 if r.get('category') is None else self.categories.setdefault(r['category'], len(self.categories))
+            for r in results
+        ])
+
+        ids = [r['id'] for r in results]
+        self.int_ids = self.int_ids and all(isinstance(i, (int, np.integer)) for i in ids)
+        self._int_ids.append([i if self.int_ids else 0 for i in ids])
+        encoded_ids = [str(i).encode('utf-8') for i in ids]
+        self._id_file.write(b''.join(encoded_ids))
+        self._id_offsets.append_lengths([len(i) for i in encoded_ids])
+
+        queries = [r['query'].encode('utf-8') for r in results]
+        self._query_file.write(b''.join(queries))
+        self._query_offsets.append_lengths([len(q) for q in queries])
+
+        rows, lengths = [], []
+        for row, r in enumerate(results, self.count):
+            if r.get('correction') is not None:
+                line = (json.dumps(r['correction'], ensure_ascii=False, default=str) + "\n").encode('utf-8')
+                self._corrections_file.write(line)
+                rows.append(row)
+                lengths.append(len(line))
+        columns['correction_rows'].append(rows)
+        self._correction_offsets.append_lengths(lengths)
+        self.count += len(results)
+
+    def close(self, metrics=None, **meta):
+        """Finish the array files and write meta.json; meta entries are stored as-is"""
+        for column in self.columns.values():
+            column.close()
+        for f in (self._query_file, self._corrections_file, self._id_file):
+            f.close()
+        for offsets in (self._query_offsets, self._correction_offsets, self._id_offsets, self._int_ids):
+            offsets.close()
+
+        # Integer ids stay numeric; anything else is stored as strings
+        id_type = 'int' if self.int_ids else 'str'
+        unused = ['ids.bin', 'ids.offsets.npy'] if id_type == 'int' else ['ids.npy']
+        for name in unused:
+            os.remove(os.path.join(self.path, name))
+
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({
+                'format': FORMAT,
+                'version': VERSION,
+                'rows': self.count,
+                'id_type': id_type,
+                'methods': METHODS,
+                'categories': list(self.categories),
+                'metrics': metrics,
+                **meta
+            }, f, indent=2, allow_nan=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if not self._query_file.closed:
+            self.close()
+
+
+def save_result_columns(path, results, metrics=None, **meta):
+    """Write result records as a results directory in one go"""
+    writer = ResultColumnsWriter(path)
+    writer.add(results)
+    writer.close(metrics, **meta)
+
+
+class ResultColumns:
+    """Read-only view of a results directory
+
+    Array attributes (labels, predictions, confidence, method_votes,
+    method_scores, category, ids) are memory-mapped by default, so only the
+    pages that are actually touched are read from disk. Strings and
+    corrections are decoded per row on request.
+    """
+
+    def __init__(self, path, mmap=True):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('format') != FORMAT:
+            raise ValueError(f"{path} is not a columnar results directory")
+        if self.meta['methods'] != METHODS:
+            raise ValueError(f"Unexpected detector columns in {path}: {self.meta['methods']}")
+        self.path = path
+        mode = 'r' if mmap else None
+
+        def load(name):
+            return np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mode)
+
+        self.labels = load('labels')
+        self.predictions = load('predictions')
+        self.confidence = load('confidence')
+        self.method_votes = load('method_votes')
+        self.method_scores = load('method_scores')
+        self.category = load('category')
+        self.categories = self.meta['categories']
+        self.metrics = self.meta.get('metrics')
+
+        self._query_bytes = _map_bytes(os.path.join(path, 'query.bin'), mmap)
+        self._query_offsets = load('query.offsets')
+        if self.meta['id_type'] == 'int':
+            self.ids = load('ids')
+            self._id_bytes = None
+        else:
+            self._id_bytes = _map_bytes(os.path.join(path, 'ids.bin'), mmap)
+            self._id_offsets = load('ids.offsets')
+            self.ids = None
+        self.correction_rows = load('correction_rows')
+        self._correction_offsets = load('corrections.offsets')
+        self._corrections_path = os.path.join(path, 'corrections.jsonl')
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def case_id(self, row):
+        if self._id_bytes is None:
+            return int(self.ids[row])
+        start, end = self._id_offsets[row], self._id_offsets[row + 1]
+        return self._id_bytes[start:end].tobytes().decode('utf-8')
+
+    def query(self, row):
+        start, end = self._query_offsets[row], self._query_offsets[row + 1]
+        return self._query_bytes[start:end].tobytes().decode('utf-8')
+
+    def category_name(self, row):
+        code = int(self.category[row])
+        return self.categories[code] if code >= 0 else None
+
+    def correction(self, row):
+        """The correction of one case (None if the case was not flagged), read from its byte span"""
+        i = int(np.searchsorted(self.correction_rows, row))
+        if i == len(self.correction_rows) or self.correction_rows[i] != row:
+            return None
+        start, end = int(self._correction_offsets[i]), int(self._correction_offsets[i + 1])
+        with open(self._corrections_path, 'rb') as f:
+            f.seek(start)
+            return json.loads(f.read(end - start))
+
+    def record(self, row):
+        """One case as a result dict shaped like main.build_result output"""
+        method_scores = {}
+        for k, name in enumerate(METHODS):
+            vote, score = int(self.method_votes[row, k]), float(self.method_scores[row, k])
+            # NaN scores come back as None, so a record always serializes to valid JSON
+            method_scores[name] = (None, None) if vote < 0 else (vote, None if np.isnan(score) else score)
+        label = int(self.labels[row])
+        return {
+            'id': self.case_id(row),
+            'query': self.query(row),
+            'prediction': int(self.predictions[row]),
+            'actual': None if label < 0 else label,
+            'confidence': float(self.confidence[row]),
+            'method_scores': method_scores,
+            'correction': self.correction(row),
+            'category': self.category_name(row)
+        }
+
+
+def convert_json_results(json_path, path):
+    """Convert a legacy detection_results.json into a results directory"""
+    with open(json_path) as f:
+        data = json.load(f)
+    save_result_columns(path, data['results'], data.get('metrics'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or create a columnar detection-results directory")
+    parser.add_argument('path', nargs='?', default='detection_results')
+    parser.add_argument('--case', type=int, metavar='ROW', help="print the full record of this row")
+    parser.add_argument('--convert', metavar='RESULTS.json',
+                        help="first convert a legacy detection_results.json into path")
+    args = parser.parse_args(argv)
+
+    if args.convert:
+        convert_json_results(args.convert, args.path)
+        print(f"✓ Converted {args.convert} → {args.path}/")
+
+    start = time.perf_counter()
+    results = ResultColumns(args.path)
+    elapsed = (time.perf_counter() - start) * 1000
+    labeled = results.labels >= 0
+    print(f"{args.path}: {len(results)} cases opened in {elapsed:.1f} ms")
+    print(f"  Flagged:   {int(np.sum(results.predictions == 1))}")
+    print(f"  Labeled:   {int(labeled.sum())}, "
+          f"accuracy {np.mean(results.predictions[labeled] == results.labels[labeled]) if labeled.any() else 0:.3f}")
+    print(f"  Corrected: {len(results.correction_rows)}")
+    if args.case is not None:
+        print(json.dumps(results.record(args.case), indent=2, ensure_ascii=False, default=str))
+
+
+if __name__ == "__main__":
+    main()
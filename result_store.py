@@ -0,0 +1,97 @@
+"""
+Checkpointed Per-Case Result Store
+SQLite store of per-detector scores keyed by case and by a fingerprint of each
+detector's model/config, so an interrupted or re-configured run only recomputes
+what is actually missing
+"""
+
+import json
+import sqlite3
+import hashlib
+
+
+def case_key(item):
+    """Case id plus a hash of the texts the detectors read"""
+    content = "\0".join([item['query'], item['evidence'], item['llm_output']])
+    digest = hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
+    return f"{item.get('id')}:{digest}"
+
+
+def config_fingerprint(config):
+    """Stable short hash of a JSON-serializable config"""
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+class ResultStore:
+    """Detector scores per (case, detector, fingerprint)
+
+    A detector whose fingerprint changed simply finds no rows for itself, so
+    only that detector is recomputed; every other detector's scores are reused.
+    Each put_many() call is committed, which makes it a checkpoint.
+    """
+
+    # Max host parameters per IN (...) query on older SQLite builds is 999
+    _QUERY_CHUNK = 900
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS stage_scores (
+                case_key    TEXT NOT NULL,
+                stage       TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                pred        INTEGER NOT NULL,
+                score       REAL,
+                PRIMARY KEY (case_key, stage, fingerprint)
+            )
+        """)
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, case_keys, fingerprints):
+        """For each case key, a dict stage -> (pred, score) of the scores stored
+        under the current fingerprint of that stage"""
+        found = {key: {} for key in case_keys}
+        unique_keys = list(found)
+        for start in range(0, len(unique_keys), self._QUERY_CHUNK):
+            chunk = unique_keys[start:start + self._QUERY_CHUNK]
+            rows = self.conn.execute(
+                f"SELECT case_key, stage, fingerprint, pred, score FROM stage_scores "
+                f"WHERE case_key IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            for key, stage, fingerprint, pred, score in rows:
+                if fingerprints.get(stage) == fingerprint:
+                    found[key][stage] = (pred, score)
+
+        cached = [found[key] for key in case_keys]
+        for scores in cached:
+            self.hits += len(scores)
+            self.misses += len(fingerprints) - len(scores)
+        return cached
+
+    def put_many(self, case_keys, method_scores_list, fingerprints):
+        """Store every computed (non-skipped) detector score and commit"""
+        rows = [
+            (key, stage, fingerprints[stage], pred, score)
+            for key, method_scores in zip(case_keys, method_scores_list)
+            for stage, (pred, score) in method_scores.items()
+            if pred is not None
+        ]
+        self.conn.executemany("INSERT OR REPLACE INTO stage_scores VALUES (?, ?, ?, ?, ?)", rows)
+        self.conn.commit()
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'stored_scores': self.conn.execute("SELECT COUNT(*) FROM stage_scores").fetchone()[0],
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,211 @@
+"""
+Columnar Detector-Score Matrix and Offline Re-Scoring
+Stores the raw per-detector scores of a run as NumPy arrays so that ensemble
+weights and thresholds can be re-tuned without running any model again
+
+Usage:
+    python score_matrix.py detection_scores.npz --weights 0.3,0.2,0.15,0.2,0.15 --decision-threshold 0.35
+"""
+
+import json
+import time
+import argparse
+
+import numpy as np
+
+# Column order of the score matrix (same as the ensemble weight order)
+METHODS = ['entailment', 'similarity', 'domain', 'uncertainty', 'medical_rules']
+
+
+def classification_metrics(labels, predictions):
+    """Accuracy/precision/recall/F1 and confusion matrix over labeled rows (label >= 0)"""
+    labeled = labels >= 0
+    y, p = labels[labeled] == 1, predictions[labeled] == 1
+    tp = int(np.sum(y & p))
+    tn = int(np.sum(~y & ~p))
+    fp = int(np.sum(~y & p))
+    fn = int(np.sum(y & ~p))
+    total = tp + tn + fp + fn
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    return {
+        'accuracy': (tp + tn) / total if total else 0.0,
+        'precision': precision,
+        'recall': recall,
+        'f1_score': 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+        'confusion_matrix': [[tn, fp], [fn, tp]]
+    }
+
+
+class ScoreMatrix:
+    """Per-case raw detector scores plus the weights/thresholds of the run
+
+    scores has one column per METHODS entry; NaN marks a detector that was not
+    run for that case (zero weight or cascade skip), which never votes.
+    labels uses -1 for unlabeled cases.
+    """
+
+    def __init__(self, ids, labels, predictions, scores, weights, thresholds):
+        self.ids = ids
+        self.labels = labels
+        self.predictions = predictions
+        self.scores = scores
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.thresholds = dict(thresholds)
+
+    @classmethod
+    def from_results(cls, results, weights, thresholds):
+        """Build from result records (dicts with id/actual/prediction/method_scores)"""
+        builder = ScoreMatrixBuilder()
+        builder.add(results)
+        return builder.build(weights, thresholds)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def save(self, path):
+        np.savez(
+            path,
+            ids=self.ids,
+            labels=self.labels,
+            predictions=self.predictions,
+            scores=self.scores,
+            methods=np.array(METHODS),
+            weights=self.weights,
+            thresholds=np.array(json.dumps(self.thresholds))
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if list(data['methods']) != METHODS:
+                raise ValueError(f"Unexpected score columns in {path}: {list(data['methods'])}")
+            return cls(
+                data['ids'],
+                data['labels'],
+                data['predictions'],
+                data['scores'],
+                data['weights'],
+                json.loads(str(data['thresholds']))
+            )
+
+    def votes(self, thresholds=None):
+        """(n_cases, n_methods) 0/1 hallucination votes under the given cutoffs
+
+        Mirrors the detector decisions: low entailment probability, low
+        similarity or low relevance flag a case; any risky phrase or rule
+        violation flags it. NaN compares False, so skipped detectors never vote.
+        """
+        t = {**self.thresholds, **(thresholds or {})}
+        s = self.scores
+        with np.errstate(invalid='ignore'):
+            return np.stack([
+                s[:, 0] <= t['entailment'],
+                s[:, 1] < t['similarity'],
+                s[:, 2] < t['domain'],
+                s[:, 3] > 0,
+                s[:, 4] > 0
+            ], axis=1).astype(np.float64)
+
+    def rescore(self, weights=None, thresholds=None):
+        """Ensemble predictions and confidences for new weights/thresholds, no model calls"""
+        weights = self.weights if weights is None else np.asarray(weights, dtype=np.float64)
+        t = {**self.thresholds, **(thresholds or {})}
+        votes = self.votes(t)
+
+        # Accumulate column by column, in the same order as the detector's weighted vote
+        hallucination_weight = np.zeros(len(self))
+        unknown_weight = np.zeros(len(self))
+        for k in range(len(METHODS)):
+            hallucination_weight += votes[:, k] * weights[k]
+            unknown_weight += np.isnan(self.scores[:, k]) * weights[k]
+
+        # Skipped detectors bound the confidence as in the detector's vote
+        predictions = (hallucination_weight >= t['decision']).astype(np.int8)
+        confidence = np.where(predictions == 1, hallucination_weight, 1 - hallucination_weight - unknown_weight)
+        return predictions, confidence
+
+    def metrics(self, predictions=None):
+        return classification_metrics(self.labels, self.predictions if predictions is None else predictions)
+
+
+class ScoreMatrixBuilder:
+    """Accumulates result records chunk by chunk as compact arrays"""
+
+    def __init__(self):
+        self.ids = []
+        self.labels = []
+        self.predictions = []
+        self.scores = []
+
+    def add(self, results):
+        if not results:
+            return
+        self.ids.extend(r['id'] for r in results)
+        self.labels.append(np.array([-1 if r['actual'] is None else r['actual'] for r in results], dtype=np.int8))
+        self.predictions.append(np.array([r['prediction'] for r in results], dtype=np.int8))
+        self.scores.append(np.array([
+            [np.nan if r['method_scores'][name][1] is None else r['method_scores'][name][1] for name in METHODS]
+            for r in results
+        ], dtype=np.float32))
+
+    def build(self, weights, thresholds):
+        ids = np.array(self.ids)
+        if ids.dtype.kind not in 'iu':
+            ids = np.array([str(i) for i in self.ids])
+        return ScoreMatrix(
+            ids,
+            np.concatenate(self.labels) if self.labels else np.empty(0, dtype=np.int8),
+            np.concatenate(self.predictions) if self.predictions else np.empty(0, dtype=np.int8),
+            np.concatenate(self.scores) if self.scores else np.empty((0, len(METHODS)), dtype=np.float32),
+            weights,
+            thresholds
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-score a saved detector-score matrix without model calls")
+    parser.add_argument('scores', nargs='?', default='detection_scores.npz')
+    parser.add_argument('--weights', help="comma-separated ensemble weights in METHODS order")
+    parser.add_argument('--decision-threshold', type=float)
+    parser.add_argument('--entailment-threshold', type=float)
+    parser.add_argument('--similarity-threshold', type=float)
+    parser.add_argument('--domain-threshold', type=float)
+    args = parser.parse_args(argv)
+
+    matrix = ScoreMatrix.load(args.scores)
+    weights = [float(w) for w in args.weights.split(',')] if args.weights else None
+    overrides = {
+        name: value for name, value in [
+            ('decision', args.decision_threshold),
+            ('entailment', args.entailment_threshold),
+            ('similarity', args.similarity_threshold),
+            ('domain', args.domain_threshold)
+        ] if value is not None
+    }
+
+    start = time.perf_counter()
+    predictions, _ = matrix.rescore(weights, overrides)
+    metrics = matrix.metrics(predictions)
+    elapsed = (time.perf_counter() - start) * 1000
+
+    used_weights = matrix.weights if weights is None else weights
+    print(f"Re-scored {len(matrix)} cases in {elapsed:.2f} ms")
+    print(f"  Weights:    {', '.join(f'{n}={w:g}' for n, w in zip(METHODS, used_weights))}")
+    print(f"  Thresholds: {', '.join(f'{n}={v:g}' for n, v in {**matrix.thresholds, **overrides}.items())}")
+    print(f"  Accuracy:   {metrics['accuracy']:.3f}")
+    print(f"  Precision:  {metrics['precision']:.3f}")
+    print(f"  Recall:     {metrics['recall']:.3f}")
+    print(f"  F1-Score:   {metrics['f1_score']:.3f}")
+    print(f"  Confusion:  {metrics['confusion_matrix']}")
+    changed = int(np.sum(predictions != matrix.predictions))
+    print(f"  {changed} predictions differ from the original run")
+
+    skipped = int(np.isnan(matrix.scores).any(axis=1).sum())
+    if skipped:
+        print(f"  ⚠ {skipped} cases have skipped detectors (cascade or zero weight); "
+              f"re-score a full run for exact results under new settings")
+
+
+if __name__ == "__main__":
+    main()
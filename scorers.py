@@ -0,0 +1,373 @@
+"""
+Batched Sentence-Pair Scoring Engines
+Run sequence-classification models directly on (text_a, text_b) pairs
+instead of going through text-classification pipelines with joined strings.
+Each distinct text is tokenized once per tokenizer; pair inputs are then
+assembled from the cached token IDs with the tokenizer's own special tokens
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+# ============================================================================
+# TOKENIZE-ONCE PAIR ENCODING
+# ============================================================================
+
+class TokenCache:
+    """LRU cache of the token IDs (no special tokens, untruncated) of each distinct text under one tokenizer"""
+
+    def __init__(self, tokenizer, max_items=100000):
+        # tokenizer: a private `tokenizers.Tokenizer` with padding and truncation off
+        self.tokenizer = tokenizer
+        self.max_items = max_items
+        self.ids = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def encode(self, texts):
+        """int32 token-ID array per text; texts not cached yet are tokenized once, in one batch"""
+        found = {}
+        with self._lock:
+            for text in dict.fromkeys(texts):
+                ids = self.ids.get(text)
+                if ids is not None:
+                    self.ids.move_to_end(text)
+                    found[text] = ids
+            missing = [text for text in dict.fromkeys(texts) if text not in found]
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        if missing:
+            encodings = self.tokenizer.encode_batch(missing, add_special_tokens=False)
+            new = {text: np.array(e.ids, dtype=np.int32) for text, e in zip(missing, encodings)}
+            found.update(new)
+            with self._lock:
+                self.ids.update(new)
+                while len(self.ids) > self.max_items:
+                    self.ids.popitem(last=False)
+        return [found[text] for text in texts]
+
+    def stats(self):
+        return {'texts': len(self.ids), 'hits': self.hits, 'misses': self.misses}
+
+
+# Token caches of this process, one per distinct tokenizer (vocabulary, normalizer and pre-tokenizer)
+_TOKEN_CACHES = {}
+_TOKEN_CACHES_LOCK = threading.Lock()
+
+
+def shared_token_cache(backend_tokenizer):
+    """The process-wide TokenCache for a `tokenizers.Tokenizer`
+
+    Models with the same tokenizer (e.g. an NLI model and a cross-encoder
+    fine-tuned from the same base) share one cache, so a text reused across
+    stages is tokenized once. Padding and truncation settings are not part
+    of the identity; the cache works on an unpadded, untruncated copy.
+    """
+    from tokenizers import Tokenizer
+
+    tokenizer = Tokenizer.from_str(backend_tokenizer.to_str())
+    tokenizer.no_padding()
+    tokenizer.no_truncation()
+    key = hashlib.sha1(tokenizer.to_str().encode('utf-8')).hexdigest()
+    with _TOKEN_CACHES_LOCK:
+        if key not in _TOKEN_CACHES:
+            _TOKEN_CACHES[key] = TokenCache(tokenizer)
+        return _TOKEN_CACHES[key]
+
+
+def truncate_longest_first(len_a, len_b, budget):
+    """Kept lengths of a pair under 'longest_first' truncation to budget tokens
+
+    The `tokenizers` library's rule: the shorter sequence keeps up to half the
+    budget (rounded down) and the longer one takes the rest, so on an odd
+    budget the spare token goes to the longer sequence (to the second one when
+    both are equally long).
+    """
+    if len_a + len_b <= budget:
+        return len_a, len_b
+    if len_a > len_b:
+        keep_b = min(len_b, budget // 2)
+        return budget - keep_b, keep_b
+    keep_a = min(len_a, budget // 2)
+    return keep_a, budget - keep_a
+
+
+class PairEncoder:
+    """Builds padded model inputs for (text_a, text_b) pairs from cached token IDs
+
+    The special tokens and token types of the model's pair format ([CLS] a
+    [SEP] b [SEP] for BERT, <s> a </s></s> b </s> for BART/RoBERTa, ...) are
+    read once from the tokenizer's post-processor, so no pair is ever rebuilt
+    as a string or re-tokenized. Truncation is length-aware: only pairs that
+    exceed max_length are cut, longest sequence first, from the right.
+    """
+
+    def __init__(self, tokenizer, max_length, input_names):
+        self.cache = shared_token_cache(tokenizer.backend_tokenizer)
+        self.max_length = max_length
+        self.input_names = list(input_names)
+        self.pad_token_id = tokenizer.pad_token_id or 0
+        self._read_template()
+
+    def _read_template(self):
+        """Special tokens before, between and after the two sequences, with their token types
+
+        A pair whose second text is empty is encoded as a single sequence, as
+        transformers tokenizers do, so the single-sequence template is read too.
+        """
+        self.pair_template, self.pair_types = self._probe('a', 'b')
+        self.single_template, self.single_types = self._probe('a')
+
+    def _probe(self, *texts):
+        probe = self.cache.tokenizer.encode(*texts, add_special_tokens=True)
+        segments = [[] for _ in range(len(texts) + 1)]
+        sequence_types = [0] * len(texts)
+        segment = 0
+        for token_id, type_id, sequence in zip(probe.ids, probe.type_ids, probe.sequence_ids):
+            if sequence is None:
+                segments[segment].append((token_id, type_id))
+            else:
+                sequence_types[sequence] = type_id
+                segment = sequence + 1
+        template = [(np.array([t for t, _ in s], dtype=np.int64), np.array([y for _, y in s], dtype=np.int64))
+                    for s in segments]
+        return template, sequence_types
+
+    @staticmethod
+    def _num_special_tokens(template):
+        return sum(len(ids) for ids, _ in template)
+
+    def encode(self, pairs):
+        """(a_ids, b_ids) per pair, already truncated to fit max_length with the special tokens
+
+        b_ids is None for an empty second text (encoded as a single sequence).
+        """
+        ids = self.cache.encode([a for a, _ in pairs] + [b for _, b in pairs])
+        pair_budget = self.max_length - self._num_special_tokens(self.pair_template)
+        single_budget = self.max_length - self._num_special_tokens(self.single_template)
+        encoded = []
+        for (_, b), a_ids, b_ids in zip(pairs, ids[:len(pairs)], ids[len(pairs):]):
+            if not b:
+                encoded.append((a_ids[:single_budget], None))
+                continue
+            keep_a, keep_b = truncate_longest_first(len(a_ids), len(b_ids), pair_budget)
+            encoded.append((a_ids[:keep_a], b_ids[:keep_b]))
+        return encoded
+
+    def _parts(self, encoded_pair):
+        """(token ids, token types) segments of one encoded pair, in order"""
+        a_ids, b_ids = encoded_pair
+        if b_ids is None:
+            (prefix, prefix_types), (suffix, suffix_types) = self.single_template
+            return ((prefix, prefix_types), (a_ids, self.single_types[0]), (suffix, suffix_types))
+        (prefix, prefix_types), (middle, middle_types), (suffix, suffix_types) = self.pair_template
+        type_a, type_b = self.pair_types
+        return ((prefix, prefix_types), (a_ids, type_a), (middle, middle_types), (b_ids, type_b),
+                (suffix, suffix_types))
+
+    def length(self, encoded_pair):
+        return sum(len(ids) for ids, _ in self._parts(encoded_pair))
+
+    def features(self, encoded, return_tensors='np'):
+        """Padded input_ids / attention_mask / token_type_ids (those the model takes) for encoded pairs"""
+        width = max(self.length(pair) for pair in encoded)
+        input_ids = np.full((len(encoded), width), self.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(encoded), width), dtype=np.int64)
+        token_type_ids = np.zeros((len(encoded), width), dtype=np.int64)
+
+        for row, pair in enumerate(encoded):
+            pos = 0
+            for ids, types in self._parts(pair):
+                input_ids[row, pos:pos + len(ids)] = ids
+                token_type_ids[row, pos:pos + len(ids)] = types
+                pos += len(ids)
+            attention_mask[row, :pos] = 1
+
+        features = {'input_ids': input_ids, 'attention_mask': attention_mask, 'token_type_ids': token_type_ids}
+        features = {name: features[name] for name in self.input_names if name in features}
+        if return_tensors == 'pt':
+            import torch
+            features = {name: torch.from_numpy(array) for name, array in features.items()}
+        return features
+
+
+def check_pair_encoding(tokenizer, lengths=range(0, 25), max_lengths=None):
+    """Compare PairEncoder against tokenizer(a, b, truncation='longest_first') over a grid
+
+    Builds a pair of every length combination (in words of one token each)
+    and encodes it at every max_length, both from cached IDs and with the
+    tokenizer itself. Returns the (len_a, len_b, max_length) cases whose
+    input_ids / token_type_ids differ; an empty list means exact parity.
+    """
+    lengths = list(lengths)
+    special = tokenizer.num_special_tokens_to_add(pair=True)
+    if max_lengths is None:
+        max_lengths = range(special + 2, special + 2 * max(lengths) + 2)
+    pairs = [(' '.join(['a'] * len_a), ' '.join(['b'] * len_b)) for len_a in lengths for len_b in lengths]
+
+    mismatches = []
+    for max_length in max_lengths:
+        encoder = PairEncoder(tokenizer, max_length, ['input_ids', 'token_type_ids'])
+        encoded = encoder.encode(pairs)
+        ours = encoder.features(encoded)
+        for row, (a, b) in enumerate(pairs):
+            # One call per pair: an empty text_pair only falls back to a single sequence when not batched
+            ref = tokenizer(a, b, truncation='longest_first', max_length=max_length)
+            width = encoder.length(encoded[row])
+            same = (width == len(ref['input_ids'])
+                    and ours['input_ids'][row, :width].tolist() == ref['input_ids'])
+            if same and 'token_type_ids' in ref:
+                same = ours['token_type_ids'][row, :width].tolist() == ref['token_type_ids']
+            if not same:
+                mismatches.append((len(a.split()), len(b.split()), max_length))
+    return mismatches
+
+
+# ============================================================================
+# SCORERS
+# ============================================================================
+
+class PairScorer:
+    """Length-sorted, padded batching of (text_a, text_b) pairs
+
+    Subclasses set self.tokenizer, self.max_length and self.num_labels, and
+    implement _forward() for their inference runtime. Tokenizers backed by
+    the `tokenizers` library go through a PairEncoder (tokenize once, batch
+    by exact token length); others tokenize each batch of pairs directly.
+    """
+
+    # Tensor type the tokenizer returns for _forward()
+    return_tensors = 'np'
+    _pair_encoder = None
+
+    def _forward(self, features):
+        """Logits as a float32 array of shape (batch, n_labels)"""
+        raise NotImplementedError
+
+    @property
+    def pair_encoder(self):
+        """PairEncoder for this scorer's tokenizer, or None if it has no `tokenizers` backend"""
+        if self._pair_encoder is None and getattr(self.tokenizer, 'backend_tokenizer', None) is not None:
+            self._pair_encoder = PairEncoder(self.tokenizer, self.max_length, self.tokenizer.model_input_names)
+        return self._pair_encoder
+
+    def logits(self, pairs, batch_size=32):
+        """Raw model logits for (text_a, text_b) pairs, shape (n_pairs, n_labels)"""
+        if not pairs:
+            return np.empty((0, self.num_labels), dtype=np.float32)
+        if self.pair_encoder is None:
+            return self._logits_from_text(pairs, batch_size)
+
+        # Sort by token length so each padded batch holds similarly sized pairs
+        encoded = self.pair_encoder.encode(pairs)
+        order = sorted(range(len(pairs)), key=lambda i: self.pair_encoder.length(encoded[i]), reverse=True)
+        logits = np.empty((len(pairs), self.num_labels), dtype=np.float32)
+
+        for start in range(0, len(order), batch_size):
+            idx = order[start:start + batch_size]
+            features = self.pair_encoder.features([encoded[i] for i in idx], return_tensors=self.return_tensors)
+            logits[idx] = self._forward(features)
+
+        return logits
+
+    def _logits_from_text(self, pairs, batch_size):
+        """logits() for tokenizers without a `tokenizers` backend: each batch tokenized as text"""
+        order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][0]) + len(pairs[i][1]), reverse=True)
+        logits = np.empty((len(pairs), self.num_labels), dtype=np.float32)
+
+        for start in range(0, len(order), batch_size):
+            idx = order[start:start + batch_size]
+            features = self.tokenizer(
+                [pairs[i][0] for i in idx],
+                [pairs[i][1] for i in idx],
+                padding=True,
+                truncation='longest_first',
+                max_length=self.max_length,
+                return_tensors=self.return_tensors
+            )
+            logits[idx] = self._forward(features)
+
+        return logits
+
+    def score(self, pairs, batch_size=32, activation='sigmoid'):
+        """One relevance score per pair: sigmoid of the first logit, or the raw logit"""
+        logits = self.logits(pairs, batch_size=batch_size)[:, 0]
+        if activation == 'sigmoid':
+            return 1.0 / (1.0 + np.exp(-logits))
+        return logits
+
+
+class CrossEncoderScorer(PairScorer):
+    """Sequence-pair classification over real sentence pairs (PyTorch): cross-encoders and NLI models
+
+    max_length=None truncates only at the model's own limit.
+    """
+
+    return_tensors = 'pt'
+
+    def __init__(self, model_name, max_length=512):
+        from transformers import AutoTokenizer, AutoModelForSequenceClassification
+        self.model_name = model_name
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        self.model.eval()
+        limits = [self.tokenizer.model_max_length, getattr(self.model.config, 'max_position_embeddings', None),
+                  max_length]
+        self.max_length = min(limit for limit in limits if limit)
+        self.num_labels = self.model.config.num_labels
+        self.id2label = {int(i): label for i, label in self.model.config.id2label.items()}
+
+    def _forward(self, features):
+        import torch
+        with torch.inference_mode():
+            return self.model(**features).logits.float().numpy()
+
+
+class PairClassificationPipeline:
+    """Stands in for the transformers text-classification pipeline used by nli_batch
+
+    Called with [{'text': premise, 'text_pair': hypothesis}, ...] and top_k=None,
+    returns per input the full [{'label', 'score'}, ...] softmax distribution
+    of a PairScorer, so NLI pairs go through its tokenize-once encoding.
+    """
+
+    def __init__(self, scorer):
+        self.scorer = scorer
+        self.id2label = scorer.id2label
+        # Where the torch weights live (for the model registry)
+        self.model = getattr(scorer, 'model', None)
+
+    def __call__(self, inputs, batch_size=16, truncation=True, top_k=None):
+        pairs = [(item['text'], item['text_pair']) for item in inputs]
+        logits = self.scorer.logits(pairs, batch_size=batch_size)
+        logits = logits - logits.max(axis=1, keepdims=True)
+        probs = np.exp(logits)
+        probs /= probs.sum(axis=1, keepdims=True)
+
+        results = []
+        for row in probs:
+            ranked = sorted(
+                ({'label': self.id2label[i], 'score': float(p)} for i, p in enumerate(row)),
+                key=lambda r: r['score'], reverse=True
+            )
+            results.append(ranked if top_k is None else ranked[:top_k])
+        return results
+
+
+if __name__ == "__main__":
+    import sys
+    from transformers import AutoTokenizer
+
+    # Usage: python scorers.py MODEL_DIR  - parity check of the pair encoding against the tokenizer
+    tokenizer = AutoTokenizer.from_pretrained(sys.argv[1])
+    mismatches = check_pair_encoding(tokenizer)
+    print(f"Pair encoding vs tokenizer(truncation='longest_first'): {len(mismatches)} mismatches")
+    for len_a, len_b, max_length in mismatches[:10]:
+        print(f"  len_a={len_a} len_b={len_b} max_length={max_length}")
+    sys.exit(1 if mismatches else 0)
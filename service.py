@@ -0,0 +1,342 @@
+"""
+Async HTTP Detection Service with Dynamic Micro-Batching
+Serves HallucinationDetector.ensemble_detection over HTTP from a single
+asyncio event loop (standard library only). Concurrent requests are queued
+and coalesced into micro-batches, bounded by a maximum batch size and a
+maximum wait, that run through the batched ensemble on one inference
+thread. A full queue is rejected with 503 (backpressure)
+
+Endpoints:
+    POST /detect   {"query": ..., "evidence": ..., "llm_output": ...}
+                   -> {"prediction", "label", "confidence", "method_scores"}
+    GET  /health   readiness and queue depth
+    GET  /metrics  request/batch counters, latency percentiles, per-stage timings
+
+Usage:
+    python service.py --port 8080 --max-batch-size 32 --max-wait-ms 5
+    python loadgen.py --url http://127.0.0.1:8080 --concurrency 64 --requests 2000
+"""
+
+import json
+import math
+import time
+import asyncio
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from main import HallucinationDetector, detector_args, open_embedding_cache
+from instrumentation import StageProfiler, PERCENTILES
+from onnx_backend import BACKENDS, DEFAULT_ONNX_DIR
+from nli_models import NLI_PRESETS, DEFAULT_NLI_PRESET
+from medical_rules import DEFAULT_RULES_PATH
+from embedding_cache import DEFAULT_EMBEDDING_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_BYTES = 1 << 20
+# Request latencies kept for the /metrics percentiles
+LATENCY_WINDOW = 10000
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+def json_scores(method_scores):
+    """method_scores with non-finite scores (e.g. NaN) as None, since JSON has no NaN"""
+    return {
+        name: (pred, None if score is None or not math.isfinite(score) else float(score))
+        for name, (pred, score) in method_scores.items()
+    }
+
+
+class QueueFull(Exception):
+    """The micro-batcher already holds max_queue pending requests"""
+
+
+class MicroBatcher:
+    """Coalesces concurrent detection requests into batched ensemble calls
+
+    A batch is dispatched once it holds max_batch_size cases or its first case
+    has waited max_wait_ms, whichever comes first. While a batch runs on the
+    inference thread, new requests keep queueing, so batches grow with load.
+    """
+
+    def __init__(self, detector, max_batch_size=32, max_wait_ms=5.0, max_queue=1024, cascade=False):
+        self.detector = detector
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self.cascade = cascade
+        # One inference thread: model calls are serialized, and each uses the runtime's own thread pool
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inference')
+        self.queue = None
+        self._worker = None
+
+        self.batches = 0
+        self.batched_cases = 0
+        self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+        self.queue_waits = deque(maxlen=LATENCY_WINDOW)
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._worker.cancel()
+        self.executor.shutdown(wait=True)
+
+    @property
+    def pending(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def submit(self, query, evidence, output):
+        """(prediction, confidence, method_scores) for one case, once its batch has run"""
+        if self.pending >= self.max_queue:
+            raise QueueFull()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(((query, evidence, output), future, time.perf_counter()))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = batch[0][2] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    # Past the deadline: take what is already queued, without waiting
+                    while len(batch) < self.max_batch_size and not self.queue.empty():
+                        batch.append(self.queue.get_nowait())
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            start = time.perf_counter()
+            self.queue_waits.extend(start - queued for _, _, queued in batch)
+            cases = [case for case, _, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self._detect, cases)
+            except Exception as exc:
+                logger.exception("Batch of %d cases failed", len(cases))
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            self.batches += 1
+            self.batched_cases += len(batch)
+            self.batch_sizes.append(len(batch))
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _detect(self, cases):
+        queries, evidences, outputs = (list(column) for column in zip(*cases))
+        with self.detector.profiler.span('ensemble', len(cases)):
+            return self.detector.ensemble_detection_batch(queries, evidences, outputs, cascade=self.cascade)
+
+
+class DetectionService:
+    """Minimal HTTP/1.1 (keep-alive) front end for a MicroBatcher"""
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+        self.ready = False
+        self.started = time.time()
+        self.requests = 0
+        self.rejected = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    async def warm_up(self):
+        """Load the models (and run one case) before reporting ready"""
+        detector = self.batcher.detector
+        case = ("What is aspirin used for?", "Aspirin relieves pain and reduces fever.",
+                "Aspirin is used for pain relief.")
+        await asyncio.get_running_loop().run_in_executor(self.batcher.executor, self.batcher._detect, [case])
+        self.ready = True
+        logger.info("  → Models loaded (%s backend), service ready", detector.backend)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self._respond(writer, 400, {'error': 'malformed request line'}, keep_alive=False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    length = int(headers.get('content-length') or 0)
+                    if length < 0:
+                        raise ValueError
+                except ValueError:
+                    await self._respond(writer, 400, {'error': 'invalid Content-Length'}, keep_alive=False)
+                    break
+                if length > MAX_BODY_BYTES:
+                    await self._respond(writer, 413, {'error': f'body larger than {MAX_BODY_BYTES} bytes'},
+                                        keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                status, payload, extra_headers = await self.route(method, path.split('?', 1)[0], body)
+                await self._respond(writer, status, payload, keep_alive, extra_headers)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, payload, keep_alive=True, extra_headers=None):
+        body = json.dumps(payload, allow_nan=False).encode('utf-8')
+        head = [f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+                "Content-Type: application/json",
+                f"Content-Length: {len(body)}",
+                f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        head.extend(f"{name}: {value}" for name, value in (extra_headers or {}).items())
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def route(self, method, path, body):
+        """(status, JSON payload, extra headers) for one request"""
+        if path == '/detect':
+            if method != 'POST':
+                return 405, {'error': 'use POST'}, {'Allow': 'POST'}
+            return await self.detect(body)
+        if path == '/health':
+            status = 200 if self.ready else 503
+            return status, {'status': 'ok' if self.ready else 'loading', 'queue_depth': self.batcher.pending}, None
+        if path == '/metrics':
+            return 200, self.metrics(), None
+        return 404, {'error': f'no route {path}'}, None
+
+    async def detect(self, body):
+        start = time.perf_counter()
+        try:
+            case = json.loads(body)
+            fields = [case[name] for name in ('query', 'evidence', 'llm_output')]
+            if not all(isinstance(field, str) for field in fields):
+                raise TypeError
+        except (ValueError, KeyError, TypeError):
+            return 400, {'error': "expected a JSON object with string fields query, evidence and llm_output"}, None
+        if not self.ready:
+            return 503, {'error': 'models are loading'}, {'Retry-After': '1'}
+
+        self.requests += 1
+        try:
+            prediction, confidence, method_scores = await self.batcher.submit(*fields)
+        except QueueFull:
+            self.rejected += 1
+            return 503, {'error': 'detection queue is full'}, {'Retry-After': '1'}
+        except Exception as exc:
+            self.errors += 1
+            return 500, {'error': f'{type(exc).__name__}: {exc}'}, None
+        self.latencies.append(time.perf_counter() - start)
+        return 200, {
+            'prediction': prediction,
+            'label': 'HALLUCINATION' if prediction == 1 else 'FACTUAL',
+            'confidence': confidence,
+            'method_scores': json_scores(method_scores)
+        }, None
+
+    def metrics(self):
+        def percentiles(values):
+            values = np.array(values)
+            if not len(values):
+                return None
+            return {f'p{q}': float(np.percentile(values, q) * 1000) for q in PERCENTILES}
+
+        batcher = self.batcher
+        return {
+            'uptime_sec': time.time() - self.started,
+            'requests': self.requests,
+            'rejected': self.rejected,
+            'errors': self.errors,
+            'queue_depth': batcher.pending,
+            'batches': batcher.batches,
+            'mean_batch_size': batcher.batched_cases / batcher.batches if batcher.batches else None,
+            'max_batch_size': max(batcher.batch_sizes, default=None),
+            'latency_ms': percentiles(self.latencies),
+            'queue_wait_ms': percentiles(batcher.queue_waits),
+            'stages': batcher.detector.profiler.summary()['stages']
+        }
+
+
+async def serve(detector, host='127.0.0.1', port=8080, max_batch_size=32, max_wait_ms=5.0, max_queue=1024,
+                cascade=False):
+    """Run the service until cancelled"""
+    batcher = MicroBatcher(detector, max_batch_size, max_wait_ms, max_queue, cascade)
+    batcher.start()
+    service = DetectionService(batcher)
+    server = await asyncio.start_server(service.handle, host, port, backlog=1024)
+    print(f"✓ Listening on http://{host}:{port} (batches of up to {max_batch_size}, {max_wait_ms:g} ms max wait, "
+          f"queue limit {max_queue})")
+    await service.warm_up()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await batcher.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP hallucination detection service with micro-batching")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch-size', type=int, default=32, help="cases per micro-batch (default 32)")
+    parser.add_argument('--max-wait-ms', type=float, default=5.0,
+                        help="longest a request waits for its batch to fill (default 5 ms)")
+    parser.add_argument('--max-queue', type=int, default=1024,
+                        help="pending requests beyond which new ones get 503 (default 1024)")
+    parser.add_argument('--cascade', action='store_true')
+    parser.add_argument('--no-dedup', dest='dedup', action='store_false',
+                        help="score every row, even when its detector inputs repeat another row's")
+    parser.add_argument('--risk-phrases', metavar='PATH',
+                        help="file with one risk phrase per line, replacing the built-in list")
+    parser.add_argument('--rules', metavar='PATH', default=DEFAULT_RULES_PATH,
+                        help="JSON file with medical safety rules (default: medical_rules.json)")
+    parser.add_argument('--embedding-cache', metavar='DIR', default=DEFAULT_EMBEDDING_CACHE_DIR,
+                        help="persistent embedding cache (safe to share with concurrent batch runs)")
+    parser.add_argument('--backend', choices=BACKENDS, default='torch')
+    parser.add_argument('--onnx-dir', default=DEFAULT_ONNX_DIR)
+    parser.add_argument('--nli-model', default=DEFAULT_NLI_PRESET,
+                        help=f"NLI preset ({', '.join(NLI_PRESETS)}), hub id or local model path")
+    parser.add_argument('--nli-labels')
+    parser.add_argument('--nli-granularity', choices=HallucinationDetector.NLI_GRANULARITIES, default='output')
+    parser.add_argument('--nli-aggregate', choices=HallucinationDetector.NLI_AGGREGATES, default='max_contradiction')
+    parser.add_argument('--log-level', choices=['WARNING', 'INFO', 'DEBUG'], default='INFO')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(message)s')
+    for name in (__name__, 'main'):
+        logging.getLogger(name).setLevel(args.log_level)
+    # Stage timings for /metrics, over a bounded window of recent batches
+    # Same detector arguments as main.py, so a service and a batch run with the same flags agree
+    detector = HallucinationDetector(embedding_cache=open_embedding_cache(args.backend, args.embedding_cache),
+                                     profiler=StageProfiler(max_spans=LATENCY_WINDOW), **detector_args(args))
+    try:
+        asyncio.run(serve(detector, args.host, args.port, args.max_batch_size, args.max_wait_ms, args.max_queue,
+                          args.cascade))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Streaming Helpers for Large Evaluation Runs
+Bounded-size chunking, append-only JSONL result writing and incremental
+metrics, so a run's memory does not grow with the number of cases
+"""
+
+import json
+from itertools import islice
+
+
+def chunked(iterable, size):
+    """Yield lists of at most size items from any iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class JsonlResultWriter:
+    """Append one JSON record per line, flushed as soon as it is written"""
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.file = open(path, 'a' if append else 'w', encoding='utf-8')
+        self.count = 0
+
+    def write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StreamingMetrics:
+    """Confusion-matrix counters updated one prediction at a time
+
+    Cases without a ground-truth label (label None) are counted but left out
+    of the metrics. to_dict() has the same keys as main.compute_metrics().
+    """
+
+    def __init__(self):
+        self.tp = self.tn = self.fp = self.fn = 0
+        self.unlabeled = 0
+
+    def update(self, label, prediction):
+        if label is None:
+            self.unlabeled += 1
+        elif label == 1:
+            if prediction == 1:
+                self.tp += 1
+            else:
+                self.fn += 1
+        else:
+            if prediction == 1:
+                self.fp += 1
+            else:
+                self.tn += 1
+
+    @property
+    def total(self):
+        return self.tp + self.tn + self.fp + self.fn
+
+    def to_dict(self):
+        precision = self.tp / (self.tp + self.fp) if self.tp + self.fp else 0.0
+        recall = self.tp / (self.tp + self.fn) if self.tp + self.fn else 0.0
+        return {
+            'accuracy': (self.tp + self.tn) / self.total if self.total else 0.0,
+            'precision': precision,
+            'recall': recall,
+            'f1_score': 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+            'confusion_matrix': [[self.tn, self.fp], [self.fn, self.tp]]
+        }
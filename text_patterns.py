@@ -0,0 +1,265 @@
+"""
+Compiled Phrase Matching for Large Lexicons
+Builds one trie-shaped regular expression from a phrase list so that every
+phrase is found (or rewritten) in a single pass over the text, however long
+the list gets
+"""
+
+import re
+import hashlib
+import unicodedata
+from collections import Counter
+
+WORD_CHAR = re.compile(r'\w')
+
+
+def load_phrase_file(path):
+    """Read one phrase per line, skipping blank lines and '#' comments"""
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+
+def trie_pattern(phrases):
+    """Regex source matching any of phrases, factored into a character trie
+
+    Shared prefixes are matched once ("no risk|no side effects" becomes
+    "no\\ (?:risk|side\\ effects)"), so the regex engine does not try every
+    alternative at every position. Longer phrases win over their prefixes.
+    """
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for ch in phrase:
+            node = node.setdefault(ch, {})
+        node[''] = True
+
+    def build(node):
+        is_end = '' in node
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch != '']
+        if not branches:
+            return ''
+        if len(branches) == 1 and not is_end:
+            return branches[0]
+        group = '(?:' + '|'.join(branches) + ')'
+        return group + '?' if is_end else group
+
+    return build(trie)
+
+
+class PhraseMatcher:
+    """Single-pass matcher for a fixed phrase list
+
+    Matching is case-insensitive by default and, with word_boundary=True, a
+    phrase only matches when it is not glued to other word characters - this
+    also works for phrases that start or end with punctuation such as "100%".
+    """
+
+    def __init__(self, phrases, word_boundary=True, case_sensitive=False):
+        self.case_sensitive = case_sensitive
+        self.word_boundary = word_boundary
+        normalize = (lambda p: p) if case_sensitive else str.lower
+        self.phrases = list(dict.fromkeys(normalize(p) for p in phrases if p))
+        self._phrase_set = frozenset(self.phrases)
+
+        pattern = trie_pattern(self.phrases) if self.phrases else '(?!)'
+        if word_boundary:
+            pattern = rf'(?<!\w)(?:{pattern})(?!\w)'
+        flags = 0 if case_sensitive else re.IGNORECASE
+        self.regex = re.compile(pattern, flags)
+        # Zero-width variant: tries every start position, so overlapping hits are all seen
+        self._overlapping = re.compile(f'(?=({pattern}))', flags)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        return cls(load_phrase_file(path), **kwargs)
+
+    def _key(self, matched):
+        return matched if self.case_sensitive else matched.lower()
+
+    def finditer(self, text):
+        """Yield (phrase, start, end) for every non-overlapping phrase hit"""
+        for m in self.regex.finditer(text):
+            yield self._key(m.group()), m.start(), m.end()
+
+    def count(self, text):
+        """Per-phrase match counts for text
+
+        Each phrase is counted as if searched on its own, so overlapping
+        phrases ("may" and "may be") are all counted. The overlapping scan
+        yields the longest phrase at each start; shorter phrases starting
+        there are prefixes of it that end on a word boundary.
+        """
+        counts = Counter()
+        next_start = {}
+        for m in self._overlapping.finditer(text):
+            start, matched = m.start(), m.group(1)
+            for length in range(1, len(matched) + 1):
+                phrase = self._key(matched[:length])
+                if phrase not in self._phrase_set:
+                    continue
+                if length < len(matched) and self.word_boundary and WORD_CHAR.match(text, start + length):
+                    continue
+                # A phrase's own hits never overlap, as with one regex per phrase
+                if start < next_start.get(phrase, 0):
+                    continue
+                counts[phrase] += 1
+                next_start[phrase] = start + length
+        return counts
+
+
+# (phrases, text) pairs with overlapping phrases, for check_phrase_counts()
+PHRASE_COUNT_EXAMPLES = [
+    (["may", "may be", "be"], "It may be fine, or it may not. May be."),
+    (["no side effects", "side effects", "no"], "No side effects, no risk: side effects are rare."),
+    (["no no", "no"], "no no no"),
+    (["100%", "100% safe", "safe"], "It is 100% safe; 100%, safe."),
+    (["always", "always safe", "safe"], "always safer, always safe"),
+]
+
+
+def reference_phrase_counts(phrases, text):
+    """Per-phrase counts the slow way: one word-bounded, case-insensitive regex per phrase"""
+    counts = Counter()
+    for phrase in dict.fromkeys(p.lower() for p in phrases if p):
+        hits = len(re.findall(rf'(?<!\w){re.escape(phrase)}(?!\w)', text, re.IGNORECASE))
+        if hits:
+            counts[phrase] = hits
+    return counts
+
+
+def check_phrase_counts(examples=PHRASE_COUNT_EXAMPLES):
+    """Examples where PhraseMatcher.count differs from one regex per phrase; an empty list means all pass"""
+    failures = []
+    for phrases, text in examples:
+        got, expected = PhraseMatcher(phrases).count(text), reference_phrase_counts(phrases, text)
+        if got != expected:
+            failures.append((phrases, text, dict(got), dict(expected)))
+    return failures
+
+
+def load_rewrite_file(path):
+    """Read 'pattern => replacement' lines, skipping blank lines and '#' comments"""
+    rules = []
+    for line in load_phrase_file(path):
+        pattern, sep, replacement = line.partition('=>')
+        if not sep:
+            raise ValueError(f"{path}: expected 'pattern => replacement', got {line!r}")
+        rules.append((pattern.strip(), replacement.strip()))
+    return rules
+
+
+def match_case(replacement, matched):
+    """replacement in the capitalization of matched: UPPER CASE, Capitalized or as given"""
+    if len(matched) > 1 and matched.isupper():
+        return replacement.upper()
+    if matched[:1].isupper():
+        return replacement[:1].upper() + replacement[1:]
+    return replacement
+
+
+class PhraseRewriter:
+    """Single-pass phrase replacement for a fixed (pattern, replacement) table
+
+    All patterns are compiled into one PhraseMatcher, so the text is scanned
+    once however many rules there are, and the output is assembled once.
+    Patterns match case-insensitively on word boundaries ("all" never
+    rewrites "usually"), the longest pattern wins where patterns overlap, and
+    each replacement takes the capitalization of the text it replaces.
+    """
+
+    def __init__(self, rules, word_boundary=True):
+        # Lower-cased pattern -> replacement; a later rule for the same pattern wins
+        self.rules = {pattern.lower(): replacement for pattern, replacement in rules if pattern}
+        self.matcher = PhraseMatcher(self.rules, word_boundary=word_boundary)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        return cls(load_rewrite_file(path), **kwargs)
+
+    def rewrite(self, text):
+        """(rewritten text, edits)
+
+        Each edit records the rule (lower-cased pattern), the original and
+        replacement text, its character offsets in the input (start, end) and
+        in the rewritten text (output_start, output_end).
+        """
+        pieces = []
+        edits = []
+        last = shift = 0
+        for rule, start, end in self.matcher.finditer(text):
+            original = text[start:end]
+            replacement = match_case(self.rules[rule], original)
+            pieces.append(text[last:start])
+            pieces.append(replacement)
+            edits.append({
+                'rule': rule,
+                'original': original,
+                'replacement': replacement,
+                'start': start,
+                'end': end,
+                'output_start': start + shift,
+                'output_end': start + shift + len(replacement)
+            })
+            shift += len(replacement) - len(original)
+            last = end
+        if not edits:
+            return text, edits
+        pieces.append(text[last:])
+        return ''.join(pieces), edits
+
+
+# Terminal punctuation (plus closing quotes/brackets) followed by whitespace and a sentence start
+SENTENCE_END = re.compile(r'[.!?]+["\'”’)\]]*(?=\s+["\'“‘(\[]?[A-Z0-9])')
+
+# Lower-cased tokens whose trailing period does not end a sentence
+ABBREVIATIONS = frozenset([
+    'e.g.', 'i.e.', 'etc.', 'vs.', 'approx.', 'dr.', 'mr.', 'mrs.', 'ms.', 'prof.', 'st.', 'no.', 'fig.', 'cf.'
+])
+
+
+def split_sentences(text):
+    """Split text into sentences at . ! ? boundaries
+
+    A boundary needs whitespace and an upper-case letter or digit after it,
+    so decimals ("1.5 mg") never split, and common abbreviations ("e.g.",
+    "Dr.") are skipped. Text without a boundary comes back as one sentence.
+    """
+    sentences = []
+    start = 0
+    for m in SENTENCE_END.finditer(text):
+        sentence = text[start:m.end()].strip()
+        last_token = sentence.rsplit(None, 1)[-1].lower() if sentence else ''
+        if last_token.rstrip('"\'”’)]') in ABBREVIATIONS:
+            continue
+        if sentence:
+            sentences.append(sentence)
+        start = m.end()
+    tail = text[start:].strip()
+    if tail:
+        sentences.append(tail)
+    return sentences
+
+
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_text(text):
+    """NFC-normalized text with whitespace runs collapsed to one space and the ends stripped"""
+    return WHITESPACE.sub(' ', unicodedata.normalize('NFC', text)).strip()
+
+
+def content_key(*texts):
+    """Short hash of the normalized texts, equal for inputs that differ only in whitespace"""
+    content = '\0'.join(normalize_text(text) for text in texts)
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+
+
+if __name__ == "__main__":
+    import sys
+
+    # Usage: python text_patterns.py  - check PhraseMatcher.count against one regex per phrase
+    failures = check_phrase_counts()
+    print(f"Phrase count examples: {len(PHRASE_COUNT_EXAMPLES) - len(failures)}/{len(PHRASE_COUNT_EXAMPLES)} pass")
+    for phrases, text, got, expected in failures:
+        print(f"  {phrases} in {text!r}: got {got}, expected {expected}")
+    sys.exit(1 if failures else 0)